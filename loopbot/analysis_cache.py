@@ -0,0 +1,217 @@
+""" A persistent, content-addressed cache for InfiniteJukebox analyses.
+
+The expensive part of processing a song (downbeats, segmentation, clustering)
+only depends on the decoded audio and a handful of constructor args, so its
+result can be saved to disk and reused the next time the same song shows up --
+even if it came from a different file or URL.
+
+The analysis is saved in stages (the beat-synchronous features, then the
+eigenvectors, then the clusters), each keyed off the one before it with derive(),
+so changing only the later stages' args still reuses the earlier stages' work.
+
+Entries are stored one per file as .npz archives (numpy's binary format, no
+pickles) named after the hash of the audio and args. Every entry carries a
+version stamp, so bumping CACHE_VERSION when the analysis changes invalidates
+everything written by older code. The directory is kept under a byte budget by
+evicting the least recently used entries.
+
+  Example:
+
+      cache = AnalysisCache('~/.cache/loopbot/analysis', max_bytes=256 * 1024 * 1024)
+      jukebox = InfiniteJukebox('some_file.mp3', analysis_cache=cache)
+
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from loopbot import decode
+
+# bump this whenever the analysis (or what gets stored from it) changes
+
+CACHE_VERSION = 3
+
+_SUFFIX = '.npz'
+
+class AnalysisCache(object):
+
+    """ A directory of saved analyses, bounded to max_bytes on disk.
+
+        Reads and writes are safe from multiple threads and processes: entries
+        are written to a temp file and renamed into place, so a reader only ever
+        sees a whole entry or none at all.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+
+        """ Args:
+
+                directory: where to keep the entries. Created if it doesn't exist.
+                max_bytes: the most disk space the entries may take. Once a put()
+                           goes over it, the least recently used entries get evicted.
+        """
+
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(audio, params, digest=None):
+
+        """ Returns the cache key for some decoded audio and the analysis args.
+
+            Args:
+
+                audio: a numpy array of the decoded samples
+               params: a dict of everything else that can change the analysis.
+                       Must be JSON serializable.
+               digest: decode.pcm_digest(audio), if it's already known (e.g. from
+                       DecodedAudio.digest). Otherwise it's worked out here -- which
+                       means reading through all of the audio.
+        """
+
+        if digest is None:
+            digest = decode.pcm_digest(audio)
+
+        h = hashlib.blake2b(digest_size=20)
+
+        h.update(str(CACHE_VERSION).encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        h.update(str((np.dtype(audio.dtype).str, audio.shape)).encode())
+        h.update(digest.encode())
+
+        return h.hexdigest()
+
+    @staticmethod
+    def derive(key, params):
+
+        """ Returns the cache key for a later stage of the analysis of the same audio.
+
+            Args:
+
+                  key: the key of the stage before it (from key() or derive())
+               params: a dict of everything else that can change this stage.
+                       Must be JSON serializable.
+        """
+
+        h = hashlib.blake2b(digest_size=20)
+
+        h.update(str(CACHE_VERSION).encode())
+        h.update(key.encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+
+        return h.hexdigest()
+
+    def get(self, key):
+
+        """ Returns the dict of arrays saved under key, or None if there isn't one
+            (or it was written by a different CACHE_VERSION).
+        """
+
+        path = self.__path(key)
+
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                if int(npz['__version__']) != CACHE_VERSION:
+                    entry = None
+                else:
+                    entry = {name: npz[name] for name in npz.files if name != '__version__'}
+        except (FileNotFoundError, ValueError, OSError, KeyError):
+            entry = None
+
+        if entry is None:
+            with self.__lock:
+                self.misses += 1
+            return None
+
+        # mark the entry as recently used, for eviction
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        with self.__lock:
+            self.hits += 1
+
+        return entry
+
+    def put(self, key, arrays):
+
+        """ Saves a dict of numpy arrays under key, then evicts old entries if the
+            cache has gone over max_bytes.
+        """
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, __version__=np.array(CACHE_VERSION), **arrays)
+
+            os.replace(tmp, self.__path(key))
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+
+        self.evict()
+
+    def evict(self):
+
+        """ Deletes the least recently used entries until the cache fits in max_bytes. """
+
+        entries = []
+
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(_SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    @property
+    def nbytes(self):
+
+        """ The disk space currently taken by the entries. """
+
+        total = 0
+
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(_SUFFIX):
+                    try:
+                        total += entry.stat().st_size
+                    except FileNotFoundError:
+                        pass
+
+        return total
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
@@ -0,0 +1,3 @@
+""" Benchmarks for the analysis and playback code. Each module can be run with
+python -m loopbot.benchmarks.<name> -- see its docstring for the args.
+"""
@@ -0,0 +1,100 @@
+""" Compares chunked, multi-process downbeat detection against the single pass.
+
+  Usage:
+
+      python -m loopbot.benchmarks.downbeats some_file.mp3 --workers 4 --chunk-seconds 120
+
+Runs the downbeat RNN over the whole track in one go and then again with
+chunked_downbeat_activations(), decodes both with the same DBN, and prints
+the speedup along with how well the two sets of beats and downbeats agree.
+"""
+
+import argparse
+import json
+import time
+
+import librosa
+import numpy as np
+
+from loopbot import remixatron
+
+def agreement(reference, estimate, tolerance=.07):
+
+    """ The F-measure between two arrays of beat times: the fraction of beats that
+        have a partner within tolerance seconds in the other array. 1.0 means every
+        beat was found in both. """
+
+    if len(reference) == 0 and len(estimate) == 0:
+        return 1.0
+
+    if len(reference) == 0 or len(estimate) == 0:
+        return 0.0
+
+    # for each estimated beat, the nearest reference beat
+
+    idx = np.clip(np.searchsorted(reference, estimate), 1, len(reference) - 1)
+    nearest = np.minimum(np.abs(estimate - reference[idx - 1]), np.abs(estimate - reference[idx]))
+
+    matched = np.count_nonzero(nearest <= tolerance)
+
+    precision = matched / len(estimate)
+    recall = matched / len(reference)
+
+    if matched == 0:
+        return 0.0
+
+    return 2 * precision * recall / (precision + recall)
+
+def run(filename, chunk_seconds, overlap_seconds, workers):
+
+    """ Runs the benchmark on one file and returns the results as a dict. """
+
+    y, sr = librosa.core.load(filename, mono=True, sr=44100)
+
+    remixatron.warm_up()
+
+    # the process pool is kept from one song to the next, so start it (and let its
+    # workers load their models) before timing anything
+    remixatron.chunked_downbeat_activations(y, sr, chunk_seconds, overlap_seconds, workers=workers)
+
+    with remixatron.DOWNBEAT_PROCESSORS.acquire() as (rnn, dbn, _):
+        t = time.perf_counter()
+        single = dbn(rnn(y))
+        single_seconds = time.perf_counter() - t
+
+        t = time.perf_counter()
+        act = remixatron.chunked_downbeat_activations(y, sr, chunk_seconds, overlap_seconds, workers=workers, rnn=rnn)
+        chunked = dbn(act)
+        chunked_seconds = time.perf_counter() - t
+
+    return {'file': filename,
+            'duration': len(y) / sr,
+            'chunk_seconds': chunk_seconds,
+            'overlap_seconds': overlap_seconds,
+            'workers': workers,
+            'single_pass_seconds': single_seconds,
+            'chunked_seconds': chunked_seconds,
+            'speedup': single_seconds / chunked_seconds,
+            'beat_agreement': agreement(single[:, 0], chunked[:, 0]),
+            'downbeat_agreement': agreement(single[single[:, 1] == 1, 0], chunked[chunked[:, 1] == 1, 0])}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filename')
+    parser.add_argument('--chunk-seconds', type=float, default=120)
+    parser.add_argument('--overlap-seconds', type=float, default=15)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.filename, args.chunk_seconds, args.overlap_seconds, args.workers)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for key, value in results.items():
+        print('{:<20} {}'.format(key, round(value, 4) if isinstance(value, float) else value))
+
+if __name__ == '__main__':
+    main()
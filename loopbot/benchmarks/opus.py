@@ -0,0 +1,100 @@
+""" Compares the CPU cost of playing a jukebox with live Opus encoding against
+playing it from pre-encoded packets.
+
+  Usage:
+
+      python -m loopbot.benchmarks.opus some_file.mp3 --seconds 60 --streams 1 10 100
+
+Analyses the file, then plays --seconds of its remix both ways, the way the
+bot's voice connections would: once through JukeboxAudioSource with every
+20ms frame going through an Opus encoder (what discord.py does for a PCM
+source), and once through OpusJukeboxSource, which just hands out packets.
+The one-off cost of encoding the packets is measured separately, so the
+totals for N streams of the same song can be compared. Needs libopus.
+"""
+
+import argparse
+import json
+import time
+
+import discord
+
+from loopbot import remixatron
+from loopbot.bot.audio import JukeboxAudioSource, OpusJukeboxSource
+from loopbot.bot.opus_packets import OpusBeatPackets
+
+FRAMES_PER_SECOND = 50
+
+def _cpu(fn):
+    t = time.process_time()
+    result = fn()
+    return time.process_time() - t, result
+
+def live_stream(jukebox, frames):
+
+    """ Plays frames of the remix the way discord.py plays a PCM source """
+
+    source = JukeboxAudioSource(jukebox, jukebox.crossfades)
+    encoder = discord.opus.Encoder()
+
+    for _ in range(frames):
+        encoder.encode(source.read(), discord.opus.Encoder.SAMPLES_PER_FRAME)
+
+def packet_stream(jukebox, packets, frames):
+
+    """ Plays frames of the remix from pre-encoded packets """
+
+    source = OpusJukeboxSource(jukebox, packets)
+
+    for _ in range(frames):
+        source.read()
+
+def run(filename, seconds, streams):
+
+    """ Runs the benchmark on one file and returns the results as a dict. """
+
+    jukebox = remixatron.InfiniteJukebox(filename, sample_rate=JukeboxAudioSource.SAMPLE_RATE)
+    jukebox.crossfades
+
+    frames = int(seconds * FRAMES_PER_SECOND)
+
+    encode_seconds, packets = _cpu(lambda: OpusBeatPackets(jukebox))
+    live_seconds, _ = _cpu(lambda: live_stream(jukebox, frames))
+    packet_seconds, _ = _cpu(lambda: packet_stream(jukebox, packets, frames))
+
+    return {'file': filename,
+            'duration': jukebox.duration,
+            'played_seconds': seconds,
+            'encode_cpu_seconds': encode_seconds,
+            'packet_bytes': packets.nbytes,
+            'live_cpu_per_second': live_seconds / seconds,
+            'packet_cpu_per_second': packet_seconds / seconds,
+            'streams': {n: {'live_cpu_seconds': n * live_seconds,
+                            'packet_cpu_seconds': encode_seconds + n * packet_seconds}
+                        for n in streams}}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filename')
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--streams', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.filename, args.seconds, args.streams)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("encoding the packets: {:.2f}s cpu, {:.1f} MiB".format(results['encode_cpu_seconds'],
+                                                                  results['packet_bytes'] / 1024 / 1024))
+    print("cpu per second played: live {:.2%}, pre-encoded {:.2%}".format(results['live_cpu_per_second'],
+                                                                          results['packet_cpu_per_second']))
+
+    for n, totals in results['streams'].items():
+        print("{:>4} streams of {:.0f}s: live {:.2f}s cpu, pre-encoded {:.2f}s cpu".format(
+            n, args.seconds, totals['live_cpu_seconds'], totals['packet_cpu_seconds']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+""" End to end benchmark of the InfiniteJukebox analysis on synthetic songs.
+
+  Usage:
+
+      python -m loopbot.benchmarks.pipeline --minutes 3 15 60 --output bench.json
+
+For each length, writes a synthetic song (see synth.py, reused between runs
+from --workdir), runs an InfiniteJukebox over it and records the total and
+per-stage wall time, CPU time and peak memory, along with what the analysis
+found. The results are written as JSON, so runs from different commits can be
+diffed or compared with --compare.
+
+Everything runs offline and on the CPU. Extra constructor args for the jukebox
+can be passed with --arg, e.g. --arg cluster_search=coarse --arg cluster_workers=4
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from loopbot import remixatron
+from loopbot.benchmarks import synth
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, check=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _parse_arg(arg):
+    key, _, value = arg.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, value
+
+def run_one(filename, jukebox_args, track_memory=False):
+
+    """ Runs one jukebox over filename and returns its results as a dict. """
+
+    t = time.perf_counter()
+    cpu = time.process_time()
+
+    # the jukebox prints its cluster table; keep it out of the JSON on stdout
+
+    with contextlib.redirect_stdout(sys.stderr):
+        jukebox = remixatron.InfiniteJukebox(filename, track_memory=track_memory, **jukebox_args)
+
+        # touch the play vector and the crossfades, so they get timed too
+
+        jukebox.play_vector
+        jukebox.crossfades
+
+    return {'wall_seconds': time.perf_counter() - t,
+            'cpu_seconds': time.process_time() - cpu,
+            'stages': {name: timing._asdict() for name, timing in jukebox.timings.items()},
+            'duration': jukebox.duration,
+            'beats': len(jukebox.beats),
+            'clusters': int(jukebox.clusters),
+            'segments': int(jukebox.segments),
+            'crossfade_samples': jukebox.crossfades.length,
+            'crossfade_bytes': jukebox.crossfades.nbytes,
+            'tempo': float(np.ravel(jukebox.tempo)[0])}
+
+def run(minutes, workdir, jukebox_args, seed=0, repeat=1, track_memory=False):
+
+    """ Runs the benchmark for every length in minutes and returns the results. """
+
+    remixatron.warm_up()
+
+    results = {'commit': _git_commit(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'machine': platform.machine(),
+               'cpu_count': os.cpu_count(),
+               'seed': seed,
+               'jukebox_args': jukebox_args,
+               'songs': []}
+
+    for length in minutes:
+        filename = os.path.join(workdir, 'synth-{}min-seed{}.wav'.format(length, seed))
+
+        if not os.path.exists(filename):
+            synth.write_song(filename, length, seed=seed)
+
+        runs = [run_one(filename, jukebox_args, track_memory=track_memory) for _ in range(repeat)]
+
+        results['songs'].append({'minutes': length,
+                                 'runs': runs,
+                                 'best_wall_seconds': min(r['wall_seconds'] for r in runs)})
+
+    return results
+
+def compare(baseline, results):
+
+    """ Prints the change in best wall time, per song length and per stage, from a
+        baseline results file to these results. """
+
+    base_songs = {song['minutes']: song for song in baseline['songs']}
+
+    for song in results['songs']:
+        base = base_songs.get(song['minutes'])
+
+        if base is None:
+            continue
+
+        print("{} min: {:.2f}s -> {:.2f}s ({:+.1%})".format(song['minutes'], base['best_wall_seconds'],
+                                                           song['best_wall_seconds'],
+                                                           song['best_wall_seconds'] / base['best_wall_seconds'] - 1))
+
+        base_stages = base['runs'][0]['stages']
+
+        for name, stage in song['runs'][0]['stages'].items():
+            if name in base_stages and base_stages[name]['wall_seconds'] > 0:
+                before = base_stages[name]['wall_seconds']
+                print("    {:<16} {:>8.3f}s -> {:>8.3f}s ({:+.1%})".format(name, before, stage['wall_seconds'],
+                                                                            stage['wall_seconds'] / before - 1))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, nargs='+', default=[3, 15, 60])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'loopbot-bench'))
+    parser.add_argument('--arg', action='append', default=[], help='a jukebox constructor arg, as key=value')
+    parser.add_argument('--track-memory', action='store_true')
+    parser.add_argument('--output', help='where to write the JSON results (default: stdout)')
+    parser.add_argument('--compare', help='a previous JSON results file to compare against')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+
+    results = run(args.minutes, args.workdir, dict(_parse_arg(a) for a in args.arg),
+                  seed=args.seed, repeat=args.repeat, track_memory=args.track_memory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
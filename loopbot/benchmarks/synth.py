@@ -0,0 +1,116 @@
+""" Deterministic synthetic songs for benchmarking the analysis.
+
+The songs are built out of a handful of sections (intro, verse, chorus, bridge)
+that repeat in a pop-song order until the requested length is reached. Every
+section is a chord loop over a bass line, with a click on every beat that's
+accented on the downbeats -- so there are real bars for the downbeat tracker
+to find and real repeated structure for the segmentation to find.
+
+The same seed and length always give exactly the same samples.
+
+  Usage:
+
+      python -m loopbot.benchmarks.synth out.wav --minutes 15
+
+"""
+
+import argparse
+
+import numpy as np
+import soundfile
+
+SAMPLE_RATE = 44100
+
+# the order the sections play in. Once the end is reached, it starts over from
+# the first verse.
+FORM = ['intro', 'verse', 'chorus', 'verse', 'chorus', 'bridge', 'chorus', 'chorus']
+
+# semitones above the root for each chord quality
+TRIADS = {'maj': (0, 4, 7), 'min': (0, 3, 7)}
+
+def _tone(freq, n, sr, harmonics=3):
+    t = np.arange(n) / sr
+    tone = sum(np.sin(2 * np.pi * freq * h * t) / h for h in range(1, harmonics + 1))
+    return tone * np.exp(-t * 1.5)
+
+def _click(freq, n, sr):
+    t = np.arange(min(n, int(.03 * sr))) / sr
+    click = np.zeros(n)
+    click[:len(t)] = np.sin(2 * np.pi * freq * t) * np.exp(-t * 150)
+    return click
+
+def make_section(rng, tempo, bars, sr=SAMPLE_RATE, beats_per_bar=4):
+
+    """ Makes one section: a random four chord loop, two bars a chord, with a bass
+        note on every beat and a click track on top. Returns stereo float32 samples
+        shaped (frames, 2). """
+
+    beat_len = int(round(60.0 / tempo * sr))
+
+    roots = rng.choice(np.arange(45, 57), size=4)
+    qualities = rng.choice(list(TRIADS), size=4)
+
+    beats = []
+
+    for bar in range(bars):
+        chord = (bar // 2) % 4
+        root = roots[chord]
+
+        for beat in range(beats_per_bar):
+            notes = [root + 12 + i for i in TRIADS[qualities[chord]]]
+
+            pad = sum(_tone(440 * 2 ** ((n - 69) / 12), beat_len, sr) for n in notes) / len(notes)
+            bass = _tone(440 * 2 ** ((root - 12 - 69) / 12), beat_len, sr, harmonics=2)
+            click = _click(1500 if beat == 0 else 1000, beat_len, sr)
+
+            beats.append(.3 * pad + .3 * bass + (.5 if beat == 0 else .25) * click)
+
+    mono = np.concatenate(beats)
+
+    # a little stereo width, so the channels aren't identical
+
+    return np.stack([mono, .9 * mono + .1 * np.roll(mono, beat_len // 4)], axis=1).astype(np.float32)
+
+def write_song(filename, minutes, seed=0, tempo=120.0, sr=SAMPLE_RATE):
+
+    """ Writes a synthetic song of the given length (in minutes) to a WAV file, one
+        section at a time -- so even an hour of it never has to fit in memory. """
+
+    rng = np.random.RandomState(seed)
+
+    sections = {name: make_section(rng, tempo, bars=4 if name == 'intro' else 8, sr=sr)
+                for name in sorted(set(FORM))}
+
+    peak = max(np.abs(s).max() for s in sections.values())
+
+    total = int(minutes * 60 * sr)
+    written = 0
+
+    with soundfile.SoundFile(filename, mode='w', samplerate=sr, channels=2, subtype='PCM_16') as f:
+        form = iter(FORM)
+
+        while written < total:
+            name = next(form, None)
+
+            if name is None:
+                form = iter(FORM[1:])
+                name = next(form)
+
+            section = sections[name][:total - written]
+            f.write(.8 * section / peak)
+            written += len(section)
+
+    return filename
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filename')
+    parser.add_argument('--minutes', type=float, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tempo', type=float, default=120.0)
+    args = parser.parse_args()
+
+    write_song(args.filename, args.minutes, seed=args.seed, tempo=args.tempo)
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,8 @@ secrets = load_secrets(root_dir/'secrets.toml')
 
 bot = asyncio.run(init_bot())
 
-bot.run(token=secrets.token)
+# root_logger, so loopbot's own logging shows up alongside discord's
+bot.run(token=secrets.token, root_logger=True)
 
 
 # bot.client.run(token=secrets.token)
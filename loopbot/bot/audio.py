@@ -0,0 +1,222 @@
+import audioop
+import bisect
+from typing import Optional, Union
+
+import discord
+import numpy as np
+
+from loopbot import remixatron
+from .opus_packets import OpusBeatPackets
+from .scheduler import DecodedTrack
+
+# what discord wants from an AudioSource: 20ms of 16 bit 48kHz stereo per read()
+SAMPLE_RATE = discord.opus.Encoder.SAMPLING_RATE
+CHANNELS = discord.opus.Encoder.CHANNELS
+FRAME_BYTES = discord.opus.Encoder.FRAME_SIZE
+SAMPLE_BYTES = discord.opus.Encoder.SAMPLE_SIZE
+SAMPLES_PER_FRAME = discord.opus.Encoder.SAMPLES_PER_FRAME
+
+
+class JukeboxAudioSource(discord.AudioSource):
+    """
+    plays a jukebox's endless remix, walking its play path and copying each beat's samples straight out of raw_audio.
+    beats don't line up with 20ms frames, so a frame can end partway through a beat (and pick up from there next time) or span several beats.
+    jumps start with the jump's precomputed crossfade (see remixatron.JumpCrossfades) instead of the first few ms of the beat, so they don't click.
+    """
+    SAMPLE_RATE = SAMPLE_RATE
+
+    def __init__(self, jukebox: Union[remixatron.InfiniteJukebox, remixatron.JukeboxAnalysis], crossfades: Optional[remixatron.JumpCrossfades] = None) -> None:
+        audio = jukebox.raw_audio
+        if jukebox.sample_rate != SAMPLE_RATE or audio.ndim != 2 or audio.shape[1] != CHANNELS:
+            raise ValueError(f'jukebox audio must be {CHANNELS} channel {SAMPLE_RATE}Hz, not {audio.shape} at {jukebox.sample_rate}Hz')
+        self._jukebox = jukebox
+        self._pcm = memoryview(np.ascontiguousarray(audio)).cast('B')
+        # where each beat starts and stops, in bytes
+        self._beat_starts = (jukebox.beats.column('start_index') * SAMPLE_BYTES).tolist()
+        self._beat_stops = (np.minimum(jukebox.beats.column('stop_index'), len(audio)) * SAMPLE_BYTES).tolist()
+        self._play_path = jukebox.play_path()
+        self._crossfades = crossfades
+        if crossfades is not None:
+            self._fades = memoryview(np.ascontiguousarray(crossfades.fades)).cast('B')
+            self._fade_bytes = crossfades.length * SAMPLE_BYTES
+        self._frame = bytearray(FRAME_BYTES)
+        # the part of the current beat (or crossfade) that's still to be played
+        self._buffer = self._pcm
+        self._pos = 0
+        self._stop = 0
+        # after a crossfade, the rest of the beat it leads into
+        self._resume: Optional[tuple[int, int]] = None
+        self._beat: Optional[int] = None
+
+    def start_at(self, sample: int) -> None:
+        """picks up from sample, e.g. where the song's been played straight through up to: the rest of the beat that's in plays as is, and the remix starts from the beat after. call it before the first read()"""
+        pos = sample * SAMPLE_BYTES
+        beat = bisect.bisect_left(self._beat_starts, pos)
+        if beat < len(self._beat_starts):
+            # play on to the next beat, which then follows on from it like any other
+            self._stop, self._beat = self._beat_starts[beat], beat - 1
+        else:
+            # past the last beat, so play out the song and then loop back
+            beat = int(self._jukebox.beats.column('next')[-1])
+            self._stop, self._beat = len(self._pcm), None
+        self._pos = pos
+        self._play_path.close()
+        self._play_path = self._jukebox.play_path(first_beat=beat)
+
+    def _next_beat(self) -> None:
+        previous, beat = self._beat, next(self._play_path).beat
+        self._beat = beat
+        self._buffer = self._pcm
+        self._pos = self._beat_starts[beat]
+        self._stop = self._beat_stops[beat]
+        if self._crossfades is None or previous is None or beat == previous + 1:
+            return
+        edge = self._crossfades.edge(previous, beat)
+        if edge is None:
+            return
+        self._resume = (self._pos + self._fade_bytes, self._stop)
+        self._buffer = self._fades
+        self._pos = edge * self._fade_bytes
+        self._stop = self._pos + self._fade_bytes
+
+    def read(self) -> bytes:
+        frame = self._frame
+        filled = 0
+        while filled < FRAME_BYTES:
+            if self._pos >= self._stop:
+                if self._resume is not None:
+                    self._buffer = self._pcm
+                    self._pos, self._stop = self._resume
+                    self._resume = None
+                else:
+                    self._next_beat()
+                continue
+            n = min(FRAME_BYTES - filled, self._stop - self._pos)
+            frame[filled:filled + n] = self._buffer[self._pos:self._pos + n]
+            filled += n
+            self._pos += n
+        return bytes(frame)
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        self._play_path.close()
+
+
+class OpusJukeboxSource(discord.AudioSource):
+    """
+    plays a jukebox's endless remix from its pre-encoded opus packets (see OpusBeatPackets), so discord sends them as they are rather than encoding every frame.
+    each beat is its frames of the song, except that a jump starts with the jump's own transition packets.
+    """
+    def __init__(self, jukebox: Union[remixatron.InfiniteJukebox, remixatron.JukeboxAnalysis], packets: OpusBeatPackets) -> None:
+        self._jukebox = jukebox
+        self._packets = packets
+        self._frames = packets.frames
+        self._beat_starts = packets.beat_starts.tolist()
+        self._beat_stops = packets.beat_stops.tolist()
+        self._play_path = jukebox.play_path()
+        # the packets still to be played: a jump's transition packets, then the rest of the beat's frames
+        self._pending: tuple[bytes, ...] = ()
+        self._pos = 0
+        self._stop = 0
+        self._beat: Optional[int] = None
+
+    def start_at(self, sample: int) -> None:
+        """same as JukeboxAudioSource.start_at, except that sample has to be on a frame boundary"""
+        if sample % SAMPLES_PER_FRAME:
+            raise ValueError(f'can only start at a frame boundary, not sample {sample}')
+        frame = sample // SAMPLES_PER_FRAME
+        beat = bisect.bisect_left(self._beat_starts, frame)
+        if beat < len(self._beat_starts):
+            self._stop, self._beat = self._beat_starts[beat], beat - 1
+        else:
+            beat = int(self._jukebox.beats.column('next')[-1])
+            self._stop, self._beat = len(self._frames), None
+        self._pos = frame
+        self._play_path.close()
+        self._play_path = self._jukebox.play_path(first_beat=beat)
+
+    def _next_beat(self) -> None:
+        previous, beat = self._beat, next(self._play_path).beat
+        self._beat = beat
+        self._pos = self._beat_starts[beat]
+        self._stop = self._beat_stops[beat]
+        if previous is None or beat == previous + 1:
+            return
+        transition = self._packets.transition(previous, beat)
+        if transition is not None:
+            self._pending = transition
+            self._pos += len(transition)
+
+    def read(self) -> bytes:
+        while not self._pending and self._pos >= self._stop:
+            self._next_beat()
+        if self._pending:
+            packet, self._pending = self._pending[0], self._pending[1:]
+            return packet
+        packet = self._frames[self._pos]
+        self._pos += 1
+        return packet
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        self._play_path.close()
+
+
+class ProgressiveSource(discord.AudioSource):
+    """
+    plays a song straight through (looping at the end) while it's still being analysed, then carries on with the jukebox once it's ready.
+    switch_to() hands over to a JukeboxAudioSource or OpusJukeboxSource, which picks up from exactly where this got to (see start_at), so there's no gap or skip, and the remix proper starts at the next beat.
+    the volume only applies to pcm, pre-encoded opus packets already have it baked in.
+    """
+    def __init__(self, track: Union[remixatron.InfiniteJukebox, remixatron.JukeboxAnalysis, DecodedTrack], volume: float = 1.0) -> None:
+        audio = track.raw_audio
+        if track.sample_rate != SAMPLE_RATE or audio.ndim != 2 or audio.shape[1] != CHANNELS:
+            raise ValueError(f'audio must be {CHANNELS} channel {SAMPLE_RATE}Hz, not {audio.shape} at {track.sample_rate}Hz')
+        self.volume = volume
+        self._pcm = memoryview(np.ascontiguousarray(audio)).cast('B')
+        self._pos = 0
+        self._source: Optional[Union[JukeboxAudioSource, OpusJukeboxSource]] = None
+        self._pending: Optional[Union[JukeboxAudioSource, OpusJukeboxSource]] = None
+        self._opus = False
+
+    @property
+    def switched(self) -> bool:
+        return self._source is not None
+
+    def switch_to(self, source: Union[JukeboxAudioSource, OpusJukeboxSource]) -> None:
+        """hands over to source at the next read(). can be called from any thread, but only once"""
+        if self._source is not None or self._pending is not None:
+            raise RuntimeError('already switched to the jukebox')
+        self._pending = source
+
+    def read(self) -> bytes:
+        if self._pending is not None:
+            # every frame so far has been a whole one, so this is always on a frame boundary
+            self._pending.start_at(self._pos // SAMPLE_BYTES)
+            self._source, self._pending = self._pending, None
+        if self._source is not None:
+            frame = self._source.read()
+            self._opus = self._source.is_opus()
+        else:
+            frame = bytes(self._pcm[self._pos:self._pos + FRAME_BYTES])
+            self._pos += FRAME_BYTES
+            if len(frame) < FRAME_BYTES:
+                # the end of the song, pad it out with silence and go again from the top
+                frame += bytes(FRAME_BYTES - len(frame))
+                self._pos = 0
+        if not self._opus and self.volume != 1.0:
+            frame = audioop.mul(frame, 2, min(self.volume, 2.0))
+        return frame
+
+    def is_opus(self) -> bool:
+        # whatever the last frame read() returned was
+        return self._opus
+
+    def cleanup(self) -> None:
+        for source in (self._source, self._pending):
+            if source is not None:
+                source.cleanup()
@@ -1,253 +1,369 @@
-import asyncio
-import time
-from typing import AsyncGenerator, Literal, Optional, Union
-import discord
-from discord import app_commands
-from discord.ext import commands
-from pathlib import Path
-import yt_dlp
-
-from loopbot import remixatron
-
-ytdl = yt_dlp.YoutubeDL({
-    'format': 'bestaudio/best',
-    'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
-    'restrictfilenames': True,
-    'noplaylist': True,
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'auto',
-    'source_address': '0.0.0.0',  # bind to ipv4 since ipv6 addresses cause issues sometimes # (their comment, not mine. TODO - is this accurate?)
-})
-
-ffmpeg_options = {
-    'options': '-vn',
-}
-
-async def ytdl_async_download_helper(url):
-    data = await asyncio.get_event_loop().run_in_executor(None, lambda: ytdl.extract_info(url, download=True))
-    assert data is not None
-    # take first item from playlist
-    if 'entries' in data:
-        data = data['entries'][0]
-    filename = ytdl.prepare_filename(data)
-    # TODO expose title, url, etc. also
-    return filename
-
-# https://stackoverflow.com/a/53996189/8762161
-def jukebox_process_async_helper(input_file):
-    loop = asyncio.get_event_loop()
-    queue = asyncio.Queue[tuple[float, str]]()
-    def on_progress(percentage: float, message: str) -> None:
-        loop.call_soon_threadsafe(queue.put_nowait, (percentage, message))
-    async def get_progress() -> AsyncGenerator[tuple[float, str], None]:
-        done = False # TODO actually check on the jukebox rather than doing this as % based
-        while not done:
-            ret = await queue.get()
-            yield ret
-            if ret[0] >= 1:
-                done = True
-    def make_jukebox():
-        jukebox = remixatron.InfiniteJukebox(filename=input_file, progress_callback=on_progress, do_async=False)
-        return jukebox
-    jukebox_aio = loop.run_in_executor(None, make_jukebox)
-    return jukebox_aio, get_progress()
-    # pass
-
-    # msg: discord.Message = some_channel.send('Processing...')
-
-    # in_progress=False
-    # last_time = 0
-
-    # loop = asyncio.get_running_loop()
-
-    # def on_progress(*args):
-    #     nonlocal in_progress, last_time
-    #     if not in_progress and last_time < time.monotonic() - 1:
-    #         in_progress = True
-    #         asyncio.run_coroutine_threadsafe(on_progress_async(*args), loop)
-    
-    # async def on_progress_async(progress: float, message: str):
-    #     nonlocal in_progress, last_time
-    #     await msg.edit(content=f'{message}... ({progress}% complete)')
-    #     last_time = time.monotonic()
-    #     in_progress = False
-
-
-
-# https://github.com/drensin/Remixatron/blob/71d855ad65399683ba81df394beb8a27e2a1a7ea/infinite_jukebox.py#L147-L184
-def get_jukebox_verbose_info(jukebox: remixatron.InfiniteJukebox):
-    minutes, seconds = divmod(round(jukebox.duration), 60)
-    hours, minutes = divmod(minutes, 60)
-    return (
-        discord.Embed(title='Infinite Jukebox info', description='description', colour=discord.Colour.og_blurple())
-            .add_field(name='duration', value=f'{hours:02}:{minutes:02}:{seconds:02}', inline=True)
-            .add_field(name='beats', value=f'{len(jukebox.beats)}', inline=True)
-            # .add_field(name='tempo', value=f'{int(round(jukebox.tempo))} bpm', inline=True)
-            .add_field(name='tempo', value=f'{jukebox.tempo} bpm', inline=True)
-            .add_field(name='clusters', value=f'{jukebox.clusters}', inline=True)
-            .add_field(name='segments', value=f'{jukebox.segments}', inline=True)
-            .add_field(name='sample rate', value=f'{jukebox.sample_rate}', inline=True)
-    )
-
-
-# https://github.com/Rapptz/discord.py/blob/24b61a71c1e5e24c9f722eb95313debb2d873816/examples/basic_voice.py#L35-L54
-class InfiniteJukeboxYTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, volume=0.5):
-        super().__init__(source, volume)
-
-    @classmethod
-    async def from_url(cls, url):
-        filename = await ytdl_async_download_helper(url=url)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options))
-
-
-class LoopBotCog(commands.GroupCog, name='loopbot'):
-    bot: commands.Bot
-    voice_client: Optional[discord.VoiceClient]
-    jukebox: Optional[remixatron.InfiniteJukebox]
-
-    def __init__(self, bot: commands.Bot) -> None:
-        self.bot = bot
-        self.voice_client = None
-        self.jukebox = None
-        super().__init__()
-
-    @app_commands.command(name='invitelink')
-    async def cmd_invite_link(self, interaction: discord.Interaction) -> None:
-        from .util import bot_invite_link
-        client_id = interaction.client.application_id
-        assert client_id is not None
-        invite_link = bot_invite_link(client_id=client_id, permissions='2150629376')
-        await interaction.response.send_message(f'🔗 invite link: {invite_link}')
-
-    @app_commands.command(name='joinvc')
-    async def cmd_join_vc(self, interaction: discord.Interaction, channel: discord.VoiceChannel) -> None:
-        await interaction.response.defer(thinking=True)
-        if self.voice_client is not None:
-            try:
-                await self.voice_client.move_to(channel=channel)
-                await interaction.followup.send(content=f'✅ moved to channel {channel.name}')
-            except Exception as ex:
-                print('failed to move to voice channel', ex)
-                await interaction.followup.send(content=f'❌ unable to move to channel {channel.name}')
-        else:
-            try:
-                self.voice_client = await channel.connect()
-                await interaction.followup.send(content=f'✅ connected to channel {channel.name}')
-            except Exception as ex:
-                print('failed to connect to voice channel', ex)
-                await interaction.followup.send(content=f'❌ unable to connect to channel {channel.name}')
-
-    @app_commands.command(name='leavevc')
-    async def cmd_leave_vc(self, interaction: discord.Interaction) -> None:
-        if self.voice_client is None:
-            await interaction.response.send_message(content='❌ not connected to any voice channel')
-        else:
-            await self.voice_client.disconnect()
-            await interaction.response.send_message(content='✅ disconnected')
-
-    @app_commands.command(name='play')
-    async def cmd_play(self, interaction: discord.Interaction, url: str) -> None:
-        assert self.voice_client is not None
-        await interaction.response.send_message('downloading...')
-        filename = await ytdl_async_download_helper(url=url)
-        await interaction.edit_original_response(content='processing...')
-        jukebox_aio, jukebox_aio_progress = jukebox_process_async_helper(filename)
-        async for percent, message in jukebox_aio_progress:
-            await interaction.edit_original_response(content=f'processing - {percent*100}% - "{message}"')
-        print('about to await jukebox')
-        self.jukebox = await jukebox_aio
-        print('got jukebox!')
-        await interaction.edit_original_response(embed=get_jukebox_verbose_info(self.jukebox))
-        # await interaction.channel.send(embed=get_jukebox_verbose_info(self.jukebox))
-        # await interaction.edit_original_response(content='playing...')
-        # self.voice_client.play(player, after=lambda e: print(f'player error: {e}') if e else None)
-
-    # @app_commands.command(name='getinfo')
-
-
-
-# based on https://stackoverflow.com/a/63107461/8762161
-class CogWithOwnPrefix(commands.Cog):
-    def get_prefixes(self, bot: Union[commands.Bot, commands.AutoShardedBot], message: discord.Message) -> list[str]:
-        return []
-
-    async def cog_check(self, ctx) -> bool:
-        return super().cog_check(ctx) and ctx.prefix in self.get_prefixes(ctx.bot, ctx.message)
-
-class PingCommandCog(CogWithOwnPrefix):
-    def get_prefixes(self, bot, message) -> list[str]:
-        return super().get_prefixes(bot, message) + commands.when_mentioned(bot, message)
-
-
-# from https://gist.github.com/AbstractUmbra/a9c188797ae194e592efe05fa129c57f#sync-command-example
-class SyncMentionCog(PingCommandCog):
-    def __init__(self, bot: commands.Bot) -> None:
-        self.bot = bot
-
-    @commands.command()
-    @commands.guild_only()
-    @commands.is_owner()
-    async def sync(self, ctx: commands.Context, guilds: commands.Greedy[discord.Guild], spec: Optional[Literal["~", "*", "^"]] = None) -> None:
-        if not guilds:
-            if spec == "~":
-                assert ctx.guild is not None
-                synced = await self.bot.tree.sync(guild=ctx.guild)
-            elif spec == "*":
-                assert ctx.guild is not None
-                self.bot.tree.copy_global_to(guild=ctx.guild)
-                synced = await ctx.bot.tree.sync(guild=ctx.guild)
-            elif spec == "^":
-                assert ctx.guild is not None
-                self.bot.tree.clear_commands(guild=ctx.guild)
-                await self.bot.tree.sync(guild=ctx.guild)
-                synced = []
-            else:
-                synced = await self.bot.tree.sync()
-            await ctx.send(
-                f"Synced {len(synced)} commands {'globally' if spec is None else 'to the current guild.'}"
-            )
-            return
-        ret = 0
-        for guild in guilds:
-            try:
-                await self.bot.tree.sync(guild=guild)
-            except discord.HTTPException:
-                pass
-            else:
-                ret += 1
-        await ctx.send(f"Synced the tree to {ret}/{len(guilds)}.")
-
-def cmd_help_text(command: commands.Command):
-    command.params
-
-class KillBotCog(PingCommandCog):
-    @commands.command()
-    @commands.is_owner()
-    async def stop(self, ctx: commands.Context, kill_mode: Optional[Literal['graceful', 'force']] = None) -> None:
-        cmd_help_text(ctx.command)
-
-def bot_command_prefix(bot: commands.Bot, message: discord.Message) -> list[str]:
-    prefixes = []
-    for cog in bot.cogs.values():
-        if isinstance(cog, CogWithOwnPrefix):
-            prefixes += cog.get_prefixes(bot, message)
-    return prefixes
-
-async def init_bot():
-    intents = discord.Intents.none()
-    intents.guilds = True
-    intents.messages = True
-    intents.message_content = False
-    intents.voice_states = True
-    bot = commands.Bot(command_prefix=bot_command_prefix, intents=intents)
-    await bot.add_cog(LoopBotCog(bot))
-    await bot.add_cog(SyncMentionCog(bot))
-    return bot
-
-
-
+import asyncio
+import logging
+import time
+from typing import Literal, Optional, Union
+import discord
+from discord import app_commands
+from discord.ext import commands
+from pathlib import Path
+
+from loopbot import instrumentation, remixatron
+from .audio import JukeboxAudioSource, OpusJukeboxSource, ProgressiveSource
+from .download_cache import DownloadCache
+from .opus_packets import OpusPacketCache
+from .prefetch import PrefetchSource
+from .scheduler import AnalysisScheduler, SchedulerFull
+from .singleflight import Flight, SingleFlight, Subscription
+
+logger = logging.getLogger(__name__)
+
+ytdl_options = {
+    'format': 'bestaudio/best',
+    'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0',  # bind to ipv4 since ipv6 addresses cause issues sometimes # (their comment, not mine. TODO - is this accurate?)
+}
+
+ffmpeg_options = {
+    'options': '-vn',
+}
+
+# give up on analysing a song if it takes longer than this
+ANALYSIS_TIMEOUT_SECONDS = 15 * 60
+
+PLAYBACK_VOLUME = 0.5
+
+async def ytdl_async_extract_info(downloads: DownloadCache, url):
+    # just the metadata, so we know what the url points at before downloading anything
+    return await asyncio.get_event_loop().run_in_executor(None, downloads.extract_info, url)
+
+async def ytdl_async_download_helper(downloads: DownloadCache, info):
+    # returns straight away if we've already got it
+    filename = await asyncio.get_event_loop().run_in_executor(None, downloads.download, info)
+    # TODO expose title, url, etc. also
+    return str(filename)
+
+def ytdl_track_key(info) -> tuple[str, str]:
+    return (info.get('extractor_key') or info['extractor'], info['id'])
+
+def log_stage_timing(timing: instrumentation.StageTiming) -> None:
+    logger.info('jukebox stage %s: %.3fs wall, %.3fs cpu', timing.stage, timing.wall_seconds, timing.cpu_seconds)
+
+
+# https://github.com/drensin/Remixatron/blob/71d855ad65399683ba81df394beb8a27e2a1a7ea/infinite_jukebox.py#L147-L184
+def get_jukebox_verbose_info(jukebox: Union[remixatron.InfiniteJukebox, remixatron.JukeboxAnalysis]):
+    minutes, seconds = divmod(round(jukebox.duration), 60)
+    hours, minutes = divmod(minutes, 60)
+    return (
+        discord.Embed(title='Infinite Jukebox info', description='description', colour=discord.Colour.og_blurple())
+            .add_field(name='duration', value=f'{hours:02}:{minutes:02}:{seconds:02}', inline=True)
+            .add_field(name='beats', value=f'{len(jukebox.beats)}', inline=True)
+            # .add_field(name='tempo', value=f'{int(round(jukebox.tempo))} bpm', inline=True)
+            .add_field(name='tempo', value=f'{jukebox.tempo} bpm', inline=True)
+            .add_field(name='clusters', value=f'{jukebox.clusters}', inline=True)
+            .add_field(name='segments', value=f'{jukebox.segments}', inline=True)
+            .add_field(name='sample rate', value=f'{jukebox.sample_rate}', inline=True)
+            .add_field(name='model setup', value=f'{jukebox.downbeat_setup_seconds:.2f}s', inline=True)
+    )
+
+
+# https://github.com/Rapptz/discord.py/blob/24b61a71c1e5e24c9f722eb95313debb2d873816/examples/basic_voice.py#L35-L54
+class InfiniteJukeboxYTDLSource(discord.PCMVolumeTransformer):
+    def __init__(self, source, *, volume=PLAYBACK_VOLUME):
+        super().__init__(source, volume)
+
+    @classmethod
+    async def from_url(cls, url, downloads: DownloadCache):
+        info = await ytdl_async_extract_info(downloads, url)
+        filename = await ytdl_async_download_helper(downloads, info)
+        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options))
+
+
+class LoopBotCog(commands.GroupCog, name='loopbot'):
+    bot: commands.Bot
+    voice_client: Optional[discord.VoiceClient]
+    jukebox: Optional[remixatron.JukeboxAnalysis]
+    analysis: Optional[Subscription[remixatron.JukeboxAnalysis]]
+    analyses: SingleFlight[remixatron.JukeboxAnalysis]
+    scheduler: AnalysisScheduler
+    downloads: DownloadCache
+    opus_packets: Optional[OpusPacketCache]
+    player: Optional[PrefetchSource]
+
+    def __init__(self, bot: commands.Bot, cache_dir: Path = Path('cache'), analysis_workers: int = 2, pre_encode_opus: bool = True) -> None:
+        self.bot = bot
+        self.voice_client = None
+        self.jukebox = None
+        self.analysis = None
+        self.player = None
+        # downloads+analyses in progress, by track, so concurrent /plays of the same track share one
+        self.analyses = SingleFlight()
+        self.scheduler = AnalysisScheduler(workers=analysis_workers, cache_dir=cache_dir)
+        self.downloads = DownloadCache(cache_dir / 'downloads', ytdl_options)
+        # encode each song to opus once and send the packets as they are, rather than every voice connection encoding it live
+        self.opus_packets = OpusPacketCache(volume=PLAYBACK_VOLUME) if pre_encode_opus else None
+        super().__init__()
+
+    async def cog_unload(self) -> None:
+        self.scheduler.shutdown()
+
+    def cancel_analysis(self, reason: str) -> None:
+        # only stops the work itself if nobody else is waiting on the same track
+        if self.analysis is not None:
+            self.analysis.detach(remixatron.AnalysisCancelled(reason))
+            self.analysis = None
+
+    async def download_and_analyze(self, guild_id: int, info, flight: Flight[remixatron.JukeboxAnalysis]) -> remixatron.JukeboxAnalysis:
+        flight.publish(('downloading', None))
+        filename = await ytdl_async_download_helper(self.downloads, info)
+        logger.debug('download cache: %s', self.downloads.stats)
+        # decode at discord's sample rate, so JukeboxAudioSource can play it as is
+        job = self.scheduler.submit(guild_id, filename, sample_rate=JukeboxAudioSource.SAMPLE_RATE,
+                                    deadline=time.monotonic() + ANALYSIS_TIMEOUT_SECONDS)
+        try:
+            async for event in job.events():
+                # the decoded audio is what lets someone who joins late start playing too
+                flight.publish(event, sticky=event[0] == 'decoded')
+            analysis = await job.result
+        except asyncio.CancelledError:
+            # everyone waiting on this track gave up
+            job.cancel('no longer needed')
+            raise
+        for timing in analysis.timings.values():
+            log_stage_timing(timing)
+        return analysis
+
+    @app_commands.command(name='invitelink')
+    async def cmd_invite_link(self, interaction: discord.Interaction) -> None:
+        from .util import bot_invite_link
+        client_id = interaction.client.application_id
+        assert client_id is not None
+        invite_link = bot_invite_link(client_id=client_id, permissions='2150629376')
+        await interaction.response.send_message(f'🔗 invite link: {invite_link}')
+
+    @app_commands.command(name='joinvc')
+    async def cmd_join_vc(self, interaction: discord.Interaction, channel: discord.VoiceChannel) -> None:
+        await interaction.response.defer(thinking=True)
+        if self.voice_client is not None:
+            try:
+                await self.voice_client.move_to(channel=channel)
+                await interaction.followup.send(content=f'✅ moved to channel {channel.name}')
+            except Exception as ex:
+                logger.warning('failed to move to voice channel', exc_info=ex)
+                await interaction.followup.send(content=f'❌ unable to move to channel {channel.name}')
+        else:
+            try:
+                self.voice_client = await channel.connect()
+                await interaction.followup.send(content=f'✅ connected to channel {channel.name}')
+            except Exception as ex:
+                logger.warning('failed to connect to voice channel', exc_info=ex)
+                await interaction.followup.send(content=f'❌ unable to connect to channel {channel.name}')
+
+    @app_commands.command(name='leavevc')
+    async def cmd_leave_vc(self, interaction: discord.Interaction) -> None:
+        if self.voice_client is None:
+            await interaction.response.send_message(content='❌ not connected to any voice channel')
+        else:
+            self.cancel_analysis('left the voice channel')
+            await self.voice_client.disconnect()
+            await interaction.response.send_message(content='✅ disconnected')
+
+    @app_commands.command(name='play')
+    async def cmd_play(self, interaction: discord.Interaction, url: str) -> None:
+        assert self.voice_client is not None
+        await interaction.response.send_message('looking up...')
+        info = await ytdl_async_extract_info(self.downloads, url)
+        guild_id = interaction.guild_id or 0
+        analysis = self.analyses.join(ytdl_track_key(info), lambda flight: self.download_and_analyze(guild_id, info, flight))
+        # a newer /play supersedes any analysis still running. it's only detached after joining the new one, so a /play of the track that's already being analysed carries on with it rather than cancelling it
+        self.cancel_analysis('superseded by another /play')
+        self.analysis = analysis
+        progressive: Optional[ProgressiveSource] = None
+        async for kind, event in analysis.events():
+            if kind == 'downloading':
+                await interaction.edit_original_response(content='downloading...')
+            elif kind == 'queued':
+                if event == 0:
+                    await interaction.edit_original_response(content='processing...')
+                else:
+                    await interaction.edit_original_response(content=f'queued - position {event}')
+            elif kind == 'decoded':
+                # play it straight through until the analysis is done, rather than leaving everyone waiting in silence
+                progressive = ProgressiveSource(event, volume=PLAYBACK_VOLUME)
+                self.start_playing(progressive)
+                await interaction.edit_original_response(content='playing while processing...')
+            else:
+                percent, message = event
+                playing = 'playing while ' if progressive is not None else ''
+                await interaction.edit_original_response(content=f'{playing}processing - {percent*100}% - "{message}"')
+        try:
+            jukebox = await analysis.result()
+        except SchedulerFull:
+            await interaction.edit_original_response(content='❌ too many songs are being processed right now, try again in a bit')
+            return
+        except remixatron.AnalysisCancelled as ex:
+            await interaction.edit_original_response(content=f'❌ processing stopped: {ex}')
+            return
+        except asyncio.CancelledError:
+            # the work was cancelled out from under us (rather than this command being cancelled)
+            if not analysis.flight.task.cancelled():
+                raise
+            await interaction.edit_original_response(content='❌ processing stopped')
+            return
+        finally:
+            if self.analysis is analysis:
+                self.analysis = None
+        self.jukebox = jukebox
+        await interaction.edit_original_response(embed=get_jukebox_verbose_info(self.jukebox))
+        # await interaction.channel.send(embed=get_jukebox_verbose_info(self.jukebox))
+        source = await self.jukebox_source(jukebox)
+        if progressive is not None and self.player is not None and self.player.source is progressive and self.voice_client.source is self.player:
+            # carries on from wherever the straight through playback has got to, and takes care of the volume
+            progressive.switch_to(source)
+        elif source.is_opus():
+            self.start_playing(source)
+        else:
+            self.start_playing(discord.PCMVolumeTransformer(source, volume=PLAYBACK_VOLUME))
+
+    async def jukebox_source(self, jukebox: remixatron.JukeboxAnalysis) -> Union[JukeboxAudioSource, OpusJukeboxSource]:
+        if self.opus_packets is not None:
+            try:
+                packets = await self.opus_packets.get(jukebox)
+                logger.debug('opus packets: %.1f MiB', packets.nbytes / 1024 / 1024)
+                return OpusJukeboxSource(jukebox, packets)
+            except discord.opus.OpusNotLoaded:
+                logger.warning('libopus is not loaded, encoding live instead')
+        # mixing the jump crossfades takes a moment, so do it off the event loop (and before playback starts)
+        crossfades = await asyncio.get_event_loop().run_in_executor(None, lambda: jukebox.crossfades)
+        logger.debug('crossfades: %d samples per jump, %.1f MiB', crossfades.length, crossfades.nbytes / 1024 / 1024)
+        return JukeboxAudioSource(jukebox, crossfades)
+
+    def start_playing(self, source: discord.AudioSource) -> None:
+        assert self.voice_client is not None
+        # discord only makes the voice client's encoder when play() starts with a pcm source, but the player can go from opus to pcm at any point (say the first song went straight to pre-encoded packets, and the next has to be encoded live), so make sure there is one
+        if not self.voice_client.encoder and discord.opus.is_loaded():
+            self.voice_client.encoder = discord.opus.Encoder()
+        # if something's already playing, switch it over to the new song without restarting the player. once the player's finished (or stopped), discord's done with it, and replacing its source would play nothing
+        if self.player is not None and self.voice_client.source is self.player and (self.voice_client.is_playing() or self.voice_client.is_paused()):
+            logger.info('playback stats for the last song: %s', self.player.stats)
+            self.player.replace(source)
+            return
+        if self.voice_client.is_playing():
+            self.voice_client.stop()
+        player = self.player = PrefetchSource(source)
+        def after(error: Optional[Exception]) -> None:
+            if error:
+                logger.error('player error', exc_info=error)
+            logger.info('playback stats: %s', player.stats)
+        self.voice_client.play(player, after=after)
+
+    @app_commands.command(name='stats')
+    async def cmd_stats(self, interaction: discord.Interaction) -> None:
+        if self.player is None:
+            await interaction.response.send_message(content='❌ nothing has played yet')
+            return
+        stats = self.player.stats
+        embed = (
+            discord.Embed(title='playback stats', colour=discord.Colour.og_blurple())
+                .add_field(name='frames', value=f'{stats["frames"]}', inline=True)
+                .add_field(name='underruns', value=f'{stats["underruns"]}', inline=True)
+                .add_field(name='buffered', value=f'{stats["buffered"]}/{self.player.lookahead}', inline=True)
+                .add_field(name='frame interval', value=f'{stats["mean_interval_ms"]:.2f}ms (max {stats["max_interval_ms"]:.2f}ms)', inline=True)
+                .add_field(name='jitter', value=f'{stats["jitter_ms"]:.2f}ms', inline=True)
+        )
+        await interaction.response.send_message(embed=embed)
+
+    # @app_commands.command(name='getinfo')
+
+
+
+# based on https://stackoverflow.com/a/63107461/8762161
+class CogWithOwnPrefix(commands.Cog):
+    def get_prefixes(self, bot: Union[commands.Bot, commands.AutoShardedBot], message: discord.Message) -> list[str]:
+        return []
+
+    async def cog_check(self, ctx) -> bool:
+        return super().cog_check(ctx) and ctx.prefix in self.get_prefixes(ctx.bot, ctx.message)
+
+class PingCommandCog(CogWithOwnPrefix):
+    def get_prefixes(self, bot, message) -> list[str]:
+        return super().get_prefixes(bot, message) + commands.when_mentioned(bot, message)
+
+
+# from https://gist.github.com/AbstractUmbra/a9c188797ae194e592efe05fa129c57f#sync-command-example
+class SyncMentionCog(PingCommandCog):
+    def __init__(self, bot: commands.Bot) -> None:
+        self.bot = bot
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.is_owner()
+    async def sync(self, ctx: commands.Context, guilds: commands.Greedy[discord.Guild], spec: Optional[Literal["~", "*", "^"]] = None) -> None:
+        if not guilds:
+            if spec == "~":
+                assert ctx.guild is not None
+                synced = await self.bot.tree.sync(guild=ctx.guild)
+            elif spec == "*":
+                assert ctx.guild is not None
+                self.bot.tree.copy_global_to(guild=ctx.guild)
+                synced = await ctx.bot.tree.sync(guild=ctx.guild)
+            elif spec == "^":
+                assert ctx.guild is not None
+                self.bot.tree.clear_commands(guild=ctx.guild)
+                await self.bot.tree.sync(guild=ctx.guild)
+                synced = []
+            else:
+                synced = await self.bot.tree.sync()
+            await ctx.send(
+                f"Synced {len(synced)} commands {'globally' if spec is None else 'to the current guild.'}"
+            )
+            return
+        ret = 0
+        for guild in guilds:
+            try:
+                await self.bot.tree.sync(guild=guild)
+            except discord.HTTPException:
+                pass
+            else:
+                ret += 1
+        await ctx.send(f"Synced the tree to {ret}/{len(guilds)}.")
+
+def cmd_help_text(command: commands.Command):
+    command.params
+
+class KillBotCog(PingCommandCog):
+    @commands.command()
+    @commands.is_owner()
+    async def stop(self, ctx: commands.Context, kill_mode: Optional[Literal['graceful', 'force']] = None) -> None:
+        cmd_help_text(ctx.command)
+
+def bot_command_prefix(bot: commands.Bot, message: discord.Message) -> list[str]:
+    prefixes = []
+    for cog in bot.cogs.values():
+        if isinstance(cog, CogWithOwnPrefix):
+            prefixes += cog.get_prefixes(bot, message)
+    return prefixes
+
+async def init_bot():
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.messages = True
+    intents.message_content = False
+    intents.voice_states = True
+    bot = commands.Bot(command_prefix=bot_command_prefix, intents=intents)
+    loopbot_cog = LoopBotCog(bot)
+    # start the analysis workers (and load their models) up front, so the first /play doesn't pay for it
+    loopbot_cog.scheduler.start_workers()
+    await bot.add_cog(loopbot_cog)
+    await bot.add_cog(SyncMentionCog(bot))
+    return bot
+
+
+
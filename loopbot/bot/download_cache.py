@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+import yt_dlp
+
+
+class DownloadCache:
+    """
+    a directory of downloaded media, named by extractor and id, kept under a size and age budget.
+    files are evicted least recently used first, and once they haven't been used for max_age_seconds. when a file was last used is kept in its atime, which gets bumped on every hit.
+    the mtime is left alone, since it's part of what the pcm store and analysis cache key a decoded file on (see PCMStore.key), and bumping it would make every hit decode and analyse the file all over again.
+    """
+    def __init__(self, directory: Path, ytdl_options: dict[str, Any], max_bytes: int = 2 * 1024 * 1024 * 1024, max_age_seconds: Optional[float] = 7 * 24 * 60 * 60) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # no title in the name, so the name can be worked out from just the extractor and id
+        self.ytdl = yt_dlp.YoutubeDL({**ytdl_options, 'outtmpl': str(self.directory / '%(extractor)s-%(id)s.%(ext)s')})
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def extract_info(self, url: str) -> dict[str, Any]:
+        """resolves a url (or search) to the metadata of the track it points at, without downloading anything"""
+        data = self.ytdl.extract_info(url, download=False)
+        assert data is not None
+        # take first item from playlist
+        if 'entries' in data:
+            data = data['entries'][0]
+        return data
+
+    def lookup(self, info: dict[str, Any]) -> Optional[Path]:
+        """the cached file for some metadata, if there is one"""
+        path = Path(self.ytdl.prepare_filename(info))
+        try:
+            # mark it as recently used, keeping its mtime as it was
+            os.utime(path, ns=(time.time_ns(), path.stat().st_mtime_ns))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def download(self, info: dict[str, Any]) -> Path:
+        """returns the file for some metadata, downloading it first if it isn't cached"""
+        path = self.lookup(info)
+        with self._lock:
+            if path is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if path is not None:
+            return path
+        data = self.ytdl.process_ie_result(info, download=True)
+        path = Path(self.ytdl.prepare_filename(data))
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: Optional[Path] = None) -> None:
+        """deletes files past the age budget, then the least recently used ones until the cache fits in max_bytes"""
+        now = time.time()
+        entries = []
+        for path in self.directory.iterdir():
+            # skip yt-dlp's in-progress downloads
+            if path.suffix in ('.part', '.ytdl') or path == keep:
+                continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            if self.max_age_seconds is not None and now - st.st_atime > self.max_age_seconds:
+                path.unlink(missing_ok=True)
+                continue
+            entries.append((st.st_atime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and keep.exists():
+            total += keep.stat().st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
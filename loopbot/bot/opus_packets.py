@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import threading
+from typing import Optional, Union
+
+import discord
+import librosa
+import numpy as np
+
+from loopbot import remixatron
+
+SAMPLE_RATE = discord.opus.Encoder.SAMPLING_RATE
+CHANNELS = discord.opus.Encoder.CHANNELS
+SAMPLES_PER_FRAME = discord.opus.Encoder.SAMPLES_PER_FRAME
+
+# how many frames after a jump are encoded specially, so the decoder gets from the old audio to the new smoothly
+TRANSITION_FRAMES = 2
+
+# how many samples to change the volume of at a time, to bound the float temporaries
+VOLUME_CHUNK_SAMPLES = 1024 * 1024
+
+
+def _to_pcm(audio: np.ndarray, sample_rate: int, volume: float) -> np.ndarray:
+    # the audio as 16 bit stereo at discord's sample rate, padded with silence to a whole number of frames
+    audio = audio.reshape(len(audio), -1)
+    if sample_rate != SAMPLE_RATE:
+        # (librosa resamples along the last axis)
+        audio = librosa.resample(audio.T.astype(np.float32), orig_sr=sample_rate, target_sr=SAMPLE_RATE, res_type='polyphase').T
+    frame_count = -(-len(audio) // SAMPLES_PER_FRAME)
+    pcm = np.zeros((frame_count * SAMPLES_PER_FRAME, CHANNELS), dtype=np.int16)
+    for start in range(0, len(audio), VOLUME_CHUNK_SAMPLES):
+        chunk = audio[start:start + VOLUME_CHUNK_SAMPLES].astype(np.float32)
+        chunk *= volume
+        np.clip(np.rint(chunk, out=chunk), -32768, 32767, out=chunk)
+        # (mono gets copied to both channels)
+        pcm[start:start + len(chunk)] = chunk
+    return pcm
+
+
+class OpusBeatPackets:
+    """
+    a song encoded to opus once, up front, so it can be played any number of times (by any number of guilds) without encoding anything.
+    the song is encoded straight through as 20ms frames, with each beat rounded to the nearest frame boundaries, so playing beats in order plays those frames in order.
+    that rounding moves every beat (and so every jump) by up to 10ms either way, compared to JukeboxAudioSource playing the pcm. it's well under what anyone can hear in a crossfaded jump, but it does mean the two sources don't line up sample for sample.
+    every jump (see remixatron.JumpCrossfades) also gets its own few packets, encoded from the jump's crossfade by an encoder that's just been fed the end of the beat being jumped from.
+    a song can have thousands of jumps, and only some of them ever get played, so those packets are encoded the first time each jump is, and kept in transitions.
+    """
+    frames: list[bytes]
+    transitions: dict[tuple[int, int], tuple[bytes, ...]]
+
+    def __init__(self, jukebox: Union[remixatron.InfiniteJukebox, remixatron.JukeboxAnalysis], volume: float = 1.0,
+                 fade_seconds: float = remixatron.CROSSFADE_SECONDS, bitrate: int = 128) -> None:
+        pcm = _to_pcm(jukebox.raw_audio, jukebox.sample_rate, volume)
+        frame_count = len(pcm) // SAMPLES_PER_FRAME
+
+        # each beat's first and last (exclusive) frame
+        scale = SAMPLE_RATE / jukebox.sample_rate / SAMPLES_PER_FRAME
+        self.beat_starts = np.rint(jukebox.beats.column('start_index') * scale).astype(np.int64)
+        self.beat_stops = np.minimum(np.rint(jukebox.beats.column('stop_index') * scale).astype(np.int64), frame_count)
+        self.beat_stops = np.maximum(self.beat_stops, self.beat_starts)
+
+        # the crossfades, lined up with the frames
+        data = jukebox.beats.data.copy()
+        data['start_index'] = self.beat_starts * SAMPLES_PER_FRAME
+        data['stop_index'] = self.beat_stops * SAMPLES_PER_FRAME
+        beats = remixatron.BeatTable(data, jukebox.beats.jump_offsets, jukebox.beats.jump_indices)
+        self._crossfades = remixatron.JumpCrossfades(beats, pcm, SAMPLE_RATE, fade_seconds=fade_seconds)
+
+        self.frames = self._encode(discord.opus.Encoder(), pcm.reshape(frame_count, -1), bitrate)
+
+        # the transitions are cut from the song as they're needed. at discord's rate, that's the same as cutting them from pcm, straight from the raw audio (which is memory mapped, if it came from a PCMStore), so pcm doesn't have to be kept around
+        if jukebox.sample_rate == SAMPLE_RATE:
+            self._audio, self._audio_volume = jukebox.raw_audio, volume
+        else:
+            self._audio, self._audio_volume = pcm, 1.0
+        self._bitrate = bitrate
+        # transitions are encoded on whichever thread's playing the song, so the cache is behind a lock
+        self._lock = threading.Lock()
+        self.transitions = {}
+
+    @staticmethod
+    def _encode(encoder: discord.opus.Encoder, frames: np.ndarray, bitrate: int) -> list[bytes]:
+        encoder.set_bitrate(bitrate)
+        return [encoder.encode(frame.tobytes(), SAMPLES_PER_FRAME) for frame in frames]
+
+    def _frames(self, start: int, count: int) -> np.ndarray:
+        # count frames of the song (as it is in pcm), from frame start on
+        audio = self._audio[start * SAMPLES_PER_FRAME:(start + count) * SAMPLES_PER_FRAME]
+        return _to_pcm(audio, SAMPLE_RATE, self._audio_volume)
+
+    def _encode_transition(self, source: int, target: int) -> Optional[tuple[bytes, ...]]:
+        edge = self._crossfades.edge(source, target)
+        if edge is None:
+            return None
+        start, stop = self.beat_starts[target], self.beat_stops[target]
+        count = min(TRANSITION_FRAMES, stop - start)
+        if count == 0:
+            return None
+        transition = self._frames(start, count)
+        transition[:self._crossfades.length] = self._crossfades.fades[edge]
+        # prime the encoder with the last frame before the jump, so it's in the state the listener's decoder will be in
+        primer = self._frames(max(self.beat_stops[source] - 1, 0), 1)
+        # a fresh encoder each time, so nothing carries over from the last transition (making one is cheap next to the encoding)
+        packets = self._encode(discord.opus.Encoder(), np.concatenate((primer, transition)).reshape(count + 1, -1), self._bitrate)
+        return tuple(packets[1:])
+
+    def transition(self, beat: int, target: int) -> Optional[tuple[bytes, ...]]:
+        """the packets that start a jump from beat to target, or None if it isn't one of the song's jumps"""
+        with self._lock:
+            packets = self.transitions.get((beat, target))
+            if packets is None:
+                packets = self._encode_transition(beat, target)
+                if packets is not None:
+                    self.transitions[beat, target] = packets
+            return packets
+
+    @property
+    def nbytes(self) -> int:
+        """the packets encoded so far, plus the crossfades the rest will be encoded from"""
+        return (sum(map(len, self.frames)) + sum(len(packet) for packets in list(self.transitions.values()) for packet in packets)
+                + self._crossfades.nbytes)
+
+
+class OpusPacketCache:
+    """the OpusBeatPackets of recently played songs, by file, so every guild playing a song shares one copy (and one round of encoding)"""
+    def __init__(self, max_tracks: int = 8, volume: float = 1.0) -> None:
+        self.max_tracks = max_tracks
+        self.volume = volume
+        self._tracks: collections.OrderedDict[str, asyncio.Future[OpusBeatPackets]] = collections.OrderedDict()
+
+    async def get(self, jukebox: remixatron.JukeboxAnalysis) -> OpusBeatPackets:
+        """the packets for a song, encoding it (off the event loop) if it isn't cached. raises discord.opus.OpusNotLoaded if there's no libopus"""
+        key = jukebox.filename
+        future = self._tracks.get(key)
+        if future is None:
+            future = self._tracks[key] = asyncio.get_event_loop().run_in_executor(None, OpusBeatPackets, jukebox, self.volume)
+            # anything still playing an evicted song keeps its own reference to the packets
+            while len(self._tracks) > self.max_tracks:
+                self._tracks.popitem(last=False)
+        else:
+            self._tracks.move_to_end(key)
+        try:
+            # shielded, so one caller giving up doesn't cancel the encoding for the rest
+            return await asyncio.shield(future)
+        except Exception:
+            if self._tracks.get(key) is future:
+                del self._tracks[key]
+            raise
@@ -0,0 +1,168 @@
+import collections
+import math
+import threading
+import time
+from typing import Optional
+
+import discord
+
+FRAME_BYTES = discord.opus.Encoder.FRAME_SIZE
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+# what to play when the buffer's run dry: 20ms of silence, as pcm or as an opus packet
+PCM_SILENCE = bytes(FRAME_BYTES)
+OPUS_SILENCE = b'\xf8\xff\xfe'
+
+
+class PrefetchSource(discord.AudioSource):
+    """
+    wraps another AudioSource, reading its frames ahead of time on a thread of its own and handing them out of a bounded buffer.
+    discord's player thread needs a frame every 20ms, so a hiccup in the wrapped source (walking the play path, a gc pause, ...) turns into a gap in the audio. with the buffer in between, it only does if the hiccup's longer than the buffer.
+    the buffer holds up to lookahead frames, and is topped back up to that whenever it drops below low_water. if it's empty when a frame's needed, that's an underrun, and a frame of silence gets played instead.
+    frames can be pcm or opus, and can change from one to the other partway through (discord checks is_opus() after every read()).
+    """
+    def __init__(self, source: discord.AudioSource, lookahead: int = 50, low_water: Optional[int] = None) -> None:
+        if lookahead < 1:
+            raise ValueError(f'lookahead must be at least 1, not {lookahead}')
+        self.lookahead = lookahead
+        self.low_water = lookahead // 2 if low_water is None else low_water
+        self._source = source
+        # whether the last frame read() returned was opus
+        self._opus = source.is_opus()
+        self._frames = collections.deque[tuple[bytes, bool]]()
+        self._cond = threading.Condition()
+        # bumped whenever the buffer's thrown away, so frames read from an old source don't end up in the new buffer
+        self._generation = 0
+        self._finished = False
+        self._error: Optional[Exception] = None
+        self._closed = False
+        # sources that have been replaced, for the producer to clean up (it might be in the middle of reading one)
+        self._retired: list[discord.AudioSource] = []
+        # playback health
+        self.frames = 0
+        self.underruns = 0
+        self.refills = 0
+        self._last_read: Optional[float] = None
+        self._intervals = 0
+        self._interval_mean = 0.0
+        self._interval_m2 = 0.0
+        self._interval_max = 0.0
+        self._thread = threading.Thread(target=self._produce, name='prefetch', daemon=True)
+        self._thread.start()
+
+    def _produce(self) -> None:
+        while True:
+            with self._cond:
+                # sleep until the buffer's drained down to the low water mark
+                self._cond.wait_for(lambda: self._closed or self._retired or (not self._finished and len(self._frames) <= self.low_water))
+                if self._closed:
+                    break
+                retired, self._retired = self._retired, []
+                source, generation = self._source, self._generation
+                if not retired:
+                    self.refills += 1
+            for old in retired:
+                old.cleanup()
+            if retired:
+                continue
+            # fill it back up, reading outside the lock so read() never waits on the source
+            while True:
+                try:
+                    frame = source.read()
+                except Exception as ex:
+                    # read() passes it on to discord once the buffer's played out
+                    with self._cond:
+                        if generation == self._generation:
+                            self._error = ex
+                            self._finished = True
+                    break
+                with self._cond:
+                    if self._closed or generation != self._generation:
+                        break
+                    if not frame:
+                        self._finished = True
+                        break
+                    self._frames.append((frame, source.is_opus()))
+                    if len(self._frames) >= self.lookahead:
+                        break
+        for old in self._retired:
+            old.cleanup()
+        self._source.cleanup()
+
+    def read(self) -> bytes:
+        now = time.perf_counter()
+        if self._last_read is not None:
+            self._record_interval(now - self._last_read)
+        self._last_read = now
+        with self._cond:
+            if self._frames:
+                frame, self._opus = self._frames.popleft()
+            elif self._finished:
+                if self._error is not None:
+                    raise self._error
+                return b''
+            else:
+                self.underruns += 1
+                frame = OPUS_SILENCE if self._opus else PCM_SILENCE
+            if len(self._frames) <= self.low_water:
+                self._cond.notify()
+        self.frames += 1
+        return frame
+
+    def _record_interval(self, interval: float) -> None:
+        # welford's running mean and variance, so the stats take no memory however long it plays
+        self._intervals += 1
+        delta = interval - self._interval_mean
+        self._interval_mean += delta / self._intervals
+        self._interval_m2 += delta * (interval - self._interval_mean)
+        self._interval_max = max(self._interval_max, interval)
+
+    def replace(self, source: discord.AudioSource) -> None:
+        """switches to playing another source (e.g. after a seek or skip), throwing away whatever was buffered from the old one"""
+        with self._cond:
+            self._retired.append(self._source)
+            self._source = source
+            self.invalidate()
+
+    def invalidate(self) -> None:
+        """throws away the buffered frames, so the next ones come fresh from the source"""
+        with self._cond:
+            self._generation += 1
+            self._frames.clear()
+            self._finished = False
+            self._error = None
+            self._cond.notify()
+
+    @property
+    def source(self) -> discord.AudioSource:
+        return self._source
+
+    @property
+    def buffered(self) -> int:
+        return len(self._frames)
+
+    @property
+    def stats(self) -> dict[str, float]:
+        """playback health: underruns are frames of silence played because the buffer was empty, and jitter is how far the time between reads strays from 20ms"""
+        stdev = math.sqrt(self._interval_m2 / self._intervals) if self._intervals else 0.0
+        return {
+            'frames': self.frames,
+            'underruns': self.underruns,
+            'refills': self.refills,
+            'buffered': self.buffered,
+            'mean_interval_ms': self._interval_mean * 1000,
+            'max_interval_ms': self._interval_max * 1000,
+            'jitter_ms': stdev * 1000,
+            'max_late_ms': max(self._interval_max - FRAME_SECONDS, 0.0) * 1000,
+        }
+
+    def is_opus(self) -> bool:
+        return self._opus
+
+    def cleanup(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        # the producer cleans up the sources on its way out
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
@@ -0,0 +1,224 @@
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import threading
+from pathlib import Path
+from typing import Any, AsyncGenerator, NamedTuple, Optional
+
+import numpy as np
+
+from loopbot import remixatron
+from loopbot.analysis_cache import AnalysisCache
+from loopbot.pcm_store import PCMStore
+
+
+class SchedulerFull(Exception):
+    """raised by AnalysisScheduler.submit when there's no room left in the queue"""
+
+
+class DecodedTrack(NamedTuple):
+    """a song that's been decoded but not analysed yet: enough to play it straight through"""
+    filename: str
+    raw_audio: np.ndarray
+    sample_rate: int
+    duration: float
+
+
+# per-process state of the analysis workers, set up by _init_worker
+_worker_caches: dict = {}
+# (job id, kind, payload) events for the scheduler, see AnalysisJob.events
+_worker_progress = None
+
+def _init_worker(cache_dir: Path, progress_queue) -> None:
+    global _worker_progress
+    _worker_caches['analysis_cache'] = AnalysisCache(cache_dir / 'analysis')
+    _worker_caches['pcm_store'] = PCMStore(cache_dir / 'pcm')
+    _worker_progress = progress_queue
+    # load the downbeat models once per worker, not once per song
+    remixatron.warm_up()
+
+def _noop() -> None:
+    pass
+
+def _analyze(job_id: int, filename: str, jukebox_kwargs: dict) -> remixatron.JukeboxAnalysis:
+    def on_progress(percentage: float, message: str) -> None:
+        _worker_progress.put((job_id, 'progress', (percentage, message)))
+    def on_decoded(jukebox: remixatron.InfiniteJukebox) -> None:
+        # only the path to the pcm store's copy gets sent, the scheduler maps it again on its end
+        pcm_path = getattr(jukebox.raw_audio, 'filename', None)
+        if pcm_path is not None:
+            _worker_progress.put((job_id, 'decoded', (pcm_path, jukebox.sample_rate, jukebox.duration)))
+    jukebox = remixatron.InfiniteJukebox(filename=filename, progress_callback=on_progress, decoded_callback=on_decoded,
+                                         do_async=False, **_worker_caches, **jukebox_kwargs)
+    # the analysis keeps only a path to the (memory mapped) audio, so sending it back is cheap
+    return jukebox.to_analysis()
+
+
+class AnalysisJob:
+    """a song waiting for, or being, analysed. position is its place in the queue (1 = next up), or 0 once it's running"""
+    guild_id: int
+    filename: str
+    position: Optional[int]
+    result: 'asyncio.Future[remixatron.JukeboxAnalysis]'
+
+    def __init__(self, job_id: int, guild_id: int, filename: str, token: remixatron.CancellationToken, jukebox_kwargs: dict) -> None:
+        self.job_id = job_id
+        self.guild_id = guild_id
+        self.filename = filename
+        self.token = token
+        self.jukebox_kwargs = jukebox_kwargs
+        self.position = None
+        self.result = asyncio.get_running_loop().create_future()
+        self._events = asyncio.Queue[tuple[str, Any]]()
+
+    def cancel(self, reason: str = 'cancelled') -> None:
+        self.token.cancel(reason)
+        if not self.result.done() and self.position != 0:
+            # hasn't started yet, so there's nothing to stop
+            self.result.set_exception(remixatron.AnalysisCancelled(reason))
+
+    async def events(self) -> AsyncGenerator[tuple[str, Any], None]:
+        """
+        yields ('queued', position) whenever the job's place in the queue changes, and ('progress', (percentage, message)) once it's running, until the job is done.
+        if the song gets decoded into the pcm store, there's also a ('decoded', DecodedTrack) as soon as it is, so it can start playing before the analysis is done.
+        """
+        while True:
+            next_event = asyncio.ensure_future(self._events.get())
+            done, _ = await asyncio.wait([next_event, self.result], return_when=asyncio.FIRST_COMPLETED)
+            if next_event not in done:
+                next_event.cancel()
+                # the worker can send events right before it finishes (e.g. 'decoded', for a song that's quick to analyse), so hand out whatever's still queued
+                while not self._events.empty():
+                    yield self._events.get_nowait()
+                return
+            yield next_event.result()
+
+
+class AnalysisScheduler:
+    """
+    runs song analysis on a pool of worker processes, a bounded number of songs at a time.
+    queued songs are started round robin between guilds, so one busy guild can't starve the others.
+    """
+    def __init__(self, workers: int = 2, max_queued: int = 16, max_queued_per_guild: int = 2, cache_dir: Path = Path('cache')) -> None:
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_queued_per_guild = max_queued_per_guild
+        # spawn rather than fork, since forking a process that's running an event loop and threads is asking for trouble
+        ctx = multiprocessing.get_context('spawn')
+        self._manager = ctx.Manager()
+        self._progress = self._manager.Queue()
+        self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                                            initializer=_init_worker, initargs=(cache_dir, self._progress))
+        self._queues: collections.OrderedDict[int, collections.deque[AnalysisJob]] = collections.OrderedDict()
+        self._running: dict[int, AnalysisJob] = {}
+        self._job_ids = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._progress_thread: Optional[threading.Thread] = None
+
+    def start_workers(self) -> None:
+        """starts every worker process now (they load their models as they start) rather than on the first few submits"""
+        for _ in range(self.workers):
+            self._pool.submit(_noop)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def submit(self, guild_id: int, filename: str, **jukebox_kwargs) -> AnalysisJob:
+        """queues a song for analysis. raises SchedulerFull if the queue (or this guild's share of it) is full"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._progress_thread = threading.Thread(target=self._forward_progress, daemon=True)
+            self._progress_thread.start()
+        queue = self._queues.setdefault(guild_id, collections.deque())
+        if self.queued >= self.max_queued or len(queue) >= self.max_queued_per_guild:
+            raise SchedulerFull()
+        token = remixatron.CancellationToken(self._manager.Event())
+        job = AnalysisJob(next(self._job_ids), guild_id, filename, token, jukebox_kwargs)
+        job.result.add_done_callback(lambda _: self._on_done(job))
+        queue.append(job)
+        self._pump()
+        return job
+
+    def _on_done(self, job: AnalysisJob) -> None:
+        # covers both finished jobs and ones cancelled while still queued
+        self._running.pop(job.job_id, None)
+        queue = self._queues.get(job.guild_id)
+        if queue is not None and job in queue:
+            queue.remove(job)
+        self._pump()
+
+    def _pump(self) -> None:
+        # start queued jobs while there are free workers, taking one from each guild in turn
+        while len(self._running) < self.workers and self._queues:
+            guild_id, queue = next(iter(self._queues.items()))
+            self._queues.move_to_end(guild_id)
+            if not queue:
+                del self._queues[guild_id]
+                continue
+            self._start(queue.popleft())
+        self._update_positions()
+
+    def _start(self, job: AnalysisJob) -> None:
+        assert self._loop is not None
+        self._running[job.job_id] = job
+        self._set_position(job, 0)
+        future = self._loop.run_in_executor(self._pool, _analyze, job.job_id, job.filename,
+                                            dict(job.jukebox_kwargs, cancel_token=job.token))
+        def on_finished(future: asyncio.Future) -> None:
+            if job.result.done():
+                return
+            if future.cancelled():
+                job.result.set_exception(remixatron.AnalysisCancelled('shutting down'))
+            elif future.exception() is not None:
+                job.result.set_exception(future.exception())
+            else:
+                job.result.set_result(future.result())
+        future.add_done_callback(on_finished)
+
+    def _update_positions(self) -> None:
+        # the order the queued jobs will start in, if nothing else gets queued
+        order = itertools.chain.from_iterable(itertools.zip_longest(*self._queues.values()))
+        for position, job in enumerate((job for job in order if job is not None), start=1):
+            self._set_position(job, position)
+
+    def _set_position(self, job: AnalysisJob, position: int) -> None:
+        if job.position != position:
+            job.position = position
+            job._events.put_nowait(('queued', position))
+
+    def _forward_progress(self) -> None:
+        # runs on its own thread, moving progress from the workers onto the event loop
+        assert self._loop is not None
+        while True:
+            item = self._progress.get()
+            if item is None:
+                return
+            self._loop.call_soon_threadsafe(self._on_progress, *item)
+
+    def _on_progress(self, job_id: int, kind: str, payload: Any) -> None:
+        job = self._running.get(job_id)
+        if job is None:
+            return
+        if kind == 'decoded':
+            pcm_path, sample_rate, duration = payload
+            try:
+                raw_audio = np.load(pcm_path, mmap_mode='r', allow_pickle=False)
+            except FileNotFoundError:
+                # evicted from the pcm store already, so it'll have to wait for the analysis (which decodes it again if need be)
+                return
+            payload = DecodedTrack(job.filename, raw_audio, sample_rate, duration)
+        job._events.put_nowait((kind, payload))
+
+    def shutdown(self) -> None:
+        for queue in self._queues.values():
+            for job in list(queue):
+                job.cancel('shutting down')
+        for job in list(self._running.values()):
+            job.cancel('shutting down')
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._progress_thread is not None:
+            self._progress.put(None)
+        self._manager.shutdown()
@@ -0,0 +1,118 @@
+import asyncio
+from typing import Any, AsyncGenerator, Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class Flight(Generic[T]):
+    """
+    one running piece of work that any number of callers can be attached to.
+    the work publishes events (e.g. progress) through publish(), and every attached caller gets all of them.
+    """
+    key: Hashable
+    task: 'asyncio.Task[T]'
+
+    def __init__(self, key: Hashable) -> None:
+        self.key = key
+        self._subscriptions: set['Subscription[T]'] = set()
+        self._last_event: Optional[Any] = None
+        self._sticky_events: list[Any] = []
+        # set once everyone's detached and the work's been told to stop. it can take a while to actually stop, and nobody new should attach in the meantime
+        self.cancelled = False
+
+    def publish(self, event: Any, sticky: bool = False) -> None:
+        """sends an event to every attached caller. late joiners only get the latest event, plus any sticky ones (for things they can't do without, like a partial result)"""
+        if sticky:
+            self._sticky_events.append(event)
+        else:
+            self._last_event = event
+        for subscription in self._subscriptions:
+            subscription._events.put_nowait(event)
+
+    def attach(self) -> 'Subscription[T]':
+        subscription = Subscription(self)
+        # late joiners start from wherever the work has got to
+        for event in self._sticky_events:
+            subscription._events.put_nowait(event)
+        if self._last_event is not None:
+            subscription._events.put_nowait(self._last_event)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def _detach(self, subscription: 'Subscription[T]') -> None:
+        self._subscriptions.discard(subscription)
+        # nobody's waiting on the work any more, so stop it
+        if not self._subscriptions and not self.task.done():
+            self.cancelled = True
+            self.task.cancel()
+
+    @property
+    def attached(self) -> int:
+        return len(self._subscriptions)
+
+
+class Subscription(Generic[T]):
+    """one caller's view of a Flight: its own copy of the event stream, and the shared result"""
+    flight: Flight[T]
+
+    def __init__(self, flight: Flight[T]) -> None:
+        self.flight = flight
+        self._events = asyncio.Queue[Any]()
+        self._detached = asyncio.get_running_loop().create_future()
+
+    async def events(self) -> AsyncGenerator[Any, None]:
+        """yields the flight's events until the work finishes or this subscription is detached"""
+        while True:
+            next_event = asyncio.ensure_future(self._events.get())
+            done, _ = await asyncio.wait([next_event, self.flight.task, self._detached], return_when=asyncio.FIRST_COMPLETED)
+            if next_event not in done:
+                next_event.cancel()
+                # events published just before the work finished are still queued, and might be ones the caller can't do without (like a sticky one). once detached though, nobody wants them
+                if not self._detached.done():
+                    while not self._events.empty():
+                        yield self._events.get_nowait()
+                return
+            yield next_event.result()
+
+    async def result(self) -> T:
+        """the result of the work, or raises the exception passed to detach() if this subscription was detached first"""
+        await asyncio.wait([self.flight.task, self._detached], return_when=asyncio.FIRST_COMPLETED)
+        if self._detached.done():
+            return self._detached.result()
+        return self.flight.task.result()
+
+    def detach(self, exception: BaseException) -> None:
+        """stop waiting on the work. result() raises exception from now on; the work itself is cancelled if this was the last subscription"""
+        if not self._detached.done():
+            self._detached.set_exception(exception)
+            # it's fine if nobody ever awaits result() after this
+            self._detached.exception()
+        self.flight._detach(self)
+
+
+class SingleFlight(Generic[T]):
+    """runs at most one piece of work per key at a time. callers asking for a key that's already running attach to it instead of starting it again"""
+    def __init__(self) -> None:
+        self._flights: dict[Hashable, Flight[T]] = {}
+
+    def join(self, key: Hashable, start: Callable[[Flight[T]], Awaitable[T]]) -> Subscription[T]:
+        """attaches to the work for key, calling start(flight) to begin it if it isn't already running (or is finishing, or on its way out after being cancelled)"""
+        flight = self._flights.get(key)
+        if flight is None or flight.cancelled or flight.task.done():
+            flight = self._flights[key] = Flight(key)
+            flight.task = asyncio.ensure_future(start(flight))
+            flight.task.add_done_callback(lambda _: self._forget(flight))
+        return flight.attach()
+
+    def _forget(self, flight: Flight[T]) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        # retrieve the exception so asyncio doesn't complain about it never being retrieved, the subscribers get it from result()
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    def __len__(self) -> int:
+        return len(self._flights)
@@ -0,0 +1,238 @@
+""" Streams audio files into numpy arrays with ffmpeg.
+
+ffmpeg decodes, resamples and interleaves the audio itself and writes raw
+16 bit PCM to a pipe. decode_audio() reads that straight into a buffer sized
+from the file's duration, and fills in the mono signal the analysis needs as
+each chunk arrives -- so there's never a float copy of the whole stereo track,
+and progress can be reported as the bytes come in. The PCM buffer can be
+supplied by the caller (e.g. a memory map in a PCMStore, see
+PCMStore.track_writer), so that it never has to be in RAM at all.
+
+If ffmpeg isn't on the PATH, it falls back to librosa (which is slower, and
+takes about twice the memory) with the same results.
+
+  Example:
+
+      audio = decode_audio('some_file.mp3', progress_callback=print)
+      audio.pcm           # int16, shaped (frames, 2)
+      audio.mono          # float32, shaped (frames,)
+      audio.digest        # a hash of audio.pcm, e.g. for AnalysisCache.key
+
+"""
+
+import collections
+import hashlib
+import shutil
+import subprocess
+import threading
+import typing
+
+import numpy as np
+
+FFMPEG = 'ffmpeg'
+FFPROBE = 'ffprobe'
+
+# how much to read from ffmpeg at a time
+
+CHUNK_BYTES = 1024 * 1024
+
+# how many of ffmpeg's last lines of errors to keep, for the exception if it fails.
+# A damaged file can make it log an error for every frame, so the rest are dropped.
+
+STDERR_TAIL_LINES = 20
+
+class DecodedAudio(typing.NamedTuple):
+
+    """ The decoded samples of a file.
+
+        pcm: int16 samples shaped (frames, channels), for playback
+       mono: the channels averaged together as float32 in [-1, 1], for analysis
+ sample_rate: the sample rate of both
+     digest: the pcm_digest() of pcm, worked out as it was decoded
+    """
+
+    pcm: np.ndarray
+    mono: np.ndarray
+    sample_rate: int
+    digest: str
+
+def pcm_hasher():
+
+    """ The hash DecodedAudio.digest is made with: feed it the bytes of the int16
+        samples, in order, and take its hexdigest(). """
+
+    return hashlib.blake2b(digest_size=20)
+
+def pcm_digest(pcm):
+
+    """ Returns the digest of some samples, the same as decode_audio() would have
+        given them. Hashing a whole track takes a while, so use DecodedAudio.digest
+        instead when there is one. """
+
+    h = pcm_hasher()
+    h.update(memoryview(np.ascontiguousarray(pcm)).cast('B'))
+
+    return h.hexdigest()
+
+def probe_duration(filename):
+
+    """ Returns the duration of a file in seconds according to ffprobe, or None if
+        it couldn't tell. """
+
+    try:
+        out = subprocess.run([FFPROBE, '-v', 'error', '-show_entries', 'format=duration',
+                              '-of', 'default=noprint_wrappers=1:nokey=1', filename],
+                             capture_output=True, check=True, text=True).stdout
+        return float(out.strip())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+def _allocate_in_memory(channels):
+
+    """ The default allocate for decode_audio(): plain arrays, copied when they grow. """
+
+    pcm = np.empty((0, channels), dtype=np.int16)
+
+    def allocate(frames):
+        nonlocal pcm
+        grown = np.empty((frames, channels), dtype=np.int16)
+        grown[:len(pcm)] = pcm
+        pcm = grown
+        return pcm
+
+    return allocate
+
+def decode_audio(filename, sample_rate=44100, channels=2, progress_callback=None, allocate=None):
+
+    """ Decodes a file to int16 PCM plus a float32 mono mixdown.
+
+        Args:
+
+                 filename: the file to decode
+              sample_rate: the sample rate to resample to
+                 channels: the number of channels to up or down mix to
+        progress_callback: if set, called with the fraction (0.0 to 1.0) of the file
+                           decoded so far, after every chunk
+                 allocate: if set, called with a number of frames to get the int16
+                           array, shaped (frames, channels), to decode into. It's
+                           called again if the file turns out to be longer than it
+                           said, and has to keep what's been written so far. The
+                           returned pcm is the start of the last array it returned.
+    """
+
+    if allocate is None:
+        allocate = _allocate_in_memory(channels)
+
+    if shutil.which(FFMPEG) is None:
+        return _decode_with_librosa(filename, sample_rate, channels, allocate)
+
+    frame_bytes = 2 * channels
+
+    # size the buffers from the duration, with a second to spare. If the file
+    # turns out to be longer than it said, they grow.
+
+    duration = probe_duration(filename)
+
+    if duration:
+        capacity = int(duration * sample_rate) + sample_rate
+    else:
+        capacity = 5 * 60 * sample_rate
+
+    expected_bytes = capacity * frame_bytes
+
+    pcm = allocate(capacity)
+    mono = np.empty(capacity, dtype=np.float32)
+
+    proc = subprocess.Popen([FFMPEG, '-nostdin', '-v', 'error', '-i', filename,
+                             '-f', 's16le', '-acodec', 'pcm_s16le',
+                             '-ac', str(channels), '-ar', str(sample_rate), '-'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # ffmpeg blocks once the stderr pipe's full, and we'd block waiting on stdout, so
+    # stderr gets drained as it's written, on a thread of its own
+
+    stderr = collections.deque(maxlen=STDERR_TAIL_LINES)
+
+    drain = threading.Thread(target=lambda: stderr.extend(proc.stderr), name='ffmpeg-stderr', daemon=True)
+    drain.start()
+
+    nbytes = 0
+    frames = 0
+
+    # the samples get hashed as they come in, so nothing has to read through them
+    # all again to tell whether it's seen this audio before
+
+    digest = pcm_hasher()
+
+    try:
+        while True:
+            if nbytes + CHUNK_BYTES > len(pcm) * frame_bytes:
+                capacity = len(pcm) + max(len(pcm) // 2, CHUNK_BYTES // frame_bytes)
+
+                pcm = allocate(capacity)
+
+                grown = np.empty(capacity, dtype=np.float32)
+                grown[:frames] = mono[:frames]
+                mono = grown
+
+            view = memoryview(pcm).cast('B')
+
+            n = proc.stdout.readinto(view[nbytes:nbytes + CHUNK_BYTES])
+
+            if not n:
+                break
+
+            nbytes += n
+
+            # mix down every frame that's now complete
+
+            done = nbytes // frame_bytes
+
+            np.mean(pcm[frames:done], axis=1, dtype=np.float32, out=mono[frames:done])
+            mono[frames:done] /= np.iinfo(np.int16).max
+
+            digest.update(view[frames * frame_bytes:done * frame_bytes])
+
+            frames = done
+
+            if progress_callback:
+                progress_callback(min(1.0, nbytes / expected_bytes))
+
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        drain.join()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if proc.returncode != 0:
+        message = b''.join(stderr).decode(errors='replace').strip()
+        raise RuntimeError('ffmpeg failed to decode {}: {}'.format(filename, message))
+
+    if progress_callback:
+        progress_callback(1.0)
+
+    return DecodedAudio(pcm=pcm[:frames], mono=mono[:frames], sample_rate=sample_rate, digest=digest.hexdigest())
+
+def _decode_with_librosa(filename, sample_rate, channels, allocate):
+
+    """ decode_audio() for when there's no ffmpeg. """
+
+    import librosa
+
+    y, sr = librosa.core.load(filename, mono=False, sr=sample_rate)
+
+    if y.ndim == 1 or y.shape[0] != channels:
+        y = np.tile(librosa.core.to_mono(y), (channels, 1))
+
+    pcm = allocate(y.shape[1])
+    pcm[...] = (y * np.iinfo(np.int16).max).T
+
+    del y
+
+    mono = pcm.mean(axis=1, dtype=np.float32)
+    mono /= np.iinfo(np.int16).max
+
+    return DecodedAudio(pcm=pcm, mono=mono, sample_rate=sr, digest=pcm_digest(pcm))
@@ -0,0 +1,163 @@
+""" Per-stage timing and memory instrumentation for the jukebox.
+
+A StageTimer records, for each named stage of some work, its wall time, the
+CPU time the process used during it and (optionally) the peak memory it
+allocated. The stages are run back to back: starting one stops the last.
+Whatever stops a stage -- including an exception, if it's run with stage() or
+followed by a stop() in a finally -- still records it.
+
+  Example:
+
+      timer = StageTimer(hook=lambda t: statsd.timing('jukebox.' + t.stage, t.wall_seconds))
+
+      try:
+          timer.start('decode')
+          ...
+          timer.start('analysis')
+          ...
+      finally:
+          timer.stop()
+
+      with timer.stage('crossfades'):
+          ...
+
+      print(format_timings(timer.timings))
+
+"""
+
+import contextlib
+import threading
+import time
+import tracemalloc
+import typing
+
+class StageTiming(typing.NamedTuple):
+
+    """ How long one stage took, and how much it cost.
+
+           stage: the name of the stage
+    wall_seconds: the elapsed time
+     cpu_seconds: the CPU time of the whole process over the stage. Includes other
+                  threads, so it's only meaningful when nothing else is running --
+                  and it doesn't include worker processes.
+      peak_bytes: the most memory allocated at once during the stage, over what
+                  was allocated when it started. None unless memory is tracked.
+    """
+
+    stage: str
+    wall_seconds: float
+    cpu_seconds: float
+    peak_bytes: typing.Optional[int]
+
+class StageTimer(object):
+
+    """ Times consecutive stages, keeps the results in timings (a dict of stage
+        name to StageTiming, in the order they ran) and passes each one to hook. """
+
+    def __init__(self, hook=None, track_memory=False):
+
+        """ Args:
+
+                    hook: a function called with the StageTiming of each stage as soon
+                          as it finishes, e.g. to forward it to a metrics system.
+            track_memory: set to True to measure the peak memory of each stage. This
+                          turns on tracemalloc, which slows everything down a bit.
+                          tracemalloc is process wide, so the peaks of stages that run
+                          at the same time in different threads get mixed together.
+                          If the timer turns it on, it turns it off again after each
+                          stage.
+        """
+
+        self.hook = hook
+        self.track_memory = track_memory
+        self.timings = {}
+
+        self.__lock = threading.Lock()
+        self.__current = None
+        self.__started_tracemalloc = False
+
+    def start(self, stage):
+
+        """ Starts timing a stage, stopping the current one (if any) first. """
+
+        self.stop()
+
+        memory = None
+
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.__started_tracemalloc = True
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+
+        with self.__lock:
+            self.__current = (stage, time.perf_counter(), time.process_time(), memory)
+
+    def stop(self):
+
+        """ Stops timing the current stage and records it. Returns its StageTiming,
+            or None if no stage was running. """
+
+        with self.__lock:
+            current, self.__current = self.__current, None
+
+        if current is None:
+            return None
+
+        stage, wall, cpu, memory = current
+
+        peak_bytes = None
+
+        if memory is not None and tracemalloc.is_tracing():
+            peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - memory)
+
+        if self.__started_tracemalloc:
+            self.__started_tracemalloc = False
+            tracemalloc.stop()
+
+        timing = StageTiming(stage=stage,
+                             wall_seconds=time.perf_counter() - wall,
+                             cpu_seconds=time.process_time() - cpu,
+                             peak_bytes=peak_bytes)
+
+        self.timings[stage] = timing
+
+        if self.hook:
+            self.hook(timing)
+
+        return timing
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+
+        """ A context manager that times a stage for as long as the block runs, and
+            records it however the block exits. """
+
+        self.start(stage)
+
+        try:
+            yield
+        finally:
+            self.stop()
+
+def format_timings(timings):
+
+    """ Formats a dict of StageTimings as a table, with a total at the bottom. """
+
+    lines = ["{:<16} {:>10} {:>10} {:>12}".format('Stage', 'Wall (s)', 'CPU (s)', 'Peak (MB)')]
+
+    def mb(peak_bytes):
+        return '-' if peak_bytes is None else '{:.1f}'.format(peak_bytes / (1024 * 1024))
+
+    for t in timings.values():
+        lines.append("{:<16} {:>10.3f} {:>10.3f} {:>12}".format(t.stage, t.wall_seconds, t.cpu_seconds, mb(t.peak_bytes)))
+
+    peaks = [t.peak_bytes for t in timings.values() if t.peak_bytes is not None]
+
+    lines.append("{:<16} {:>10.3f} {:>10.3f} {:>12}".format('total',
+                                                             sum(t.wall_seconds for t in timings.values()),
+                                                             sum(t.cpu_seconds for t in timings.values()),
+                                                             mb(max(peaks)) if peaks else '-'))
+
+    return "\n".join(lines)
@@ -0,0 +1,347 @@
+""" A disk-backed store of decoded audio, for sharing it between jukeboxes.
+
+Decoded PCM is big -- about 10MB a minute for 16 bit stereo at 44.1kHz -- and
+a jukebox holds on to all of it for as long as it's playing. The store writes
+it to disk once per track as a .npy file and hands out read-only memory maps
+of it instead. Those only take RAM for the pages that are actually being
+played, and every jukebox playing the same track shares the same pages of the
+OS's page cache.
+
+Entries are keyed on the source file's path, size and modification time plus
+the decode settings, so a re-downloaded file gets decoded again. The directory
+is kept under a byte budget by evicting the least recently used entries (but
+never the one that was just written). Evicting a file that's still mapped is
+fine: the OS keeps it around until the last map of it goes away. Entries used in
+the last grace_seconds aren't evicted either, so that one process can hand the
+path of an entry to another (as the bot's analysis workers do) without it
+disappearing before the other end maps it.
+
+A track can be decoded straight into the store with track_writer(), without
+ever holding all of it in RAM, even though its exact length isn't known until
+the decoder's done.
+
+  Example:
+
+      store = PCMStore('~/.cache/loopbot/pcm', max_bytes=4 * 1024 * 1024 * 1024)
+      jukebox = InfiniteJukebox('some_file.mp3', pcm_store=store)
+
+      with store.track_writer(key, channels=2) as track:
+          decoded = decode_audio('some_file.mp3', allocate=track.allocate)
+          track.truncate(len(decoded.pcm))
+      track.samples       # the stored copy, as a read-only memory map
+
+Each entry can also carry the decode.pcm_digest() of its samples (which
+decode_audio() works out as it goes), so the analysis cache can key on the
+audio without reading through all of it every time -- see digest().
+
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+_SUFFIX = '.npy'
+_DIGEST_SUFFIX = '.digest'
+
+# the room left for the .npy header at the start of a track_writer() file. The
+# header's only written once the length is known, so it needs space for the
+# longest shape there could be -- it's padded out to exactly this with spaces.
+
+_HEADER_BYTES = 128
+
+def _npy_header(dtype, shape):
+
+    """ A version 1.0 .npy header for a C ordered array, padded to _HEADER_BYTES. """
+
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                   'fortran_order': False,
+                   'shape': tuple(shape)}).encode('latin1')
+
+    # the magic string, then the header's length, then the header itself -- which
+    # has to end in a newline
+
+    prefix = np.lib.format.magic(1, 0)
+    length = _HEADER_BYTES - len(prefix) - 2
+
+    if len(header) + 1 > length:
+        raise ValueError('shape {} is too long for the header'.format(shape))
+
+    return prefix + struct.pack('<H', length) + header.ljust(length - 1) + b'\n'
+
+class TrackWriter(object):
+
+    """ A store entry being written whose length isn't known up front. See
+        PCMStore.track_writer(). """
+
+    def __init__(self, path, channels, dtype):
+        self.path = path
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.frames = 0
+        self.samples = None
+
+        # set this to the samples' decode.pcm_digest() to store it with them
+        self.digest = None
+
+    def allocate(self, frames):
+
+        """ Returns a writable memory map of frames frames to write into, keeping
+            whatever was written to the last one. Growing it just grows the file, so
+            nothing is copied. Matches decode_audio()'s allocate argument.
+        """
+
+        self.frames = frames
+
+        return np.memmap(self.path, dtype=self.dtype, mode='r+', offset=_HEADER_BYTES,
+                         shape=(frames, self.channels))
+
+    def truncate(self, frames):
+
+        """ Keeps just the first frames frames of what's been written. """
+
+        if frames > self.frames:
+            raise ValueError('only {} frames were allocated, not {}'.format(self.frames, frames))
+
+        self.frames = frames
+
+    def _finish(self):
+
+        """ Cuts the file down to size and writes its header. """
+
+        with open(self.path, 'r+b') as f:
+            f.write(_npy_header(self.dtype, (self.frames, self.channels)))
+            f.truncate(_HEADER_BYTES + self.frames * self.channels * self.dtype.itemsize)
+
+class PCMStore(object):
+
+    """ A directory of decoded tracks, bounded to max_bytes on disk. """
+
+    def __init__(self, directory, max_bytes=4 * 1024 * 1024 * 1024, grace_seconds=30 * 60):
+
+        """ Args:
+
+                directory: where to keep the decoded tracks. Created if it doesn't exist.
+                max_bytes: the most disk space the tracks may take. Once a new track
+                           goes over it, the least recently used ones get evicted.
+            grace_seconds: how long after it was written or last got that a track is
+                           safe from eviction, even if that leaves the store over
+                           max_bytes for a while.
+        """
+
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = max_bytes
+        self.grace_seconds = grace_seconds
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(filename, **params):
+
+        """ Returns the store key for a source file and its decode settings (which must
+            be JSON serializable), e.g. key('song.mp3', sample_rate=44100). """
+
+        st = os.stat(filename)
+
+        h = hashlib.blake2b(digest_size=20)
+
+        h.update(json.dumps([os.path.abspath(filename), st.st_size, st.st_mtime_ns, params],
+                            sort_keys=True).encode())
+
+        return h.hexdigest()
+
+    def get(self, key):
+
+        """ Returns the stored samples for key as a read-only memory map, or None if
+            there aren't any. """
+
+        path = self.__path(key)
+
+        try:
+            samples = np.load(path, mmap_mode='r', allow_pickle=False)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # mark the entry as recently used, for eviction
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return samples
+
+    def digest(self, key):
+
+        """ Returns the decode.pcm_digest() stored with key's samples, or None if
+            there isn't one. """
+
+        try:
+            with open(self.__digest_path(key)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def __write_digest(self, key, digest):
+        tmp = self.__tempfile()
+        try:
+            with open(tmp, 'w') as f:
+                f.write(digest)
+            os.replace(tmp, self.__digest_path(key))
+        except BaseException:
+            self.__discard(tmp)
+            raise
+
+    def __tempfile(self):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        return tmp
+
+    def __commit(self, tmp, key):
+
+        """ Moves a finished temp file into place as key's entry, then evicts -- anything
+            but it. """
+
+        path = self.__path(key)
+
+        os.replace(tmp, path)
+
+        self.evict(keep=path)
+
+    @staticmethod
+    def __discard(tmp):
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+
+    @contextlib.contextmanager
+    def writer(self, key, shape, dtype=np.int16):
+
+        """ A context manager that yields a writable memory map of the given shape to
+            decode into. When the block exits normally the samples are stored under
+            key; if it raises, they're thrown away. Either way, readers never see a
+            half written track.
+        """
+
+        tmp = self.__tempfile()
+
+        try:
+            samples = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+
+            yield samples
+
+            samples.flush()
+            del samples
+
+            self.__commit(tmp, key)
+        except BaseException:
+            self.__discard(tmp)
+            raise
+
+    @contextlib.contextmanager
+    def track_writer(self, key, channels, dtype=np.int16):
+
+        """ Like writer(), but for when the number of frames isn't known until they've
+            all been written. It yields a TrackWriter: pass its allocate() to
+            decode_audio(), then truncate() it to the number of frames decoded. After
+            the block, its samples attribute is the stored copy, as a read-only memory
+            map.
+        """
+
+        tmp = self.__tempfile()
+        track = TrackWriter(tmp, channels, dtype)
+
+        try:
+            yield track
+
+            track._finish()
+
+            # map it before it's moved into place, so that even if something else
+            # evicts it straight away, there's still a copy to hand back
+
+            samples = np.load(tmp, mmap_mode='r', allow_pickle=False)
+
+            if track.digest is not None:
+                self.__write_digest(key, track.digest)
+
+            self.__commit(tmp, key)
+        except BaseException:
+            self.__discard(tmp)
+            raise
+
+        track.samples = self.get(key)
+
+        if track.samples is None:
+            track.samples = samples
+
+    def put(self, key, samples, digest=None):
+
+        """ Stores a numpy array of samples under key and returns the stored copy (as
+            a read-only memory map). If samples alone wouldn't fit in max_bytes, they
+            aren't stored, and come straight back. digest, if given, is stored with
+            them (see digest()). """
+
+        if samples.nbytes > self.max_bytes:
+            return samples
+
+        if digest is not None:
+            self.__write_digest(key, digest)
+
+        with self.writer(key, samples.shape, samples.dtype) as out:
+            out[...] = samples
+
+        stored = self.get(key)
+
+        return samples if stored is None else stored
+
+    def evict(self, keep=None):
+
+        """ Deletes the least recently used tracks until the store fits in max_bytes.
+
+            Args:
+
+                keep: the path of a track not to delete, however old it is (i.e. the
+                      one that was just written, which the writer's about to use).
+        """
+
+        entries = []
+        now = time.time()
+
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(_SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            if self.grace_seconds and now - mtime < self.grace_seconds:
+                # still in use, and everything after it was used more recently
+                break
+            for doomed in (path, path[:-len(_SUFFIX)] + _DIGEST_SUFFIX):
+                try:
+                    os.remove(doomed)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def __digest_path(self, key):
+        return os.path.join(self.directory, key + _DIGEST_SUFFIX)
@@ -32,16 +32,1286 @@ be signaled when the processing is complete. The default mode is to run synchron
 """
 
 import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import itertools
 import librosa
-import madmom
+import os
 import random
 import scipy
+import scipy.linalg.blas
+import scipy.sparse.linalg
 import threading
+import time
+import typing
 
 import numpy as np
 import sklearn.cluster
 import sklearn.metrics
 
+from loopbot import decode
+from loopbot import instrumentation
+
+# the length of the pre-computed play_vector. At 120bpm this is ~145 hours of
+# remix, which is far more than anyone will ever listen to.
+PLAY_VECTOR_LENGTH = 1024 * 1024 + 1
+
+# how long the crossfade at each jump is, and the most memory the crossfades
+# of one song are allowed to take. If they'd take more, they get shorter.
+CROSSFADE_SECONDS = .01
+CROSSFADE_MAX_BYTES = 16 * 1024 * 1024
+
+# crossfades shorter than this many samples aren't worth having
+CROSSFADE_MIN_SAMPLES = 32
+
+# the most memory (in MiB) sklearn gets for each chunk of pairwise distances when it
+# computes a silhouette score, so long tracks never need all n x n of them at once
+SILHOUETTE_WORKING_MEMORY = 64
+
+# eigenvalues of the Laplacian closer together than this are treated as equal, since
+# their eigenvectors are too (see fix_degenerate_eigenvectors())
+EIGENVALUE_TOLERANCE = 1e-4
+
+# the per-beat scalar values, stored as one column each. This is ~60 bytes a
+# beat, versus a couple of KB for a dict with the same keys in it.
+BEAT_DTYPE = np.dtype([('id', np.int32),
+                       ('start', np.float64),
+                       ('duration', np.float64),
+                       ('bar_position', np.int8),
+                       ('cluster', np.int16),
+                       ('segment', np.int32),
+                       ('is', np.int32),
+                       ('amplitude', np.float64),
+                       ('next', np.int32),
+                       ('start_index', np.int64),
+                       ('stop_index', np.int64),
+                       ('quartile', np.int16)])
+
+PLAY_STEP_DTYPE = np.dtype([('beat', np.int32),
+                            ('seq_len', np.int32),
+                            ('seq_pos', np.int32)])
+
+class PlayStep(typing.NamedTuple):
+
+    """ One step of a play path. Behaves like the old play_vector dicts, so
+        step['beat'] still works alongside step.beat and tuple unpacking.
+    """
+
+    beat: int
+    seq_len: int
+    seq_pos: int
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+class BeatTable(collections.abc.Sequence):
+
+    """ Column-oriented storage for the beats of a song.
+
+        The scalar per-beat values live in a single numpy structured array (see
+        BEAT_DTYPE), and the jump candidates live in CSR form: the candidates of
+        beat i are jump_indices[jump_offsets[i]:jump_offsets[i+1]]. Audio buffers
+        aren't stored at all -- they're just views into the song's raw audio.
+
+        Indexing the table gives you a Beat, a read-only dict-like view, so code that
+        does things like beats[i]['next'] keeps working. Code that cares about speed
+        should use column() and jump_candidates() instead.
+    """
+
+    def __init__(self, data, jump_offsets, jump_indices, audio=None):
+        self.data = data
+        self.jump_offsets = jump_offsets
+        self.jump_indices = jump_indices
+        self.audio = audio
+
+    @classmethod
+    def from_dicts(cls, beats, audio=None):
+
+        """ Builds a table out of a list of beat dicts (the old self.beats format) """
+
+        data = np.array([tuple(b.get(name, 0) for name in BEAT_DTYPE.names) for b in beats],
+                        dtype=BEAT_DTYPE)
+
+        candidate_counts = [len(b.get('jump_candidates', [])) for b in beats]
+
+        jump_offsets = np.zeros(len(beats) + 1, dtype=np.int64)
+        np.cumsum(candidate_counts, out=jump_offsets[1:])
+
+        jump_indices = np.fromiter(itertools.chain.from_iterable(b.get('jump_candidates', []) for b in beats),
+                                   dtype=np.int32, count=int(jump_offsets[-1]))
+
+        return cls(data, jump_offsets, jump_indices, audio=audio)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Beat(self, i) for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('beat index out of range')
+
+        return Beat(self, index)
+
+    def column(self, name):
+        """ Returns the numpy array holding one of the BEAT_DTYPE values for every beat """
+        return self.data[name]
+
+    def jump_candidates(self, index):
+        """ Returns the jump candidates of a beat as a (read-only) numpy array """
+        return self.jump_indices[self.jump_offsets[index]:self.jump_offsets[index + 1]]
+
+    def buffer(self, index):
+        """ Returns the audio for a beat as a view into the raw audio, if we have it """
+        if self.audio is None:
+            return None
+        row = self.data[index]
+        return self.audio[row['start_index']:row['stop_index']]
+
+    @property
+    def nbytes(self):
+        """ The memory used by the table itself (not counting the audio it points at) """
+        return self.data.nbytes + self.jump_offsets.nbytes + self.jump_indices.nbytes
+
+class Beat(collections.abc.Mapping):
+
+    """ A read-only, dict-compatible view of one row of a BeatTable """
+
+    __slots__ = ('_table', '_index')
+
+    KEYS = BEAT_DTYPE.names + ('buffer', 'jump_candidates')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, key):
+        if key == 'buffer':
+            return self._table.buffer(self._index)
+        if key == 'jump_candidates':
+            return self._table.jump_candidates(self._index).tolist()
+        if key not in BEAT_DTYPE.fields:
+            raise KeyError(key)
+        return self._table.data[key][self._index].item()
+
+    def __iter__(self):
+        return iter(Beat.KEYS)
+
+    def __len__(self):
+        return len(Beat.KEYS)
+
+    def __eq__(self, other):
+        if isinstance(other, Beat):
+            return self._table is other._table and self._index == other._index
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self._table), self._index))
+
+    def __repr__(self):
+        return 'Beat(%r)' % {key: self[key] for key in BEAT_DTYPE.names}
+
+class BeatGraph(typing.NamedTuple):
+
+    """ The result of build_beat_graph() """
+
+    beats: BeatTable
+    outro: list
+    segments: int
+    max_amplitude: float
+
+def beats_to_times(boundaries, frame_times, beat_frames, beat_seconds):
+
+    """ Returns frame_times (the times of the beat-synchronous boundaries, as
+        librosa.util.fix_frames() gives them), except that every boundary that's
+        one of the beats gets that beat's exact time back. If several beats land
+        in the same frame, the first one's time is used.
+
+        Args:
+
+              boundaries: the boundary frames, sorted
+             frame_times: the times of those frames
+             beat_frames: the frame each beat landed in, sorted
+            beat_seconds: the exact time of each beat
+    """
+
+    beat_frames = np.asarray(beat_frames)
+    times = np.array(frame_times, dtype=np.float64)
+
+    if len(beat_frames) == 0:
+        return times
+
+    first = np.minimum(np.searchsorted(beat_frames, boundaries), len(beat_frames) - 1)
+    is_beat = beat_frames[first] == boundaries
+
+    times[is_beat] = np.asarray(beat_seconds, dtype=np.float64)[first[is_beat]]
+
+    return times
+
+def build_beat_graph(starts, clusters, amplitudes, bar_positions, duration,
+                     bytes_per_second, start_beat=0, audio=None):
+
+    """ Builds the final beat table (including 'next' and 'jump_candidates') out of the
+        per-beat analysis results.
+
+        This used to be done with per-beat dicts and a scan over every beat for every
+        beat. Instead, all of the beats that can be jumped to are grouped by their
+        (cluster, is, bar_position) key, so each beat only has to look at the group
+        that matches its next beat. The results are exactly the same.
+
+        Args:
+
+                   starts: the start time (in seconds) of each beat
+                 clusters: the cluster label of each beat
+               amplitudes: the mean amplitude of each beat
+            bar_positions: the position of each beat in its bar
+                 duration: the duration (in seconds) of the whole track
+         bytes_per_second: the number of raw audio samples per second
+               start_beat: the first beat to play in the file
+                    audio: the raw audio the beats point into (optional)
+    """
+
+    starts = np.asarray(starts, dtype=np.float64)
+    clusters = np.asarray(clusters).astype(np.int64)
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    bar_positions = np.asarray(bar_positions).astype(np.int64)
+
+    beat_count = len(starts)
+
+    # a new segment starts every time the cluster changes. 'is' is the position
+    # of the beat within its segment.
+
+    new_segment = np.ones(beat_count, dtype=bool)
+    new_segment[1:] = clusters[1:] != clusters[:-1]
+
+    segment = np.cumsum(new_segment) - 1
+    segment_starts = np.flatnonzero(new_segment)
+    segment_beat = np.arange(beat_count) - segment_starts[segment]
+
+    durations = np.empty(beat_count, dtype=np.float64)
+    durations[:-1] = np.diff(starts)
+    durations[-1] = duration - starts[-1]
+
+    start_index = (starts * bytes_per_second).astype(np.int64)
+    stop_index = ((starts + durations) * bytes_per_second).astype(np.int64)
+
+    # get the average amplitude of the beats, and assume that the fade point of the
+    # song is the last beat of the song that is >= 75% of it. (This is summed in plain
+    # python on purpose, so that the threshold comes out exactly as it always has.)
+
+    max_amplitude = sum(amplitudes.tolist()) / beat_count
+
+    loud_beats = np.flatnonzero(amplitudes >= (.75 * max_amplitude))
+    fade = loud_beats[-1] if len(loud_beats) else beat_count - 1
+
+    # truncate the beats to [start:fade + 1] and assign final beat ids
+
+    kept = slice(start_beat, fade + 1)
+
+    data = np.zeros(len(starts[kept]), dtype=BEAT_DTYPE)
+
+    data['start'] = starts[kept]
+    data['duration'] = durations[kept]
+    data['cluster'] = clusters[kept]
+    data['amplitude'] = amplitudes[kept]
+    data['bar_position'] = bar_positions[kept]
+    data['segment'] = segment[kept]
+    data['is'] = segment_beat[kept]
+    data['start_index'] = start_index[kept]
+    data['stop_index'] = stop_index[kept]
+
+    count = len(data)
+    ids = np.arange(count)
+    loop_bounds_begin = start_beat
+
+    data['id'] = ids
+    data['quartile'] = ids // (count / 4.0)
+
+    # compute a coherent 'next' beat to play. This is always just the next ordinal beat
+    # unless we're at the end of the song. Then we want to find a reasonable 'next' beat
+    # to play. It should (a) share the same cluster, (b) be in a logical place in its
+    # measure, (c) be after the computed loop_bounds_begin, and is in the first half of
+    # the song. If we can't find such an animal, then just return the beat at
+    # loop_bounds_begin
+
+    kept_clusters = clusters[kept]
+
+    next_beat = ids + 1
+
+    last = count - 1
+
+    loop_targets = np.flatnonzero((kept_clusters == kept_clusters[last]) &
+                                  (ids % 4 == (last + 1) % 4) &
+                                  (ids <= (.5 * count)) &
+                                  (ids >= loop_bounds_begin))
+
+    next_beat[last] = loop_targets[0] if len(loop_targets) else loop_bounds_begin
+
+    # find all the beats that (a) are in the same cluster as the NEXT oridnal beat, (b) are of the same
+    # cluster position as the next ordinal beat, (c) are in the same place in the measure as the NEXT beat,
+    # (d) but AREN'T the next beat, (e) AREN'T in the same cluster as the current beat, AND
+    # (f) are more than 7 beats away (to minimize weird local loops)
+    #
+    # THAT collection of beats contains our jump candidates.
+    #
+    # (a) - (c) are the same for every beat with the same (cluster, is, bar_position) key, so
+    # we sort the beats we're allowed to jump to by that key (keeping them in song order
+    # within each key) and look up the whole group for each beat's next beat at once.
+
+    _, key = np.unique(np.stack((data['cluster'], data['is'], data['bar_position']), axis=1),
+                       axis=0, return_inverse=True)
+    key = key.reshape(-1)
+
+    jumpable = ids[loop_bounds_begin:]
+    grouped = jumpable[np.argsort(key[jumpable], kind='stable')]
+
+    group_sizes = np.bincount(key[grouped], minlength=key.max() + 1)
+    group_starts = np.cumsum(group_sizes) - group_sizes
+
+    # expand every beat into one row per member of its next beat's group...
+
+    target_key = key[next_beat]
+    pair_counts = group_sizes[target_key]
+
+    pair_source = np.repeat(ids, pair_counts)
+    pair_offset = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    pair_candidate = grouped[np.repeat(group_starts[target_key], pair_counts) + pair_offset]
+
+    # ...and then throw out the ones that fail (d) - (f)
+
+    pair_next = next_beat[pair_source]
+
+    keep = ((data['segment'][pair_candidate] != data['segment'][pair_source]) &
+            (pair_candidate != pair_next) &
+            (np.abs(pair_candidate - pair_next) > 7))
+
+    jump_indices = pair_candidate[keep].astype(np.int32)
+    jump_offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pair_source[keep], minlength=count), out=jump_offsets[1:])
+
+    # we don't want to ever play past the point where it's impossible to loop,
+    # so let's find the latest point in the song where there are still jump
+    # candidates and make sure that we can't play past it.
+
+    jumping_beats = np.flatnonzero(np.diff(jump_offsets))
+    last_chance = jumping_beats[-1] if len(jumping_beats) else last
+
+    # if we play our way to the last beat that has jump candidates, then just skip
+    # to the earliest jump candidate rather than enter a section from which no
+    # jumping is possible.
+
+    next_beat[last_chance] = jump_indices[jump_offsets[last_chance]:jump_offsets[last_chance + 1]].min()
+
+    data['next'] = next_beat
+
+    beats = BeatTable(data, jump_offsets, jump_indices, audio=audio)
+
+    # store the beats that start after the last jumpable point. That's
+    # the outro to the song. We can use these
+    # beasts to create a sane ending for a fixed-length remix
+
+    outro = []
+
+    for i in range(last_chance + 1 + start_beat, beat_count):
+        if start_beat <= i <= fade:
+            outro.append(dict(beats[i - start_beat]))
+        else:
+            outro.append({'start': float(starts[i]),
+                          'cluster': int(clusters[i]),
+                          'amplitude': float(amplitudes[i]),
+                          'bar_position': int(bar_positions[i]),
+                          'segment': int(segment[i]),
+                          'is': int(segment_beat[i]),
+                          'duration': float(durations[i]),
+                          'start_index': int(start_index[i]),
+                          'stop_index': int(stop_index[i]),
+                          'buffer': audio[start_index[i]:stop_index[i]] if audio is not None else None})
+
+    # save off the segment count
+
+    segments = int(data['segment'].max()) + 1
+
+    return BeatGraph(beats, outro, segments, max_amplitude)
+
+class JumpCrossfades(object):
+
+    """ Precomputed crossfades for every jump in a BeatTable.
+
+        A jump from beat b to some beat c other than b + 1 -- one of b's jump
+        candidates, or its 'next' beat when that loops back -- would normally cut
+        straight from the end of b to the start of c, which clicks. Instead, the
+        first few ms of c are replaced by an equal-power crossfade from the audio
+        that would have followed b to the start of c. Those are all computed up
+        front (with numpy, a chunk of jumps at a time), so a player only has to
+        copy samples out of fades when it jumps -- no mixing on the audio thread.
+
+        The fades are stored in one (edges, length, channels) array: first every
+        jump candidate, in the same order as beats.jump_indices, then every 'next'
+        that loops back. Use edge() to find the one for a jump; sources and targets
+        hold the beats each edge goes from and to.
+
+        Args:
+
+                    beats: the BeatTable to compute the crossfades for
+                    audio: the raw audio the beats point into
+             fade_seconds: how long each crossfade is
+                max_bytes: the most memory the fades can take. If fade_seconds
+                           worth of fade for every jump would take more, the fades
+                           get shorter -- and if that'd make them shorter than
+                           CROSSFADE_MIN_SAMPLES, there aren't any (length is 0).
+    """
+
+    # how many jumps to mix at a time, to bound the float temporaries
+    CHUNK_EDGES = 1024
+
+    def __init__(self, beats, audio, sample_rate, fade_seconds=CROSSFADE_SECONDS, max_bytes=CROSSFADE_MAX_BYTES):
+        samples = audio.reshape(len(audio), -1)
+
+        # every jump goes from the end of its source beat to the start of its target
+
+        beat_ids = np.arange(len(beats))
+        next_beat = beats.column('next')
+        loops = np.flatnonzero(next_beat != beat_ids + 1)
+
+        sources = np.concatenate((np.repeat(beat_ids, np.diff(beats.jump_offsets)), loops))
+        targets = np.concatenate((beats.jump_indices, next_beat[loops])).astype(np.int64)
+
+        edge_count = len(sources)
+        channels = samples.shape[1]
+        bytes_per_sample = channels * samples.dtype.itemsize
+
+        start_index = beats.column('start_index')
+        stop_index = np.minimum(beats.column('stop_index'), len(samples))
+
+        # a fade has to fit inside the shortest beat it could be jumped to, and in
+        # the memory budget
+
+        length = int(round(fade_seconds * sample_rate))
+
+        if edge_count:
+            length = min(length, int((stop_index - start_index)[targets].min()),
+                         max_bytes // (edge_count * bytes_per_sample))
+
+        if length < CROSSFADE_MIN_SAMPLES:
+            length = 0
+
+        self.length = length
+        self.sources = sources
+        self.targets = targets
+        self.fades = np.empty((edge_count, length, channels), dtype=samples.dtype)
+
+        # if a beat's 'next' is also one of its candidates, the first one wins
+
+        self.__edges = {}
+
+        for edge, key in enumerate(zip(sources.tolist(), targets.tolist())):
+            self.__edges.setdefault(key, edge)
+
+        if length == 0:
+            return
+
+        # equal power: the gains are the sin and cos of the same quarter circle, so
+        # their squares always sum to 1 and uncorrelated audio doesn't dip in the middle
+
+        angle = (np.arange(length) + .5) / length * (np.pi / 2)
+
+        fade_in = np.sin(angle, dtype=np.float32)[:, None]
+        fade_out = np.cos(angle, dtype=np.float32)[:, None]
+
+        outgoing = stop_index[sources]
+        incoming = start_index[targets]
+
+        offsets = np.arange(length)
+
+        if np.issubdtype(samples.dtype, np.integer):
+            info = np.iinfo(samples.dtype)
+        else:
+            info = None
+
+        for first in range(0, edge_count, self.CHUNK_EDGES):
+            chunk = slice(first, first + self.CHUNK_EDGES)
+
+            # the audio after the last beat is silence
+
+            positions = outgoing[chunk, None] + offsets
+            past_end = positions >= len(samples)
+
+            out = samples[np.minimum(positions, len(samples) - 1)].astype(np.float32)
+            out[past_end] = 0
+
+            mixed = out * fade_out
+            mixed += samples[incoming[chunk, None] + offsets] * fade_in
+
+            if info is not None:
+                np.clip(np.rint(mixed, out=mixed), info.min, info.max, out=mixed)
+
+            self.fades[chunk] = mixed
+
+    def edge(self, beat, target):
+
+        """ Returns the index (into fades) of the jump from beat to target, or None if
+            there isn't a fade for that jump. """
+
+        if self.length == 0:
+            return None
+
+        return self.__edges.get((beat, target))
+
+    @property
+    def nbytes(self):
+        """ The memory used by the fades """
+        return self.fades.nbytes
+
+def _fit_cluster_candidate(evecs, Cnorm, n_clusters, score=True):
+
+    ''' Clusters the beats into n_clusters clusters and scores the result.
+
+        This lives at module level so that it can be shipped off to a process pool.
+        Returns the cluster labels and their silhouette average. If score is False the
+        silhouette average is left for the caller to compute, and None is returned
+        in its place.
+    '''
+
+    # compute a matrix of the Eigen-vectors / their normalized values
+    X = evecs[:, :n_clusters] / Cnorm[:, n_clusters-1:n_clusters]
+
+    # create the candidate clusters and fit them
+
+    cluster_labels = sklearn.cluster.KMeans(n_clusters=n_clusters,
+                                            max_iter=600,
+                                            random_state=10,
+                                            n_init=10).fit_predict(X)
+
+    if not score:
+        return cluster_labels, None
+
+    with sklearn.config_context(working_memory=SILHOUETTE_WORKING_MEMORY):
+        silhouette_avg = sklearn.metrics.silhouette_score(X, cluster_labels)
+
+    return cluster_labels, silhouette_avg
+
+# the pools the cluster candidates get fitted on, by (kind, workers). They're kept
+# from one song to the next, so a process pool's workers only start up (and import
+# numpy and sklearn) once.
+
+_CLUSTER_EXECUTORS = {}
+_CLUSTER_EXECUTORS_LOCK = threading.Lock()
+
+def cluster_executor(kind, workers):
+
+    ''' Returns the shared pool to fit cluster candidates on, creating it the first
+        time it's asked for.
+
+        Args:
+
+               kind: 'thread' or 'process'
+            workers: how many threads or processes it has
+    '''
+
+    with _CLUSTER_EXECUTORS_LOCK:
+        executor = _CLUSTER_EXECUTORS.get((kind, workers))
+
+        if executor is None:
+            if kind == 'process':
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+            _CLUSTER_EXECUTORS[kind, workers] = executor
+
+        return executor
+
+def shutdown_cluster_executors():
+
+    ''' Shuts down the pools cluster_executor() has handed out. They're started
+        again on next use. '''
+
+    with _CLUSTER_EXECUTORS_LOCK:
+        executors = list(_CLUSTER_EXECUTORS.values())
+        _CLUSTER_EXECUTORS.clear()
+
+    for executor in executors:
+        executor.shutdown()
+
+def smallest_eigenvectors(L, k):
+
+    ''' Computes just the k smallest eigenvalues (and their eigenvectors) of a normalized
+        Laplacian (dense or scipy.sparse), in ascending order -- like eigh() would.
+
+        That's what the clustering uses out of a full eigh(), at roughly O(n^2 * k) cost
+        instead of O(n^3). The eigenvalues of a normalized Laplacian all lie in [0, 2], so
+        for a dense L the smallest ones of L are the largest ones of 2I - L -- which Lanczos
+        iteration (eigsh) converges on far more quickly than it does on the small end of L.
+
+        A sparse L comes from a long track, where the smallest eigenvalues are crowded very
+        close together near 0 and plain Lanczos takes forever to pull them apart. There we
+        use shift-invert mode instead, which only needs a sparse factorization of L.
+    '''
+
+    n = L.shape[0]
+
+    # a fixed starting vector, so the same song always gets the same eigenvectors
+    v0 = np.random.RandomState(0).uniform(-1, 1, n)
+
+    # the median filtered recurrence matrix isn't quite symmetric, and so neither is L.
+    # eigh() only ever looks at the lower triangle, so mirror that onto the upper one
+    # to solve for exactly the same matrix it does (eigsh would use both triangles).
+    # It's solved in double precision either way: in single precision, eigsh can miss
+    # some of a cluster of nearly equal eigenvalues.
+
+    if scipy.sparse.issparse(L):
+
+        lower = scipy.sparse.tril(L, format='csc').astype(np.float64)
+        L = lower + scipy.sparse.tril(lower, k=-1).T
+
+        # L is (very nearly) positive semi-definite, so the eigenvalues nearest a
+        # shift just below 0 are its smallest ones
+
+        evals, evecs = scipy.sparse.linalg.eigsh(scipy.sparse.csc_matrix(L), k=k, sigma=-1e-3,
+                                                 which='LM', v0=v0)
+
+        order = np.argsort(evals, kind='stable')
+
+        return evals[order], evecs[:, order]
+
+    M = -np.tril(np.asarray(L, dtype=np.float64))
+    M += np.tril(M, k=-1).T
+    M[np.diag_indices(n)] += 2.0
+
+    evals, evecs = scipy.sparse.linalg.eigsh(M, k=k, which='LA', v0=v0)
+
+    evals = 2.0 - evals
+    order = np.argsort(evals, kind='stable')
+
+    return evals[order], evecs[:, order]
+
+def sparse_diagonal_median_filter(R, size):
+
+    ''' The sparse equivalent of
+
+            librosa.segment.timelag_filter(scipy.ndimage.median_filter)(R, size=(1, size))
+
+        i.e. a median filter that runs down each diagonal of R, with any entry that isn't
+        stored counting as a 0. Away from the edges of the matrix the results are identical;
+        right at the edges, librosa pads in lag space while this just pads with zeros.
+
+        Affinities are never negative, so the median of a window can only be non-zero if
+        more than half of the window is stored entries. That means we only ever have to
+        look at positions that are near enough to a lot of stored entries, which keeps
+        all of this proportional to the number of stored entries.
+    '''
+
+    R = scipy.sparse.coo_matrix(R)
+    n_rows, n_cols = R.shape
+    half = size // 2
+
+    rows = R.row.astype(np.int64)
+    cols = R.col.astype(np.int64)
+
+    stored_keys = rows * n_cols + cols
+    order = np.argsort(stored_keys)
+    stored_keys = stored_keys[order]
+    stored_values = R.data[order]
+
+    # every stored entry "votes" for each position within half a window of it along its
+    # diagonal. A position's vote count is then the number of stored entries in its window.
+
+    offsets = np.arange(-half, half + 1)
+
+    candidate_keys = (stored_keys[:, None] + offsets * (n_cols + 1)).ravel()
+    candidate_keys, votes = np.unique(candidate_keys, return_counts=True)
+    candidate_keys = candidate_keys[votes > half]
+
+    candidate_rows, candidate_cols = np.divmod(candidate_keys, n_cols)
+
+    # only the keys that didn't wrap around the edge of the matrix are real positions
+    # (the vote counts near the edges can be off for the same reason, but those
+    # positions get their windows checked properly below anyway)
+
+    valid = (candidate_rows >= 0) & (candidate_rows < n_rows) & (candidate_cols >= 0) & (candidate_cols < n_cols)
+    candidate_rows = candidate_rows[valid]
+    candidate_cols = candidate_cols[valid]
+
+    # look up every entry in every candidate's window
+
+    window_rows = candidate_rows[:, None] + offsets
+    window_cols = candidate_cols[:, None] + offsets
+    in_bounds = (window_rows >= 0) & (window_rows < n_rows) & (window_cols >= 0) & (window_cols < n_cols)
+
+    window_keys = window_rows * n_cols + window_cols
+    found_at = np.minimum(np.searchsorted(stored_keys, window_keys), len(stored_keys) - 1)
+    found = in_bounds & (stored_keys[found_at] == window_keys)
+
+    medians = np.median(np.where(found, stored_values[found_at], 0.0), axis=1)
+
+    keep = medians != 0
+
+    return scipy.sparse.csr_matrix((medians[keep], (candidate_rows[keep], candidate_cols[keep])), shape=R.shape)
+
+def fix_eigenvector_signs(evecs):
+
+    ''' Flips each eigenvector (column) so that its largest magnitude entry is positive '''
+
+    largest = np.argmax(np.abs(evecs), axis=0)
+    signs = np.sign(evecs[largest, np.arange(evecs.shape[1])])
+    signs[signs == 0] = 1
+
+    evecs *= signs
+
+    return evecs
+
+def fix_degenerate_eigenvectors(evals, evecs, tolerance=EIGENVALUE_TOLERANCE):
+
+    ''' Replaces the eigenvectors of every run of (nearly) equal eigenvalues with a basis
+        that only depends on the space they span, not on which vectors in it the solver
+        happened to return.
+
+        Songs that repeat themselves exactly have clusters of eigenvalues that are equal
+        to within rounding. Any rotation of their eigenvectors is just as good, and the
+        dense and partial solvers land on different ones -- which KMeans then turns into
+        different clusters. Within each run, beats are picked greedily by how much of
+        the space they still add (ties going to the earliest beat, since a repeated
+        section has beats that add exactly as much as each other), and the eigenvectors
+        become the space's projections of those beats, orthonormalized in the order they
+        were picked. Only the first evecs.shape[1] eigenvalues are looked at.
+    '''
+
+    count = evecs.shape[1]
+
+    runs = np.split(np.arange(count), np.flatnonzero(np.diff(evals[:count]) > tolerance) + 1)
+
+    for run in runs:
+        if len(run) < 2:
+            continue
+
+        V = evecs[:, run].astype(np.float64)
+
+        # each beat's projection onto the space (in terms of V's columns), less what
+        # the beats picked so far already cover
+
+        residuals = V.copy()
+        basis = np.empty((len(run), len(run)))
+
+        for i in range(len(run)):
+            norms = np.einsum('ij,ij->i', residuals, residuals)
+            pivot = np.flatnonzero(norms >= norms.max() * (1.0 - 1e-6))[0]
+
+            basis[:, i] = residuals[pivot] / np.sqrt(norms[pivot])
+            residuals -= np.outer(residuals @ basis[:, i], basis[:, i])
+
+        evecs[:, run] = V @ basis
+
+    return evecs
+
+class PairwiseDistanceCache(object):
+
+    ''' Pairwise distances between the rows of X = evecs[:, :k] / Cnorm[:, k-1:k], for
+        whatever k you ask for.
+
+        The columns of X are nested as k grows, so rather than rebuilding the distances
+        from scratch for every k (which is what sklearn's silhouette_score does) we keep
+        the Gram matrix of evecs[:, :k] around and add or subtract the columns between the
+        old k and the new one. The distances then come straight out of the Gram matrix,
+        since X is just evecs[:, :k] with every row divided by its norm.
+
+        Only two n x n buffers are ever allocated. If sample_size is given, only a fixed
+        random sample of that many rows is kept, which makes them sample_size x sample_size
+        instead (and the silhouette an estimate).
+    '''
+
+    def __init__(self, evecs, Cnorm, sample_size=None, random_state=0):
+
+        if sample_size is not None and sample_size < len(evecs):
+            self.sample = np.sort(np.random.RandomState(random_state).choice(len(evecs), sample_size, replace=False))
+            evecs = evecs[self.sample]
+            Cnorm = Cnorm[self.sample]
+        else:
+            self.sample = None
+
+        self._evecs = np.asfortranarray(evecs)
+        self._Cnorm = Cnorm
+
+        # Fortran order lets BLAS update these in place
+        self._gram = np.zeros((len(evecs), len(evecs)), order='F')
+        self._distances = np.empty((len(evecs), len(evecs)), order='F')
+        self._k = 0
+
+    def distances(self, k):
+
+        ''' Returns the (shared, so don't hang on to it) n x n distance matrix for k columns '''
+
+        if abs(k - self._k) >= k:
+            self._update_gram(0, k, alpha=1.0, beta=0.0)
+        elif k > self._k:
+            self._update_gram(self._k, k, alpha=1.0, beta=1.0)
+        elif k < self._k:
+            self._update_gram(k, self._k, alpha=-1.0, beta=1.0)
+
+        self._k = k
+
+        # the squared distance between rows i and j of X is
+        #   gram[i,i]/c[i]**2 + gram[j,j]/c[j]**2 - 2*gram[i,j]/(c[i]*c[j])
+
+        inv_norm = 1.0 / self._Cnorm[:, k-1]
+
+        D = self._distances
+
+        np.multiply(self._gram, inv_norm[:, None], out=D)
+        D *= inv_norm[None, :]
+
+        self_similarity = np.diag(D).copy()
+
+        D *= -2.0
+        D += self_similarity[:, None]
+        D += self_similarity[None, :]
+
+        np.maximum(D, 0.0, out=D)
+        np.sqrt(D, out=D)
+        np.fill_diagonal(D, 0.0)
+
+        return D
+
+    def _update_gram(self, first, last, alpha, beta):
+
+        # gram = beta * gram + alpha * (evecs[:, first:last] @ evecs[:, first:last].T), in place
+
+        columns = self._evecs[:, first:last]
+
+        self._gram = scipy.linalg.blas.dgemm(alpha, columns, columns, beta=beta, c=self._gram,
+                                             trans_b=True, overwrite_c=True)
+
+def silhouette_from_distances(D, labels):
+
+    ''' The mean silhouette coefficient of all samples, given their precomputed pairwise
+        distances. Gives the same answer as sklearn.metrics.silhouette_score.
+    '''
+
+    _, codes = np.unique(labels, return_inverse=True)
+    codes = codes.reshape(-1)
+
+    counts = np.bincount(codes)
+    rows = np.arange(len(codes))
+
+    # the summed distance from every sample to every cluster, in one matrix multiply
+
+    membership = np.zeros((len(codes), len(counts)))
+    membership[rows, codes] = 1.0
+
+    cluster_distances = D @ membership
+
+    own_counts = counts[codes]
+
+    a = cluster_distances[rows, codes] / np.maximum(own_counts - 1, 1)
+
+    cluster_distances /= counts
+    cluster_distances[rows, codes] = np.inf
+    b = cluster_distances.min(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        silhouettes = (b - a) / np.maximum(a, b)
+
+    # samples that are alone in their cluster get a silhouette of 0
+    silhouettes[own_counts == 1] = 0.0
+
+    return float(np.mean(np.nan_to_num(silhouettes)))
+
+class DownbeatProcessorPool(object):
+
+    """ Keeps madmom's downbeat processors loaded between songs.
+
+        Building an RNNDownBeatProcessor loads its whole model ensemble from disk,
+        which costs about as much as running it on a short song. The pool hands out
+        already built (rnn, dbn) pairs instead, and only builds a new pair when all
+        of the existing ones are busy -- so concurrent songs never share one.
+
+        It also keeps the process pool that chunked_downbeat_activations() spreads
+        its chunks over, so the worker processes (and the models they've loaded)
+        outlive each song too.
+    """
+
+    def __init__(self):
+        self.__idle = []
+        self.__lock = threading.Lock()
+        self.__executor = None
+        self.__executor_workers = 0
+
+        self.created = 0
+        self.setup_seconds = 0.0
+
+    def __create(self):
+        t = time.perf_counter()
+
+        # imported here rather than up top, since it's only the beat tracking that needs
+        # madmom (and loading it pulls in the whole of its neural network stack)
+        import madmom.features
+
+        processors = (madmom.features.RNNDownBeatProcessor(),
+                      madmom.features.DBNDownBeatTrackingProcessor(beats_per_bar=[3, 4], fps=100))
+
+        elapsed = time.perf_counter() - t
+
+        with self.__lock:
+            self.created += 1
+            self.setup_seconds += elapsed
+
+        return processors
+
+    @contextlib.contextmanager
+    def acquire(self):
+
+        """ A context manager that yields (rnn, dbn, setup_seconds) and returns the
+            processors to the pool afterwards. setup_seconds is how long it took to
+            get them -- ~0 unless a new pair had to be built.
+        """
+
+        t = time.perf_counter()
+
+        with self.__lock:
+            processors = self.__idle.pop() if self.__idle else None
+
+        if processors is None:
+            processors = self.__create()
+
+        setup_seconds = time.perf_counter() - t
+
+        try:
+            yield processors[0], processors[1], setup_seconds
+        finally:
+            with self.__lock:
+                self.__idle.append(processors)
+
+    def warm_up(self, count=1):
+
+        """ Builds processors until at least count of them are idle. Returns how long
+            that took, in seconds.
+        """
+
+        t = time.perf_counter()
+
+        while True:
+            with self.__lock:
+                if len(self.__idle) >= count:
+                    break
+
+            processors = self.__create()
+
+            with self.__lock:
+                self.__idle.append(processors)
+
+        return time.perf_counter() - t
+
+    def executor(self, workers):
+
+        """ Returns a process pool of workers processes, each of which loads the
+            downbeat models once when it starts. The same pool is handed out every
+            time, unless a different number of workers is asked for -- then the old
+            one is shut down (once it's finished what it's doing) and replaced.
+        """
+
+        with self.__lock:
+            if self.__executor is not None and self.__executor_workers != workers:
+                self.__executor.shutdown(wait=False)
+                self.__executor = None
+
+            if self.__executor is None:
+                self.__executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=warm_up)
+                self.__executor_workers = workers
+
+            return self.__executor
+
+    def shutdown(self):
+
+        """ Shuts down the process pool, if there is one. It's started again on next use. """
+
+        with self.__lock:
+            executor, self.__executor = self.__executor, None
+
+        if executor is not None:
+            executor.shutdown()
+
+# the pool every InfiniteJukebox gets its downbeat processors from
+
+DOWNBEAT_PROCESSORS = DownbeatProcessorPool()
+
+class SpectralFeatures(typing.NamedTuple):
+
+    """ The frame-level features the analysis uses, all at the same sample rate
+        and hop length. """
+
+    cqt: np.ndarray
+    mfcc: np.ndarray
+    rms: np.ndarray
+    onset_envelope: np.ndarray
+    tempo: np.ndarray
+    sr: int
+    hop_length: int
+
+def extract_spectral_features(y, sr, analysis_sr=None, hop_length=512):
+
+    """ Computes the constant-q spectrogram (in dB), mfccs, rms amplitudes, onset
+        envelope and tempo of some mono samples.
+
+        The samples are resampled to analysis_sr first (if it's set and differs from
+        sr), and the mfccs, onset envelope and tempo are all derived from a single
+        STFT -- rather than each librosa feature function doing its own.
+
+        Args:
+
+                    y: the mono samples
+                   sr: their sample rate
+          analysis_sr: the sample rate to compute the features at. None means sr.
+           hop_length: the hop between frames, in samples at analysis_sr
+    """
+
+    if analysis_sr and analysis_sr != sr:
+        y = librosa.resample(y, orig_sr=sr, target_sr=analysis_sr, res_type='polyphase')
+        sr = analysis_sr
+
+    BINS_PER_OCTAVE = 12 * 3
+    N_OCTAVES = 7
+
+    cqt = librosa.cqt(y=y, sr=sr, hop_length=hop_length, bins_per_octave=BINS_PER_OCTAVE,
+                      n_bins=N_OCTAVES * BINS_PER_OCTAVE)
+    C = librosa.amplitude_to_db(np.abs(cqt), ref=np.max)
+
+    del cqt
+
+    # one magnitude STFT, and one mel spectrogram from it, feed the rest. These are
+    # the same spectrograms librosa.feature.mfcc() and librosa.beat.tempo() build
+    # internally when given the samples.
+
+    S = np.abs(librosa.stft(y, n_fft=2048, hop_length=hop_length))
+    mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=S**2, sr=sr))
+
+    mfcc = librosa.feature.mfcc(S=mel_db, sr=sr)
+
+    # the amplitudes come straight from the samples -- it's only a sum of squares a
+    # frame, and going via S would scale them by the STFT window.
+    # newer versions of librosa have renamed the rmse function
+
+    if hasattr(librosa.feature,'rms'):
+        rms = librosa.feature.rms(y=y, hop_length=hop_length)
+    else:
+        rms = librosa.feature.rmse(y=y, hop_length=hop_length)
+
+    onset_envelope = librosa.onset.onset_strength(S=mel_db, sr=sr, hop_length=hop_length)
+    tempo = librosa.beat.tempo(onset_envelope=onset_envelope, sr=sr, hop_length=hop_length)
+
+    return SpectralFeatures(cqt=C, mfcc=mfcc, rms=rms, onset_envelope=onset_envelope,
+                            tempo=tempo, sr=sr, hop_length=hop_length)
+
+# the sample rate madmom's downbeat models were trained at
+
+DOWNBEAT_SAMPLE_RATE = 44100
+
+# madmom's downbeat activations come out at this many frames a second
+
+DOWNBEAT_FPS = 100
+
+def warm_up(count=1):
+
+    """ Loads the downbeat models ahead of the first song, so it doesn't pay for
+        them. Call it once at startup -- from the thread or process that will do the
+        processing. Returns how long it took, in seconds.
+    """
+
+    return DOWNBEAT_PROCESSORS.warm_up(count)
+
+def _downbeat_activations(y):
+
+    """ Runs the downbeat RNN over some mono samples. Module level so that a process
+        pool can pickle it. """
+
+    with DOWNBEAT_PROCESSORS.acquire() as (rnn, _, _):
+        return rnn(y)
+
+def chunked_downbeat_activations(y, sr, chunk_seconds, overlap_seconds, workers=1, executor=None, rnn=None):
+
+    """ Computes the same activations as running the downbeat RNN over all of y in
+        one go, but a chunk at a time -- so that the chunks can be spread over a pool
+        of processes.
+
+        The network looks at its neighbors in both directions, so each chunk is run
+        with overlap_seconds of extra audio on either side, and only the frames in
+        its middle are kept. Stitched back together, they line up frame-for-frame
+        with the single pass and can go straight to the DBN.
+
+        Args:
+
+                    y: the mono samples, at sr
+                   sr: the sample rate. Must be a multiple of DOWNBEAT_FPS.
+        chunk_seconds: how much of the track each chunk keeps
+      overlap_seconds: how much context to add either side of a chunk
+              workers: the number of processes to run the chunks on. With the default
+                       of 1 they run one after the other in this process. Otherwise
+                       they run on DOWNBEAT_PROCESSORS.executor(workers), which is
+                       kept around for the next song.
+             executor: a concurrent.futures executor to run the chunks on instead.
+                  rnn: the downbeat RNN to run the chunks on when they run in this
+                       process -- e.g. the one the caller already has out of
+                       DOWNBEAT_PROCESSORS, so a second one isn't built. If not set,
+                       one is acquired from DOWNBEAT_PROCESSORS.
+    """
+
+    hop = sr // DOWNBEAT_FPS
+
+    total_frames = -(-len(y) // hop)
+    chunk_frames = max(1, int(chunk_seconds * DOWNBEAT_FPS))
+    overlap_frames = int(overlap_seconds * DOWNBEAT_FPS)
+
+    # every window starts on a frame boundary, so its frame j is frame
+    # window_start + j of the whole track
+
+    chunks = []
+
+    for begin in range(0, total_frames, chunk_frames):
+        end = min(begin + chunk_frames, total_frames)
+        window_start = max(0, begin - overlap_frames)
+        window_end = min(total_frames, end + overlap_frames)
+
+        chunks.append((begin, end, window_start, y[window_start * hop:window_end * hop]))
+
+    if executor is None and workers > 1 and len(chunks) > 1:
+        executor = DOWNBEAT_PROCESSORS.executor(workers)
+
+    if executor is None and rnn is not None:
+        results = [rnn(window) for _, _, _, window in chunks]
+    elif executor is None:
+        results = [_downbeat_activations(window) for _, _, _, window in chunks]
+    else:
+        results = list(executor.map(_downbeat_activations, [window for _, _, _, window in chunks]))
+
+    return np.concatenate([act[begin - window_start:end - window_start]
+                           for (begin, end, window_start, _), act in zip(chunks, results)])
+
+class AnalysisCancelled(Exception):
+
+    """ Raised out of InfiniteJukebox when its cancel token is cancelled or its
+        deadline passes. """
+
+class CancellationToken(object):
+
+    """ Lets one thread ask an InfiniteJukebox being processed in another to stop.
+        One token can be shared by any number of jukeboxes.
+
+        To cancel a jukebox in another process, pass in a multiprocessing (or
+        Manager) Event -- the token can then be pickled along with it. The reason
+        stays behind in the process that called cancel().
+    """
+
+    def __init__(self, event=None):
+        self.__event = event if event is not None else threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        if not self.__event.is_set():
+            self.reason = reason
+            self.__event.set()
+
+    @property
+    def cancelled(self):
+        return self.__event.is_set()
+
+class JukeboxAnalysis(object):
+
+    """ Everything a player needs from a processed InfiniteJukebox, without the rest
+        of it -- see InfiniteJukebox.to_analysis().
+
+        It has the same duration, sample_rate, tempo, clusters, segments, beats,
+        raw_audio, timings, crossfades and play_path() as the jukebox it came from, and it pickles
+        compactly: if raw_audio is a memory map (i.e. it came from a PCMStore), only
+        the path to it is pickled and it's mapped again on the other side. So's
+        everything else of any size -- the beats are pickled as their numpy columns,
+        and the crossfades aren't pickled at all (they're recomputed on first use).
+    """
+
+    def __init__(self, jukebox):
+        self.filename = jukebox._InfiniteJukebox__filename
+        self.duration = jukebox.duration
+        self.sample_rate = jukebox.sample_rate
+        self.tempo = jukebox.tempo
+        self.clusters = jukebox.clusters
+        self.segments = jukebox.segments
+        self.max_amplitude = jukebox.max_amplitude
+        self.downbeat_setup_seconds = jukebox.downbeat_setup_seconds
+        self.timings = dict(jukebox.timings)
+        self.raw_audio = jukebox.raw_audio
+        self.beats = jukebox.beats
+        self.start_beat = jukebox._loop_bounds_begin
+        self.crossfade_seconds = jukebox._crossfade_seconds
+        self.crossfade_max_bytes = jukebox._crossfade_max_bytes
+        self._crossfades = None
+
+    def play_path(self, first_beat=0):
+
+        """ Returns a generator that yields an endless remix of this song (see
+            InfiniteJukebox.play_path()) """
+
+        return InfiniteJukebox.GeneratePlayPathFromBeatsMadmom(self.beats, start_beat = self.start_beat,
+                                                               first_beat = first_beat)
+
+    @property
+    def crossfades(self):
+
+        """ The JumpCrossfades for this song's jumps (see InfiniteJukebox.crossfades),
+            computed on first use. """
+
+        if self._crossfades is None:
+            self._crossfades = JumpCrossfades(self.beats, self.raw_audio, self.sample_rate,
+                                              fade_seconds = self.crossfade_seconds,
+                                              max_bytes = self.crossfade_max_bytes)
+        return self._crossfades
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        # they're big, and cheap to compute again from the audio
+
+        state['_crossfades'] = None
+
+        state['beats'] = BeatTable(self.beats.data, self.beats.jump_offsets, self.beats.jump_indices)
+
+        pcm_path = getattr(self.raw_audio, 'filename', None)
+
+        if pcm_path is not None:
+            state['raw_audio'] = None
+            state['pcm_path'] = pcm_path
+
+            # mark it as used, so that the pcm store's grace period (which keeps it
+            # from being evicted before the other side maps it) starts from now
+
+            try:
+                os.utime(pcm_path)
+            except FileNotFoundError:
+                pass
+
+        return state
+
+    def __setstate__(self, state):
+        pcm_path = state.pop('pcm_path', None)
+
+        self.__dict__.update(state)
+
+        if pcm_path is not None:
+            try:
+                self.raw_audio = np.load(pcm_path, mmap_mode='r', allow_pickle=False)
+            except FileNotFoundError:
+                # the pcm store evicted it after all (say it was given no grace
+                # period), so decode the file again
+
+                self.raw_audio = decode.decode_audio(self.filename, sample_rate=self.sample_rate).pcm
+
+        self.beats.audio = self.raw_audio
+
 class InfiniteJukebox(object):
 
     """ Class to "infinitely" remix a song.
@@ -66,7 +1336,8 @@ class InfiniteJukebox(object):
 
       raw_audio: an array of numpy.Int16 that is suitable for using for playback via pygame
                  or similar modules. If the audio is mono then the shape of the array will
-                 be (bytes,). If it's stereo, then the shape will be (2,bytes).
+                 be (bytes,). If it's stereo, then the shape will be (2,bytes). With a
+                 pcm_store, it's a read-only memory map.
 
     sample_rate: the sample rate from the audio file. Usually 44100 or 48000
 
@@ -74,8 +1345,18 @@ class InfiniteJukebox(object):
                  this will be reflected here. If you let the algorithm decide, then auto-generated
                  value will be reflected here.
 
-          beats: a dictionary containing the individual beats of the song in normal order. Each
-                 beat will have the following keys:
+downbeat_setup_seconds: how long it took to get the downbeat processors for this song. ~0
+                 once the models are loaded (see warm_up()), and 0 if the downbeats
+                 didn't need to be computed at all.
+
+        timings: a dict of the stages of the processing ('decode', 'features', 'downbeats',
+                 'recurrence', 'eigenvectors', 'clustering', 'beat_graph', ...) to
+                 instrumentation.StageTimings, in the order they ran. Stages that were
+                 skipped (say, because the analysis was cached) aren't in it.
+                 instrumentation.format_timings() makes a table out of it.
+
+          beats: a BeatTable containing the individual beats of the song in normal order. Each
+                 beat is a read-only dict-like view with the following keys:
 
                          id: the ordinal position of the beat in the song
                       start: the time (in seconds) in the song where this beat occurs
@@ -110,12 +1391,23 @@ class InfiniteJukebox(object):
                         channel.queue(snd)
                         time.sleep(beat['duration'])
 
+     crossfades: a JumpCrossfades holding a short equal-power crossfade for every jump a
+                 play path can take, so a player can jump without clicking. Only computed
+                 the first time you read it. crossfades.nbytes is how much memory it takes,
+                 which is bounded by the crossfade_max_bytes constructor arg.
+
     play_vector: a beat play list of 1024^2 items. This represents a pre-computed
                  remix of this song that will last beat['duration'] * 1024 * 1024
                  seconds long. A song that is 120bpm will have a beat duration of .5 sec,
                  so this playlist will last .5 * 1024 * 1024 seconds -- or 145.67 hours.
 
-                 Each item contains:
+                 It is only materialized the first time you read it, and its length can be
+                 bounded with the play_vector_length constructor arg. If you just want to
+                 play the song, use play_path() instead -- it yields the same kind of items
+                 (as PlayStep tuples) on demand without holding them all in memory.
+
+                 It's stored as a numpy structured array (see PLAY_STEP_DTYPE), so each item
+                 contains:
 
                     beat: an index into the beats array of the beat to play
                  seq_len: the length of the musical sequence being played
@@ -126,7 +1418,17 @@ class InfiniteJukebox(object):
     """
 
     def __init__(self, filename, start_beat=0, clusters=0, progress_callback=None,
-                 do_async=False, use_v1=False, starting_beat_cache=None):
+                 do_async=False, use_v1=False, starting_beat_cache=None,
+                 play_vector_length=PLAY_VECTOR_LENGTH, cluster_workers=1, cluster_pool='thread',
+                 cluster_search='exhaustive', cluster_search_stride=8, verify_cluster_search=False,
+                 shared_distances=True, silhouette_sample_size='auto', silhouette_sample_threshold=2000,
+                 eigen_solver='auto', partial_eigen_threshold=1000,
+                 sparse_affinity='auto', sparse_affinity_threshold=4000, sparse_affinity_neighbors=64,
+                 analysis_cache=None, downbeat_chunk_seconds=None, downbeat_chunk_overlap=15,
+                 downbeat_workers=1, analysis_sample_rate=22050, pcm_store=None,
+                 timing_hook=None, track_memory=False, cancel_token=None, deadline=None,
+                 sample_rate=44100, crossfade_seconds=CROSSFADE_SECONDS,
+                 crossfade_max_bytes=CROSSFADE_MAX_BYTES, decoded_callback=None):
 
         """ The constructor for the class. Also starts the processing thread.
 
@@ -151,6 +1453,84 @@ class InfiniteJukebox(object):
      starting_beat_cache: the process to pick out the beats in the audio is very compute
                           intense. You can shortcut it by passing in an already populated beat
                           dictionary in the form of self.beats
+      play_vector_length: the number of items to put in play_vector if (and when) it gets
+                          materialized.
+         cluster_workers: how many candidate cluster counts to fit at the same time when
+                          auto-clustering. The DEFAULT of 1 fits them one after the other.
+            cluster_pool: either 'thread' or 'process' -- the kind of worker pool to use
+                          when cluster_workers > 1. The results are the same either way. The
+                          pool is shared, and kept for the next song (see cluster_executor).
+          cluster_search: how to search for the best cluster count when auto-clustering. The
+                          DEFAULT of 'exhaustive' tries every value from 48 down to 4. 'coarse'
+                          tries every cluster_search_stride'th value until the scores collapse,
+                          then refines around the best one -- which takes ~4x fewer fits.
+   cluster_search_stride: the stride of the first pass of the 'coarse' search.
+   verify_cluster_search: set to True to also run the exhaustive search after a 'coarse' one
+                          and record how far apart their choices are in cluster_ratio_log.
+                          Only useful for tuning, since it does all the work we skipped.
+        shared_distances: compute the silhouette scores for every candidate cluster count from
+                          one incrementally updated distance matrix (the DEFAULT) rather than
+                          letting sklearn rebuild it from scratch each time. Not used on the
+                          sparse path unless silhouette_sample_size samples.
+  silhouette_sample_size: if set, estimate the silhouette scores from a fixed random sample of
+                          this many beats instead of all of them. Only applies to
+                          shared_distances, which keeps two (sample size) x (sample size)
+                          matrices around for the whole search. The DEFAULT of 'auto' samples
+                          silhouette_sample_threshold beats from tracks with more than that,
+                          and uses every beat otherwise. None always uses every beat.
+silhouette_sample_threshold: the beat count above which silhouette_sample_size='auto' samples.
+            eigen_solver: 'dense' to always compute every eigenvector of the Laplacian, 'partial'
+                          to only compute the few that the clustering uses, or 'auto' (the
+                          DEFAULT) to go partial for tracks with more than
+                          partial_eigen_threshold beats.
+ partial_eigen_threshold: the beat count above which eigen_solver='auto' goes partial.
+         sparse_affinity: True to build the recurrence, path and Laplacian matrices as sparse
+                          matrices (so they take memory in proportion to the beat count rather
+                          than its square), False to keep them dense, or 'auto' (the DEFAULT)
+                          to go sparse for tracks with more than sparse_affinity_threshold beats.
+                          Sparse always uses the partial eigensolver.
+sparse_affinity_threshold: the beat count above which sparse_affinity='auto' goes sparse.
+sparse_affinity_neighbors: how many nearest neighbors each beat keeps in the sparse
+                          recurrence matrix.
+          analysis_cache: an AnalysisCache (see analysis_cache.py) to look the analysis up in
+                          before doing it, and to save it to afterwards. Entries are keyed on
+                          the decoded audio and the analysis args above, so the same song
+                          from a different file or URL still hits. The beat-synchronous
+                          features and eigenvectors are saved too, so a change to only
+                          the clustering (or affinity) args picks up from there. Not used
+                          with starting_beat_cache.
+  downbeat_chunk_seconds: if set, find the downbeats a chunk of this many seconds at a time
+                          (see chunked_downbeat_activations()) instead of in one pass over the
+                          whole track. Only worth it for long tracks, with downbeat_workers > 1.
+  downbeat_chunk_overlap: how many seconds of context each chunk gets on either side.
+        downbeat_workers: how many processes to spread the downbeat chunks over.
+    analysis_sample_rate: the sample rate to compute the spectral features (CQT, mfccs,
+                          amplitudes, tempo) at. Lower is faster -- the DEFAULT of 22050 is
+                          plenty for all of them. None uses the playback rate. Doesn't affect
+                          raw_audio, or the downbeats (madmom needs 44100).
+             sample_rate: the sample rate to decode the audio at, i.e. of raw_audio. The
+                          DEFAULT is 44100; use 48000 for playing over discord.
+               pcm_store: a PCMStore (see pcm_store.py) to keep the decoded audio in. If set,
+                          raw_audio and the beat buffers are read-only memory maps of the
+                          store's copy, which is shared with every other jukebox playing the
+                          same file.
+             timing_hook: a function to call with an instrumentation.StageTiming as each
+                          stage of the processing finishes -- e.g. to forward them to a
+                          metrics system. They're also collected in self.timings.
+            track_memory: set to True to also measure the peak memory allocated by each
+                          stage (see instrumentation.StageTimer).
+            cancel_token: a CancellationToken. Cancelling it stops the processing at the next
+                          stage (or cluster fit, or chunk of decoding) by raising
+                          AnalysisCancelled. Nothing is saved to the caches when that happens.
+                deadline: a time.monotonic() value. If the processing is still going then,
+                          it stops the same way.
+       crossfade_seconds: how long the crossfade at each jump is (see crossfades).
+     crossfade_max_bytes: the most memory the crossfades can take. They get shorter (or,
+                          in the extreme, go away) to fit.
+        decoded_callback: a function to call with this jukebox as soon as the audio has been
+                          decoded, before any of the (much slower) analysis. raw_audio,
+                          sample_rate and duration are set by then, so it can e.g. start
+                          playing the song straight through while the rest is worked out.
         """
         self.__progress_callback = progress_callback
         self.__filename = filename
@@ -159,6 +1539,37 @@ class InfiniteJukebox(object):
         self._extra_diag = ""
         self._use_v1 = use_v1
         self._starting_beat_cache = starting_beat_cache
+        self._play_vector_length = play_vector_length
+        self._play_vector = None
+        self._cluster_workers = cluster_workers
+        self._cluster_pool = cluster_pool
+        self._cluster_search = cluster_search
+        self._cluster_search_stride = cluster_search_stride
+        self._verify_cluster_search = verify_cluster_search
+        self._shared_distances = shared_distances
+        self._silhouette_sample_size = silhouette_sample_size
+        self._silhouette_sample_threshold = silhouette_sample_threshold
+        self._eigen_solver = eigen_solver
+        self._partial_eigen_threshold = partial_eigen_threshold
+        self._sparse_affinity = sparse_affinity
+        self._sparse_affinity_threshold = sparse_affinity_threshold
+        self._sparse_affinity_neighbors = sparse_affinity_neighbors
+        self._analysis_cache = analysis_cache
+        self._downbeat_chunk_seconds = downbeat_chunk_seconds
+        self._downbeat_chunk_overlap = downbeat_chunk_overlap
+        self._downbeat_workers = downbeat_workers
+        self._analysis_sample_rate = analysis_sample_rate
+        self._sample_rate = sample_rate
+        self._pcm_store = pcm_store
+        self._cancel_token = cancel_token
+        self._deadline = deadline
+        self._crossfade_seconds = crossfade_seconds
+        self._crossfade_max_bytes = crossfade_max_bytes
+        self._crossfades = None
+        self._decoded_callback = decoded_callback
+        self.__timer = instrumentation.StageTimer(hook=timing_hook, track_memory=track_memory)
+        self.timings = self.__timer.timings
+        self.downbeat_setup_seconds = 0.0
 
         if do_async == True:
             self.play_ready = threading.Event()
@@ -184,39 +1595,273 @@ class InfiniteJukebox(object):
         I have made some performance improvements, but the basic parts remain (mostly) unchanged
         """
 
+        # the stages are started one after the other by __begin_stage(). Stopping the
+        # timer in the finally records whichever one was running, even if it raised
+        # (or the analysis was cancelled)
+
+        try:
+            self.__process_stages()
+        finally:
+            self.__timer.stop()
+
+    def __process_stages(self):
+
+        """ The body of __process_audio_madmom(). """
+
         self.__report_progress( .1, "loading file and extracting raw audio")
 
-        #
-        # load the file as stereo with a high sample rate
-        #
+        self.__begin_stage('decode')
+
+        sr = self._sample_rate
+
+        # if another jukebox has already decoded this file into the pcm store, just
+        # map its copy
+
+        raw_audio = None
+        pcm_key = None
+        y = None
+
+        # the hash of raw_audio, for the analysis cache key. It's worked out while
+        # decoding, and kept in the pcm store alongside the samples, so a cache hit
+        # doesn't have to read through the whole track again
+
+        self.__audio_digest = None
+
+        if self._pcm_store is not None:
+            pcm_key = self._pcm_store.key(self.__filename, sample_rate=sr)
+            raw_audio = self._pcm_store.get(pcm_key)
+
+            if raw_audio is not None:
+                self.__audio_digest = self._pcm_store.digest(pcm_key)
+
+        if raw_audio is None:
 
-        y, sr = librosa.core.load(self.__filename, mono=False, sr=44100)
+            #
+            # decode the file as stereo with a high sample rate. We also get the
+            # samples mixed down to mono, because the beat detection algorithm in
+            # madmom performs better if there's only one channel.
+            #
+
+            # only pass on every 5%, rather than every chunk
+
+            reported = [0]
+
+            def on_decode_progress(fraction):
+                self.__check_cancelled()
+                if fraction - reported[0] >= .05:
+                    reported[0] = fraction
+                    self.__report_progress( .1 + .1 * fraction, "decoding audio..." )
+
+            # with a pcm store, decode straight into it, rather than into RAM and then
+            # copying it over
+
+            if self._pcm_store is not None:
+                with self._pcm_store.track_writer(pcm_key, channels=2) as track:
+                    decoded = decode.decode_audio(self.__filename, sample_rate=sr,
+                                                  progress_callback=on_decode_progress,
+                                                  allocate=track.allocate)
+                    track.truncate(len(decoded.pcm))
+                    track.digest = decoded.digest
+
+                raw_audio = track.samples
+            else:
+                decoded = decode.decode_audio(self.__filename, sample_rate=sr,
+                                              progress_callback=on_decode_progress)
+
+                raw_audio = decoded.pcm
+
+            y = decoded.mono
+            self.__audio_digest = decoded.digest
+
+            del decoded
 
-        self.duration = librosa.core.get_duration(y,sr)
-        self.raw_audio = (y * np.iinfo(np.int16).max).astype(np.int16).T.copy(order='C')
+        self.raw_audio = raw_audio
         self.sample_rate = sr
+        self.duration = len(raw_audio) / sr
+
+        if self._decoded_callback is not None:
+            self._decoded_callback(self)
+
+        # if the raw audio came from the pcm store, make the mono samples from it
+        # the same way decode_audio() does
+
+        if y is None:
+            if raw_audio.ndim > 1:
+                y = raw_audio.mean(axis=1, dtype=np.float32)
+            else:
+                y = raw_audio.astype(np.float32)
+
+            y /= np.iinfo(np.int16).max
+
+        # the rest of the analysis is the expensive part, so see if we've already
+        # done it for this exact audio
+
+        cache_keys = None
+        analysis = None
+
+        if self._analysis_cache is not None and self._starting_beat_cache is None:
+            self.__begin_stage('cache_lookup')
+            cache_keys = self.__analysis_cache_keys()
+            analysis = self._analysis_cache.get(cache_keys[-1])
+
+        if analysis is not None:
+            self.__report_progress( .5, "using cached analysis..." )
+
+            self.tempo = analysis['tempo']
+            self.clusters = int(analysis['cluster_count'])
+        else:
+            analysis = self.__analyze_audio(y, sr, cache_keys)
+
+            if cache_keys is not None:
+                self.__begin_stage('cache_store')
+                self._analysis_cache.put(cache_keys[-1], analysis)
+
+        del y
+
+        bytes_per_second = len(self.raw_audio) / self.duration
+
+        self.__report_progress( .93, "computing final beat array..." )
+
+        self.__begin_stage('beat_graph')
+
+        graph = build_beat_graph(starts=analysis['beat_times'],
+                                 clusters=analysis['clusters'],
+                                 amplitudes=analysis['amplitudes'],
+                                 bar_positions=analysis['bar_positions'],
+                                 duration=self.duration,
+                                 bytes_per_second=bytes_per_second,
+                                 start_beat=self.__start_beat,
+                                 audio=self.raw_audio)
+
+        self.max_amplitude = graph.max_amplitude
+        self.segments = graph.segments
+        self.outro = graph.outro
 
-        # after the raw audio bytes are saved, convert the samples to mono
-        # because the beat detection algorithm in madmom performs better
-        # if there's only one channel.
+        # save off the beats array. The play path is generated lazily from it
+        # (see play_path() and play_vector). Signal the play_ready event (if
+        # it's been set)
 
-        y = librosa.core.to_mono(y)
+        self.beats = graph.beats
+        self._loop_bounds_begin = self.__start_beat
+
+        self.__timer.stop()
+        self.__add_log(instrumentation.format_timings(self.timings))
+
+        self.__report_progress(1.0, "finished processing")
+
+        if self.play_ready:
+            self.play_ready.set()
+
+    def __analyze_audio(self, y, sr, cache_keys=None):
+
+        """ Runs the expensive part of the analysis on the mono samples: pitch data,
+        downbeats, the Laplacian segmentation and the clustering.
+
+        Returns a dict of numpy arrays -- which is also what gets stored in the
+        analysis cache, so everything in it must be cheap to save and load.
+
+        If cache_keys is given (see __analysis_cache_keys()), the beat-synchronous
+        features and the eigenvectors are looked up in (and saved to) the analysis
+        cache on the way, so changing only the clustering args (say) reuses
+        everything up to the clustering.
+        """
+
+        features_key, eigenvectors_key, _ = cache_keys or (None, None, None)
+
+        features = self.__cached_stage(features_key, 'features', lambda: self.__beat_features(y, sr),
+                                       .3, "using cached beat features...")
+
+        self.tempo = features['tempo']
+
+        evecs = self.__cached_stage(eigenvectors_key, 'eigenvectors', lambda: self.__eigenvectors(features),
+                                    .5, "using cached eigenvectors...")['evecs']
+
+        # cumulative normalization is needed for symmetric normalize laplacian eigenvectors
+        Cnorm = np.cumsum(evecs**2, axis=1)**0.5
+
+        # a beat with (next to) nothing in the first k eigenvectors has no direction in
+        # them, just rounding error -- which is different for every solver. Leave it at
+        # the origin instead.
+        Cnorm[Cnorm < 1e-8] = np.inf
+
+        self.__report_progress( .5, "clustering..." )
+
+        self.__begin_stage('clustering')
+
+        # if a value for clusters wasn't passed in, then we need to auto-cluster
+
+        if self.clusters == 0:
+            self.clusters, seg_ids = self.__compute_best_cluster_with_sil(evecs, Cnorm)
+
+        else: # otherwise, just use the cluster value passed in
+            k = self.clusters
+
+            self.__report_progress( .51, "using " + str(self.clusters) + " clusters..." )
+
+            X = evecs[:, :k] / Cnorm[:, k-1:k]
+
+            seg_ids = sklearn.cluster.KMeans(n_clusters=k, max_iter=300,
+                                               random_state=0, n_init=20).fit_predict(X)
+
+        # line up the start time of the beat, the cluster to which the beat belongs, the
+        # mean amplitude of the beat, and the position of the beat in its bar.
+
+        beat_times = features['beat_times']
+        ampSync = features['amplitudes']
+        downbeats = features['downbeats']
+
+        beat_count = min(len(features['beat_frames']), len(beat_times), len(seg_ids), len(ampSync), len(downbeats))
+
+        return {'beat_times': beat_times[:beat_count],
+                'clusters': np.asarray(seg_ids[:beat_count]),
+                'amplitudes': ampSync[:beat_count],
+                'bar_positions': downbeats[:beat_count, 1],
+                'cluster_count': np.array(self.clusters),
+                'tempo': np.asarray(self.tempo)}
+
+    def __cached_stage(self, key, name, compute, pct_done, message):
+
+        """ Returns one stage of the analysis out of the analysis cache if key is in
+            it, otherwise computes it (and saves it under key, unless key is None). """
+
+        if key is not None:
+            self.__begin_stage(name + '_cache_lookup')
+            entry = self._analysis_cache.get(key)
+
+            if entry is not None:
+                self.__report_progress( pct_done, message )
+                return entry
+
+        entry = compute()
+
+        if key is not None:
+            self.__begin_stage(name + '_cache_store')
+            self._analysis_cache.put(key, entry)
+
+        return entry
+
+    def __beat_features(self, y, sr):
+
+        """ Finds the downbeats, and the beat-synchronous chroma, mfccs and amplitudes """
 
         self.__report_progress( .2, "computing pitch data..." )
 
-        # Compute the constant-q chromagram for the samples.
+        self.__begin_stage('features')
 
-        BINS_PER_OCTAVE = 12 * 3
-        N_OCTAVES = 7
+        # Compute the constant-q chromagram, mfccs, amplitudes and tempo for the
+        # samples, all at the analysis sample rate. madmom still gets the full rate
+        # samples below.
 
-        cqt = librosa.cqt(y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE)
-        C = librosa.amplitude_to_db( np.abs(cqt), ref=np.max)
+        features = extract_spectral_features(y, sr, analysis_sr=self._analysis_sample_rate)
+        C = features.cqt
 
         ##########################################################
         # To reduce dimensionality, we'll beat-synchronous the CQT
 
         downbeats = []
 
+        self.__begin_stage('downbeats')
+
         # if we didn't pass in a beat cache then we'll need to do downbeat
         # detection via madmom
 
@@ -224,9 +1869,29 @@ class InfiniteJukebox(object):
     
             self.__report_progress( .3, "Running a high precision beat finding algorithm. This could take up to 2 minutes..." )
     
-            proc = madmom.features.DBNDownBeatTrackingProcessor(beats_per_bar=[3, 4], fps=100)
-            act = madmom.features.RNNDownBeatProcessor()(y)
-            downbeats = proc(act)
+            # madmom's models expect a specific sample rate
+
+            if sr != DOWNBEAT_SAMPLE_RATE:
+                y_downbeats = librosa.resample(y, orig_sr=sr, target_sr=DOWNBEAT_SAMPLE_RATE, res_type='polyphase')
+            else:
+                y_downbeats = y
+
+            with DOWNBEAT_PROCESSORS.acquire() as (rnn, dbn, setup_seconds):
+                self.downbeat_setup_seconds = setup_seconds
+                self.__add_log("downbeat processor setup took {:.3f}s".format(setup_seconds))
+
+                if self._downbeat_chunk_seconds and self.duration > self._downbeat_chunk_seconds:
+                    act = chunked_downbeat_activations(y_downbeats, DOWNBEAT_SAMPLE_RATE,
+                                                       self._downbeat_chunk_seconds,
+                                                       self._downbeat_chunk_overlap,
+                                                       workers=self._downbeat_workers,
+                                                       rnn=rnn)
+                else:
+                    act = rnn(y_downbeats)
+
+                downbeats = dbn(act)
+
+            del y_downbeats, act
         else:
             # the rest of this code expects downbeats to be a 2d numpy array of
             # [beat_time_in_sec, bar_position]
@@ -234,31 +1899,75 @@ class InfiniteJukebox(object):
            self.__report_progress( .3, "Using local beat cache for this file..." )
            downbeats = np.array( [[beat['start'], beat['bar_position']] for beat in self._starting_beat_cache] )
 
-        btz = librosa.time_to_frames(downbeats[:,0], sr=sr)
+        btz = librosa.time_to_frames(downbeats[:,0], sr=features.sr, hop_length=features.hop_length)
 
         Csync = librosa.util.sync(C, btz, aggregate=np.median)
-
-        self.tempo = librosa.beat.tempo(y, sr)
+        Msync = librosa.util.sync(features.mfcc, btz)
 
         # For alignment purposes, we'll need the timing of the beats
         # we fix_frames to include non-beat frames 0 and C.shape[1] (final frame)
-        beat_times = librosa.frames_to_time(librosa.util.fix_frames(btz,
-                                                                    x_min=0,
-                                                                    x_max=C.shape[1]),
-                                                                    sr=sr)
+        boundaries = librosa.util.fix_frames(btz, x_min=0, x_max=C.shape[1])
+        beat_times = librosa.frames_to_time(boundaries, sr=features.sr, hop_length=features.hop_length)
+
+        # the frames are only as fine as the analysis rate's hop (~23ms at 22050Hz),
+        # but the beat times are where raw_audio gets cut up for playback -- so the
+        # boundaries that are beats get madmom's own times back, rather than their
+        # frame's
+
+        beat_times = beats_to_times(boundaries, beat_times, btz, downbeats[:,0])
+
+        # Beat-align the amplitudes
+
+        self.__begin_stage('amplitudes')
+
+        ampSync = librosa.util.sync(features.rms, btz)
+
+        return {'beat_frames': np.asarray(btz),
+                'beat_times': beat_times,
+                'downbeats': np.asarray(downbeats),
+                'chroma': Csync,
+                'mfcc': Msync,
+                'amplitudes': ampSync[0],
+                'tempo': np.asarray(features.tempo)}
+
+    def __eigenvectors(self, features):
+
+        """ Builds the Laplacian out of the beat-synchronous features, and returns the
+            (median filtered) eigenvectors the clustering works from. """
+
+        Csync = features['chroma']
+        Msync = features['mfcc']
 
         self.__report_progress( .4, "building recurrence matrix..." )
+
+        self.__begin_stage('recurrence')
         #####################################################################
         # Let's build a weighted recurrence matrix using beat-synchronous CQT
         # (Equation 1)
         # width=3 prevents links within the same bar
         # mode='affinity' here implements S_rep (after Eq. 8)
-        R = librosa.segment.recurrence_matrix(Csync, width=3, mode='affinity',
-                                              sym=True)
+        #
+        # For long tracks, every one of the n x n matrices from here down to the
+        # Laplacian gets built as a scipy.sparse matrix instead, with a fixed number
+        # of neighbors per beat -- so memory grows linearly with the beat count.
+
+        sparse = self.__use_sparse_affinity(Csync.shape[1])
+
+        if sparse:
+            R = librosa.segment.recurrence_matrix(Csync, k=self._sparse_affinity_neighbors, width=3,
+                                                  mode='affinity', sym=True, sparse=True)
+
+            # Enhance diagonals with a median filter (Equation 2)
+            Rf = sparse_diagonal_median_filter(R, size=7)
+        else:
+            R = librosa.segment.recurrence_matrix(Csync, width=3, mode='affinity',
+                                                  sym=True)
 
-        # Enhance diagonals with a median filter (Equation 2)
-        df = librosa.segment.timelag_filter(scipy.ndimage.median_filter)
-        Rf = df(R, size=(1, 7))
+            # Enhance diagonals with a median filter (Equation 2)
+            df = librosa.segment.timelag_filter(scipy.ndimage.median_filter)
+            Rf = df(R, size=(1, 7))
+
+        del R
 
 
         ###################################################################
@@ -268,240 +1977,205 @@ class InfiniteJukebox(object):
         #
         # Here, we take :math:`\sigma` to be the median distance between successive beats.
         #
-        mfcc = librosa.feature.mfcc(y=y, sr=sr)
-        Msync = librosa.util.sync(mfcc, btz)
 
         path_distance = np.sum(np.diff(Msync, axis=1)**2, axis=0)
         sigma = np.median(path_distance)
         path_sim = np.exp(-path_distance / sigma)
 
-        R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
+        if sparse:
+            R_path = scipy.sparse.diags([path_sim, path_sim], [1, -1], format='csr')
+        else:
+            R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
 
 
         ##########################################################
         # And compute the balanced combination (Equations 6, 7, 9)
 
-        deg_path = np.sum(R_path, axis=1)
-        deg_rec = np.sum(Rf, axis=1)
+        deg_path = np.asarray(R_path.sum(axis=1)).ravel()
+        deg_rec = np.asarray(Rf.sum(axis=1)).ravel()
 
         mu = deg_path.dot(deg_path + deg_rec) / np.sum((deg_path + deg_rec)**2)
 
         A = mu * Rf + (1 - mu) * R_path
 
+        del Rf, R_path
+
         #####################################################
         # Now let's compute the normalized Laplacian (Eq. 10)
         L = scipy.sparse.csgraph.laplacian(A, normed=True)
 
 
-        # and its spectral decomposition
-        _, evecs = scipy.linalg.eigh(L)
-
-
-        # We can clean this up further with a median filter.
-        # This can help smooth over small discontinuities
-        evecs = scipy.ndimage.median_filter(evecs, size=(9, 1))
-
-
-        # cumulative normalization is needed for symmetric normalize laplacian eigenvectors
-        Cnorm = np.cumsum(evecs**2, axis=1)**0.5
-
-        self.__report_progress( .5, "clustering..." )
-
-        # if a value for clusters wasn't passed in, then we need to auto-cluster
-
-        if self.clusters == 0:
-            self.clusters, seg_ids = self.__compute_best_cluster_with_sil(evecs, Cnorm)
-
-        else: # otherwise, just use the cluster value passed in
-            k = self.clusters
+        # and its spectral decomposition. We only ever look at the first 48 (or
+        # self.clusters) eigenvectors, so for long tracks only compute those. (Always
+        # at least 48, so that the cached ones work for any cluster count.)
 
-            self.__report_progress( .51, "using " + str(self.clusters) + " clusters..." )
+        self.__begin_stage('eigenvectors')
 
-            X = evecs[:, :k] / Cnorm[:, k-1:k]
+        n_evecs = max(self.clusters, 48)
 
-            seg_ids = sklearn.cluster.KMeans(n_clusters=k, max_iter=300,
-                                               random_state=0, n_init=20).fit_predict(X)
+        if self.__use_partial_eigensolver(L.shape[0], n_evecs) or scipy.sparse.issparse(L):
+            evals, evecs = smallest_eigenvectors(L, n_evecs)
+        else:
+            evals, evecs = scipy.linalg.eigh(np.asarray(L, dtype=np.float64))
 
-        # Get the amplitudes and beat-align them
-        self.__report_progress( .93, "getting amplitudes" )
+        del A, L
 
-        # newer versions of librosa have renamed the rmse function
+        # each solver is free to return an eigenvector or its negation (or any rotation
+        # of the eigenvectors of a repeated eigenvalue), and KMeans can land on different
+        # clusters for them. Pin them down so that the clusters don't depend on which
+        # solver we used.
 
-        if hasattr(librosa.feature,'rms'):
-            amplitudes = librosa.feature.rms(y=y)
-        else:
-            amplitudes = librosa.feature.rmse(y=y)
+        evecs = evecs[:, :n_evecs]
 
-        ampSync = librosa.util.sync(amplitudes, btz)
+        fix_degenerate_eigenvectors(evals, evecs)
 
-        # create a list of tuples that include the ordinal position, the start time of the beat,
-        # the cluster to which the beat belongs, the mean amplitude of the beat, and the position
-        # of the beat in its bar.
+        evecs = fix_eigenvector_signs(evecs)
 
-        zbeat_tuples = zip(range(0,len(btz)), beat_times, 
-                           seg_ids, ampSync[0].tolist(), 
-                           downbeats[:,1])
 
-        beat_tuples =tuple(zbeat_tuples)
+        # We can clean this up further with a median filter.
+        # This can help smooth over small discontinuities
+        evecs = scipy.ndimage.median_filter(evecs, size=(9, 1))
 
-        info = []
+        return {'evecs': evecs}
 
-        bytes_per_second = len(self.raw_audio) / self.duration
+    def play_path(self, first_beat=0):
 
-        last_cluster = -1
-        current_segment = -1
-        segment_beat = 0
+        """ Returns a generator that yields an endless remix of this song, one
+            play_vector style item at a time. Every call starts a fresh remix, from
+            first_beat -- e.g. to pick up from wherever the song's already been
+            played up to.
+        """
 
-        for i in range(0, len(beat_tuples)):
-            final_beat = {}
-            final_beat['start'] = float(beat_tuples[i][1])
-            final_beat['cluster'] = int(beat_tuples[i][2])
-            final_beat['amplitude'] = float(beat_tuples[i][3])
-            final_beat['bar_position'] = int(beat_tuples[i][4])
+        return InfiniteJukebox.GeneratePlayPathFromBeatsMadmom(self.beats, start_beat = self._loop_bounds_begin,
+                                                               first_beat = first_beat)
 
-            if final_beat['cluster'] != last_cluster:
-                current_segment += 1
-                segment_beat = 0
-            else:
-                segment_beat += 1
+    @property
+    def crossfades(self):
 
-            final_beat['segment'] = current_segment
-            final_beat['is'] = segment_beat
+        """ The JumpCrossfades for this song's jumps, computed on first use. """
 
-            last_cluster = final_beat['cluster']
+        if self._crossfades is None:
+            with self.__timer.stage('crossfades'):
+                self._crossfades = JumpCrossfades(self.beats, self.raw_audio, self.sample_rate,
+                                                  fade_seconds = self._crossfade_seconds,
+                                                  max_bytes = self._crossfade_max_bytes)
+        return self._crossfades
 
-            if i == len(beat_tuples) - 1:
-                final_beat['duration'] = self.duration - final_beat['start']
-            else:
-                final_beat['duration'] = beat_tuples[i+1][1] - beat_tuples[i][1]
+    def to_analysis(self):
 
-            final_beat['start_index'] = int(final_beat['start'] * bytes_per_second)
-            final_beat['stop_index'] = int( (final_beat['start'] + final_beat['duration']) * bytes_per_second )
+        """ Returns the results of the processing as a JukeboxAnalysis, which can be
+            cheaply sent to another process. """
 
-            # save pointers to the raw bytes for each beat with each beat.
-            final_beat['buffer'] = self.raw_audio[ final_beat['start_index'] : final_beat['stop_index'] ]
+        return JukeboxAnalysis(self)
 
-            info.append(final_beat)
+    @property
+    def play_vector(self):
 
-        self.__report_progress( .93, "truncating to fade point..." )
+        """ The first play_vector_length items of a play path, computed on first use. """
 
-        # get the max amplitude of the beats
-        # max_amplitude = max([float(b['amplitude']) for b in info])
-        max_amplitude = sum([float(b['amplitude']) for b in info]) / len(info)
+        if self._play_vector is None:
+            with self.__timer.stage('play_vector'):
+                self._play_vector = InfiniteJukebox.CreatePlayVectorFromBeatsMadmom(self.beats,
+                                                                                    start_beat = self._loop_bounds_begin,
+                                                                                    length = self._play_vector_length)
+        return self._play_vector
 
-        # assume that the fade point of the song is the last beat of the song that is >= 75% of
-        # the max amplitude.
+    def __analysis_cache_keys(self):
 
-        self.max_amplitude = max_amplitude
+        """ Returns the analysis cache keys for the beat-synchronous features, the
+            eigenvectors and the finished analysis, in that order. Each is made from the
+            one before it plus the constructor args that can change that stage, so (say)
+            changing only the clustering args still finds the eigenvectors. Args that
+            only change how fast we get there (like cluster_workers) are left out, so
+            they still share entries.
+        """
 
-        fade = len(info) - 1
+        features_key = self._analysis_cache.key(self.raw_audio,
+                                                {'sample_rate': self._sample_rate,
+                                                 'analysis_sample_rate': self._analysis_sample_rate,
+                                                 'downbeat_chunk_seconds': self._downbeat_chunk_seconds,
+                                                 'downbeat_chunk_overlap': self._downbeat_chunk_overlap},
+                                                digest=self.__audio_digest)
 
-        for b in reversed(info):
-            if b['amplitude'] >= (.75 * max_amplitude):
-                fade = info.index(b)
-                break
+        eigenvectors_key = self._analysis_cache.derive(features_key,
+                                                       {'eigenvectors': max(self.clusters, 48),
+                                                        'eigen_solver': self._eigen_solver,
+                                                        'partial_eigen_threshold': self._partial_eigen_threshold,
+                                                        'sparse_affinity': self._sparse_affinity,
+                                                        'sparse_affinity_threshold': self._sparse_affinity_threshold,
+                                                        'sparse_affinity_neighbors': self._sparse_affinity_neighbors})
 
-        # truncate the beats to [start:fade + 1]
-        beats = info[self.__start_beat:fade + 1]
+        analysis_key = self._analysis_cache.derive(eigenvectors_key,
+                                                   {'clusters': self.clusters,
+                                                    'use_v1': self._use_v1,
+                                                    'cluster_search': self._cluster_search,
+                                                    'cluster_search_stride': self._cluster_search_stride,
+                                                    'shared_distances': self._shared_distances,
+                                                    'silhouette_sample_size': self._silhouette_sample_size,
+                                                    'silhouette_sample_threshold': self._silhouette_sample_threshold})
 
-        loop_bounds_begin = self.__start_beat
+        return features_key, eigenvectors_key, analysis_key
 
-        self.__report_progress( .93, "computing final beat array..." )
+    def __silhouette_sample_size(self, beat_count):
 
-        # assign final beat ids
-        for beat in beats:
-            beat['id'] = beats.index(beat)
-            beat['quartile'] = beat['id'] // (len(beats) / 4.0)
+        ''' How many beats the shared silhouette distances are computed over (None for all of them) '''
 
-        # compute a coherent 'next' beat to play. This is always just the next ordinal beat
-        # unless we're at the end of the song. Then it gets a little trickier.
+        if self._silhouette_sample_size == 'auto':
+            if beat_count > self._silhouette_sample_threshold:
+                return self._silhouette_sample_threshold
+            return None
 
-        for beat in beats:
-            if beat == beats[-1]:
+        return self._silhouette_sample_size
 
-                # if we're at the last beat, then we want to find a reasonable 'next' beat to play. It should (a) share the
-                # same cluster, (b) be in a logical place in its measure, (c) be after the computed loop_bounds_begin, and
-                # is in the first half of the song. If we can't find such an animal, then just return the beat
-                # at loop_bounds_begin
+    def __use_sparse_affinity(self, beat_count):
 
-                beat['next'] = next( (b['id'] for b in beats if b['cluster'] == beat['cluster'] and
-                                      b['id'] % 4 == (beat['id'] + 1) % 4 and
-                                      b['id'] <= (.5 * len(beats)) and
-                                      b['id'] >= loop_bounds_begin), loop_bounds_begin )
-            else:
-                beat['next'] = beat['id'] + 1
+        ''' Decides whether to build the affinity matrices and Laplacian as sparse matrices '''
 
-            # find all the beats that (a) are in the same cluster as the NEXT oridnal beat, (b) are of the same
-            # cluster position as the next ordinal beat, (c) are in the same place in the measure as the NEXT beat,
-            # (d) but AREN'T the next beat, (e) AREN'T in the same cluster as the current beat, AND
-            # (f) are more than 7 beats away (to minimize weird local loops)
-            #
-            # THAT collection of beats contains our jump candidates
-
-            jump_candidates = [bx['id'] for bx in beats[loop_bounds_begin:] if
-                               (bx['cluster'] == beats[beat['next']]['cluster']) and
-                               (bx['is'] == beats[beat['next']]['is']) and
-                               (bx['bar_position'] == beats[beat['next']]['bar_position']) and
-                               (bx['segment'] != beat['segment']) and
-                               (bx['id'] != beat['next']) and
-                               (abs(bx['id'] - beats[beat['next']]['id']) > 7)]
-
-            if jump_candidates:
-                beat['jump_candidates'] = jump_candidates
-            else:
-                beat['jump_candidates'] = []
+        # the neighbor count has to leave room for the width=3 band that
+        # recurrence_matrix excludes
 
-        # save off the segment count
+        if beat_count <= self._sparse_affinity_neighbors + 2 * 3:
+            return False
 
-        self.segments = max([b['segment'] for b in beats]) + 1
+        if self._sparse_affinity == 'auto':
+            return beat_count > self._sparse_affinity_threshold
 
-        # we don't want to ever play past the point where it's impossible to loop,
-        # so let's find the latest point in the song where there are still jump
-        # candidates and make sure that we can't play past it.
+        return bool(self._sparse_affinity)
 
-        last_chance = len(beats) - 1
+    def __use_partial_eigensolver(self, beat_count, n_evecs):
 
-        for b in reversed(beats):
-            if len(b['jump_candidates']) > 0:
-                last_chance = beats.index(b)
-                break
+        ''' Decides whether to use smallest_eigenvectors() or a full dense eigh() '''
 
-        # if we play our way to the last beat that has jump candidates, then just skip
-        # to the earliest jump candidate rather than enter a section from which no
-        # jumping is possible.
+        # eigsh needs the number of eigenvectors to be less than the matrix size
 
-        beats[last_chance]['next'] = min(beats[last_chance]['jump_candidates'])
+        if beat_count <= n_evecs + 1:
+            return False
 
-        # store the beats that start after the last jumpable point. That's
-        # the outro to the song. We can use these
-        # beasts to create a sane ending for a fixed-length remix
+        if self._eigen_solver == 'partial':
+            return True
 
-        outro_start = last_chance + 1 + self.__start_beat
+        if self._eigen_solver == 'dense':
+            return False
 
-        if outro_start >= len(info):
-            self.outro = []
-        else:
-            self.outro = info[outro_start:]
+        return beat_count > self._partial_eigen_threshold
 
-        #
-        # This section of the code computes the play_vector -- a 1024*1024 beat length
-        # remix of the current song.
-        #
+    def __begin_stage(self, stage):
 
-        self.__report_progress(0.95, "creating play vector")
+        """ Checks whether we've been cancelled, then starts timing the next stage. """
 
-        play_vector = InfiniteJukebox.CreatePlayVectorFromBeatsMadmom(beats, start_beat = loop_bounds_begin)
+        self.__check_cancelled()
+        self.__timer.start(stage)
 
-        # save off the beats array and play_vector. Signal
-        # the play_ready event (if it's been set)
+    def __check_cancelled(self):
 
-        self.beats = beats
-        self.play_vector = play_vector
+        """ Raises AnalysisCancelled if the cancel token has been cancelled or the
+            deadline has passed. """
 
-        self.__report_progress(1.0, "finished processing")
+        if self._cancel_token is not None and self._cancel_token.cancelled:
+            raise AnalysisCancelled(self._cancel_token.reason or "cancelled")
 
-        if self.play_ready:
-            self.play_ready.set()
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise AnalysisCancelled("deadline exceeded")
 
     def __report_progress(self, pct_done, message):
 
@@ -565,111 +2239,126 @@ class InfiniteJukebox(object):
 
         self._clusters_list = []
 
-        best_cluster_size = 0
-        best_labels = None
-        best_cluster_score = 0
-
         # we need at least 3 clusters for any song and shouldn't need to calculate more than
         # 48 clusters for even a really complicated peice of music.
 
         cluster_ratio_map = []
         cluster_ratio_map.append(['Clusters', 'AVG(sil)', 'MIN(seg_len)', 'Ratio', 'Cluster Score'])
 
-        for n_clusters in range(48, 3, -1):
+        # every cluster count we've tried so far, mapped to its (cluster_score, labels)
 
-            report_pct = .95 - (n_clusters/100.00)
-            self.__report_progress(round(report_pct,2), "Testing a cluster value of %d..." % n_clusters)
+        evaluated = {}
 
-            # compute a matrix of the Eigen-vectors / their normalized values
-            X = evecs[:, :n_clusters] / Cnorm[:, n_clusters-1:n_clusters]
+        # the most fits we'll possibly do, so the progress percentage never goes backwards
 
-            # create the candidate clusters and fit them
+        stride = max(2, self._cluster_search_stride)
+        budget = self.__cluster_search_budget(stride)
 
-            cluster_labels = sklearn.cluster.KMeans(n_clusters=n_clusters, 
-                                                    max_iter=600,
-                                                    random_state=10, 
-                                                    n_init=10).fit_predict(X)
+        # the silhouette scores for every candidate are computed from one set of pairwise
+        # distances that gets updated as we go, rather than from scratch each time. That
+        # takes two n x n buffers for the whole search, so long tracks only put a sample
+        # of their beats in it. The sparse path is meant to take memory in proportion to
+        # the beat count, so unless it's sampling, it skips the cache and lets sklearn
+        # compute each silhouette a chunk of distances at a time.
 
-            # get some key statistics, including how well each beat in the cluster resemble
-            # each other (the silhouette average), the ratio of segments to clusters, and the
-            # length of the smallest segment in this cluster configuration
+        distance_cache = None
 
-            silhouette_avg = sklearn.metrics.silhouette_score(X, cluster_labels)
+        beat_count = len(evecs)
+        sample_size = self.__silhouette_sample_size(beat_count)
+        sampled = sample_size is not None and sample_size < beat_count
 
-            ratio, min_segment_len = self.__segment_stats_from_labels(cluster_labels.tolist())
+        if self._shared_distances and (sampled or not self.__use_sparse_affinity(beat_count)):
+            distance_cache = PairwiseDistanceCache(evecs[:, :48], Cnorm[:, :48], sample_size=sample_size)
 
-            # We need to grade each cluster according to how likely it is to produce a good
-            # result. There are a few factors to look at.
-            #
-            # First, we can look at how similar the beats in each cluster (on average) are for
-            # this candidate cluster size. This is known as the silhouette score. It ranges
-            # from -1 (very bad) to 1 (very good).
-            #
-            # Another thing we can look at is the ratio of clusters to segments. Higher ratios
-            # are preferred because they afford each beat in a cluster the opportunity to jump
-            # around to meaningful places in the song.
-            #
-            # All other things being equal, we prefer a higher cluster count to a lower one
-            # because it will tend to make the jumps more selective -- and therefore higher
-            # quality.
-            #
-            # Lastly, if we see that we have segments equal to just one beat, that might be
-            # a sign of overfitting. We call these one beat segments 'orphans'. Some songs,
-            # however, will have orphans no matter what cluster count you use. So, we don't
-            # want to throw out a cluster count just because it has orphans. Instead, we
-            # just de-rate its fitness score. If most of the cluster candidates have orphans
-            # then this won't matter in the overall scheme because everyone will be de-rated
-            # by the same scaler.
-            #
-            # Putting this all together, we muliply the cluster count * the average
-            # silhouette score for the clusters in this candidate * the ratio of clusters to
-            # segments. Then we scale (or de-rate) the fitness score by whether or not is has
-            # orphans in it.
+        def evaluate(candidates):
+
+            # fits every candidate we haven't tried yet and yields their cluster scores in order
+
+            candidates = [k for k in candidates if 4 <= k <= 48 and k not in evaluated]
+
+            # the candidates are fit (possibly in parallel), but their results always come
+            # back in this order so that ties are broken exactly the same way every time.
 
-            orphan_scaler = .5 if min_segment_len == 1 else 1
+            fitted = self.__fit_cluster_candidates(evecs, Cnorm, candidates, score=distance_cache is None)
 
-            #cluster_score = n_clusters * silhouette_avg * ratio * orphan_scaler
-            
-            # NOTE: Removing the effects of the orphan_scaler for now because it seems
-            #       to be doing more harm than good.
+            for n_clusters, (cluster_labels, silhouette_avg) in zip(candidates, fitted):
 
-            # NOTE: I'm playing with different fitness functions. As in all machine learning,
-            # this has become the hardest bit.
+                report_pct = .5 + (.4 * min(len(evaluated), budget) / budget)
+                self.__report_progress(round(report_pct,2), "Testing a cluster value of %d..." % n_clusters)
 
-            # My first thought was simply to choose the largest clustering that had a 
-            # ratio > 3, an average silhouette score > .5, and no orphans. That didn't
-            # quite produce the outcome I wanted
+                if silhouette_avg is None:
+                    sample_labels = cluster_labels if distance_cache.sample is None else cluster_labels[distance_cache.sample]
+                    silhouette_avg = silhouette_from_distances(distance_cache.distances(n_clusters), sample_labels)
 
-            # cluster_score = n_clusters if (ratio >= 3.0 and silhouette_avg > .5 and min_segment_len > 1) else 0
+                cluster_score, row = self.__score_cluster_candidate(n_clusters, cluster_labels, silhouette_avg)
 
-            # My next attempt is to compute a composite score of the number of clusters 
-            # plus a scaled value of the silhouette average plus the minimum segment length.
-            # So far this is producing a better result, but I think I need to compute and 
-            # account for the maximum segment lengths, too.
+                # I'm keeping track of the basic statistics per cluster value tested so I can
+                # print them at the end of the evaluation in the hopes of discovering the optimal
+                # general fitness function.
 
-            cluster_score = 0.0
+                cluster_ratio_map.append(row)
 
-            if ( ratio >= 3.0 and silhouette_avg > .5 ):
-                cluster_score = n_clusters + \
-                                (10.0 * silhouette_avg) + \
-                                min(min_segment_len, 8) + \
-                                ratio
+                evaluated[n_clusters] = (cluster_score, cluster_labels)
 
-            # I'm keeping track of the basic statistics per cluster value tested so I can
-            # print them at the end of the evaluation in the hopes of discovering the optimal
-            # general fitness function.
+                yield n_clusters, cluster_score
 
-            cluster_ratio_map.append([n_clusters, round(silhouette_avg * 100, 2), min_segment_len, round(ratio,4), round(cluster_score,4)])
+        def best_so_far():
 
-            # if this cluster count has a score that's better than the best score so far, store
-            # it for later.
+            # the highest scoring cluster count. Ties go to the smaller cluster count, which
+            # is what the exhaustive search has always done.
 
-            if cluster_score >= best_cluster_score:
-                best_cluster_score = cluster_score
-                best_cluster_size = n_clusters
-                best_labels = cluster_labels
+            return max(evaluated, key=lambda k: (evaluated[k][0], -k))
 
-        self.cluster_ratio_log = {'best_cluster_size': best_cluster_size, 'cluster_scores': cluster_ratio_map}
+        if self._cluster_search == 'coarse':
+
+            # scores tend to climb smoothly with the cluster count, right up until the
+            # segment/cluster ratio drops below 3 and they collapse to 0. So walk up the
+            # cluster counts in big strides, and stop once the scores have collapsed ...
+
+            collapsed = 0
+            found_any = False
+
+            for n_clusters, cluster_score in evaluate(range(4, 49, stride)):
+                if cluster_score > 0:
+                    found_any = True
+                    collapsed = 0
+                elif found_any:
+                    collapsed += 1
+                    if collapsed >= 2:
+                        break
+
+            # ... then narrow in on the best region we found, halving the step each time
+
+            step = stride // 2
+
+            while step >= 1:
+                best = best_so_far()
+                list(evaluate([best - step, best + step]))
+                step //= 2
+
+        else:
+            list(evaluate(range(48, 3, -1)))
+
+        best_cluster_size = best_so_far()
+        best_cluster_score, best_labels = evaluated[best_cluster_size]
+
+        self.cluster_ratio_log = {'best_cluster_size': best_cluster_size,
+                                  'cluster_scores': cluster_ratio_map,
+                                  'search_strategy': self._cluster_search,
+                                  'evaluated': len(evaluated)}
+
+        # if asked to, see how far we landed from what the exhaustive search would have
+        # picked. Anything we already fit gets reused, so this only fits what's left.
+
+        if self._verify_cluster_search and self._cluster_search != 'exhaustive':
+            list(evaluate(range(48, 3, -1)))
+
+            exhaustive_size = best_so_far()
+            exhaustive_score = evaluated[exhaustive_size][0]
+
+            self.cluster_ratio_log['exhaustive_best_cluster_size'] = exhaustive_size
+            self.cluster_ratio_log['cluster_size_delta'] = best_cluster_size - exhaustive_size
+            self.cluster_ratio_log['cluster_score_ratio'] = (best_cluster_score / exhaustive_score) if exhaustive_score else 1.0
 
         # print a nice table of the cluster metrics I stored in each iteration
         for cr in cluster_ratio_map:
@@ -677,12 +2366,131 @@ class InfiniteJukebox(object):
             msg = "{:<10} {:<10} {:<15} {:<8} {:<15}".format(c,sa,msl,r,cs)
             print(msg)
    
-        msg = "Selected best cluster size of: {}".format(best_cluster_size)
+        msg = "Selected best cluster size of: {} ({} cluster values tested)".format(best_cluster_size, self.cluster_ratio_log['evaluated'])
         print (msg)
 
+        if 'exhaustive_best_cluster_size' in self.cluster_ratio_log:
+            print("Exhaustive search would have selected: {}".format(self.cluster_ratio_log['exhaustive_best_cluster_size']))
+
         # return the best results
         return (best_cluster_size, best_labels)
 
+    def __cluster_search_budget(self, stride):
+
+        ''' The most cluster counts that the current search strategy will ever fit '''
+
+        if self._cluster_search != 'coarse':
+            return len(range(48, 3, -1))
+
+        budget = len(range(4, 49, stride))
+        step = stride // 2
+
+        while step >= 1:
+            budget += 2
+            step //= 2
+
+        return budget
+
+    def __score_cluster_candidate(self, n_clusters, cluster_labels, silhouette_avg):
+
+        ''' Grades one candidate cluster count. Returns its cluster score along with a
+            row for the cluster_ratio_map table.
+        '''
+
+        # get some key statistics, including how well each beat in the cluster resemble
+        # each other (the silhouette average), the ratio of segments to clusters, and the
+        # length of the smallest segment in this cluster configuration
+
+        ratio, min_segment_len = self.__segment_stats_from_labels(cluster_labels.tolist())
+
+        # We need to grade each cluster according to how likely it is to produce a good
+        # result. There are a few factors to look at.
+        #
+        # First, we can look at how similar the beats in each cluster (on average) are for
+        # this candidate cluster size. This is known as the silhouette score. It ranges
+        # from -1 (very bad) to 1 (very good).
+        #
+        # Another thing we can look at is the ratio of clusters to segments. Higher ratios
+        # are preferred because they afford each beat in a cluster the opportunity to jump
+        # around to meaningful places in the song.
+        #
+        # All other things being equal, we prefer a higher cluster count to a lower one
+        # because it will tend to make the jumps more selective -- and therefore higher
+        # quality.
+        #
+        # Lastly, if we see that we have segments equal to just one beat, that might be
+        # a sign of overfitting. We call these one beat segments 'orphans'. Some songs,
+        # however, will have orphans no matter what cluster count you use. So, we don't
+        # want to throw out a cluster count just because it has orphans. Instead, we
+        # just de-rate its fitness score. If most of the cluster candidates have orphans
+        # then this won't matter in the overall scheme because everyone will be de-rated
+        # by the same scaler.
+        #
+        # Putting this all together, we muliply the cluster count * the average
+        # silhouette score for the clusters in this candidate * the ratio of clusters to
+        # segments. Then we scale (or de-rate) the fitness score by whether or not is has
+        # orphans in it.
+
+        orphan_scaler = .5 if min_segment_len == 1 else 1
+
+        #cluster_score = n_clusters * silhouette_avg * ratio * orphan_scaler
+        
+        # NOTE: Removing the effects of the orphan_scaler for now because it seems
+        #       to be doing more harm than good.
+
+        # NOTE: I'm playing with different fitness functions. As in all machine learning,
+        # this has become the hardest bit.
+
+        # My first thought was simply to choose the largest clustering that had a 
+        # ratio > 3, an average silhouette score > .5, and no orphans. That didn't
+        # quite produce the outcome I wanted
+
+        # cluster_score = n_clusters if (ratio >= 3.0 and silhouette_avg > .5 and min_segment_len > 1) else 0
+
+        # My next attempt is to compute a composite score of the number of clusters 
+        # plus a scaled value of the silhouette average plus the minimum segment length.
+        # So far this is producing a better result, but I think I need to compute and 
+        # account for the maximum segment lengths, too.
+
+        cluster_score = 0.0
+
+        if ( ratio >= 3.0 and silhouette_avg > .5 ):
+            cluster_score = n_clusters + \
+                            (10.0 * silhouette_avg) + \
+                            min(min_segment_len, 8) + \
+                            ratio
+
+        return cluster_score, [n_clusters, round(silhouette_avg * 100, 2), min_segment_len, round(ratio,4), round(cluster_score,4)]
+
+    def __fit_cluster_candidates(self, evecs, Cnorm, candidates, score=True):
+
+        ''' Fits KMeans for each of the candidate cluster counts and yields their
+            (labels, silhouette average) in the same order as the candidates. If score
+            is False, the silhouette averages are None.
+
+            If cluster_workers > 1, the fits are spread over a thread or process pool
+            (see cluster_executor(), which keeps it for the next song).
+        '''
+
+        jobs = [(evecs[:, :n_clusters], Cnorm[:, :n_clusters], n_clusters, score) for n_clusters in candidates]
+
+        if self._cluster_workers <= 1:
+            for job in jobs:
+                self.__check_cancelled()
+                yield _fit_cluster_candidate(*job)
+            return
+
+        pool = cluster_executor(self._cluster_pool, self._cluster_workers)
+
+        futures = [pool.submit(_fit_cluster_candidate, *job) for job in jobs]
+        try:
+            for future in futures:
+                self.__check_cancelled()
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
     @staticmethod
     def __segment_count_from_labels(labels):
 
@@ -730,16 +2538,49 @@ class InfiniteJukebox(object):
 
         self._extra_diag += line + "\n"
 
-    def CreatePlayVectorFromBeatsMadmom(beats, start_beat = 0):
+    def CreatePlayVectorFromBeatsMadmom(beats, start_beat = 0, length = PLAY_VECTOR_LENGTH):
 
         #
         # This section of the code computes the play_vector -- a 1024*1024 beat length
-        # remix of the current song.
+        # remix of the current song. It's just the first `length` steps of the
+        # (endless) play path, so prefer GeneratePlayPathFromBeatsMadmom() if you
+        # don't actually need the whole thing in memory at once.
         #
 
-        print("CreatePlayVectorFromBeatsMadmom")
+        play_path = InfiniteJukebox.GeneratePlayPathFromBeatsMadmom(beats, start_beat = start_beat)
+
+        return np.fromiter(itertools.islice(play_path, length), dtype=PLAY_STEP_DTYPE, count=length)
+
+    @staticmethod
+    def GeneratePlayPathFromBeatsMadmom(beats, start_beat = 0, first_beat = 0):
+
+        """ Lazily generates an endless remix of the song, one play step at a time.
+
+            This walks exactly the same jump / recent-segment logic that used to fill
+            play_vector up front, but only does the work for the steps you actually
+            consume. Each step is a PlayStep with the 'beat', 'seq_len' and 'seq_pos'
+            keys described in the class docs.
+
+            beats can be a BeatTable or a list of beat dicts. The remix starts at
+            first_beat, and start_beat is where it starts over from if it gets stuck.
+        """
+
+        if not isinstance(beats, BeatTable):
+            beats = BeatTable.from_dicts(beats)
 
         random.seed()
+
+        # pull the columns we need out as plain lists. Indexing those is a lot
+        # cheaper than indexing numpy arrays one element at a time.
+
+        bar_position = beats.column('bar_position').tolist()
+        segment = beats.column('segment').tolist()
+        quartile = beats.column('quartile').tolist()
+        next_beat = beats.column('next').tolist()
+
+        jump_offsets = beats.jump_offsets.tolist()
+        jump_indices = beats.jump_indices.tolist()
+
         duration = beats[-1]['start'] + beats[-1]['duration']
         tempo = (len(beats)/duration) * 60
 
@@ -750,7 +2591,7 @@ class InfiniteJukebox(object):
         # for popular music. Find that value and round down to the nearest
         # multiple of 4. (There almost always are 4 beats per measure in Western music).
 
-        beats_per_bar = max([ b['bar_position'] for b in beats ])
+        beats_per_bar = max(bar_position)
 
         max_sequence_len = int(round((tempo / 120.0) * 48.0))
         max_sequence_len = max_sequence_len - (max_sequence_len % 4)
@@ -762,14 +2603,12 @@ class InfiniteJukebox(object):
 
         # min_sequence = max(random.randrange(16, max_sequence_len, 4), start_beat) + 1
 
-        min_sequence = random.choice(acceptable_jump_amounts) - (beats[1]['bar_position'] + 2)
+        min_sequence = random.choice(acceptable_jump_amounts) - (bar_position[min(first_beat + 1, len(beats) - 1)] + 2)
 
         current_sequence = 0
-        beat = beats[0]
-
-        play_vector = []
+        beat = first_beat
 
-        play_vector.append( {'beat':0, 'seq_len':min_sequence, 'seq_pos':current_sequence} )
+        yield PlayStep(first_beat, min_sequence, current_sequence)
 
         # we want to keep a list of recently played segments so we don't accidentally wind up in a local loop
         #
@@ -779,7 +2618,7 @@ class InfiniteJukebox(object):
         #
         # On the off chance that the (# of segments) *.25 < 1 we set a floor queue depth of 1
 
-        segments = max([b['segment'] for b in beats]) + 1
+        segments = max(segment) + 1
 
         recent_depth = int(round(segments * .25))
         recent_depth = max( recent_depth, 1 )
@@ -798,10 +2637,10 @@ class InfiniteJukebox(object):
         beats_since_jump = 0
         failed_jumps = 0
 
-        for i in range(0, 1024 * 1024):
+        while True:
 
-            if beat['segment'] not in recent:
-                recent.append(beat['segment'])
+            if segment[beat] not in recent:
+                recent.append(segment[beat])
 
             current_sequence += 1
 
@@ -819,10 +2658,12 @@ class InfiniteJukebox(object):
 
                 # find the jump candidates that haven't been recently played
 
+                jump_candidates = jump_indices[jump_offsets[beat]:jump_offsets[beat + 1]]
+
                 non_recent_candidates = []
 
                 # if beat['bar_position'] == beats_per_bar:
-                non_recent_candidates = [c for c in beat['jump_candidates'] if beats[c]['segment'] not in recent]
+                non_recent_candidates = [c for c in jump_candidates if segment[c] not in recent]
 
                 # if there aren't any good jump candidates, then we need to fall back
                 # to another selection scheme.
@@ -840,16 +2681,16 @@ class InfiniteJukebox(object):
                     # playing section. That way we maximize our chances of avoiding a long local loop -- such as
                     # might be found in the section preceeding the outro of a song.
 
-                    non_quartile_candidates = [c for c in beat['jump_candidates'] if beats[c]['quartile'] != beat['quartile']]
+                    non_quartile_candidates = [c for c in jump_candidates if quartile[c] != quartile[beat]]
 
                     if (failed_jumps >= (.1 * len(beats))) and (len(non_quartile_candidates) > 0):
 
-                        furthest_distance = max([abs(beat['id'] - c) for c in non_quartile_candidates])
+                        furthest_distance = max([abs(beat - c) for c in non_quartile_candidates])
 
                         jump_to = next(c for c in non_quartile_candidates
-                                       if abs(beat['id'] - c) == furthest_distance)
+                                       if abs(beat - c) == furthest_distance)
 
-                        beat = beats[jump_to]
+                        beat = jump_to
                         beats_since_jump = 0
                         failed_jumps = 0
 
@@ -860,14 +2701,14 @@ class InfiniteJukebox(object):
                     elif failed_jumps >= (.3 * len(beats)):
                         beats_since_jump = 0
                         failed_jumps = 0
-                        beat = beats[start_beat]
+                        beat = start_beat
 
                     # asuuming we're not in one of the failure modes but haven't found a good
                     # candidate that hasn't been recently played, just play the next beat in the
                     # sequence
 
                     else:
-                        beat = beats[beat['next']]
+                        beat = next_beat[beat]
 
                 else:
 
@@ -876,7 +2717,7 @@ class InfiniteJukebox(object):
 
                     beats_since_jump = 0
                     failed_jumps = 0
-                    beat = beats[ random.choice(non_recent_candidates) ]
+                    beat = random.choice(non_recent_candidates)
 
                 # reset our sequence position counter and pick a new target length
                 # between 16 and max_sequence_len, making sure it's evenly divisible by
@@ -884,7 +2725,7 @@ class InfiniteJukebox(object):
 
                 current_sequence = 0
 
-                min_sequence = random.choice(acceptable_jump_amounts) - (beat['bar_position'] + 2)
+                min_sequence = random.choice(acceptable_jump_amounts) - (bar_position[beat] + 2)
 
                 # if the beats we'd like to play would make us go longer than
                 # the max number of beats we should go between jumps, then let's
@@ -900,19 +2741,17 @@ class InfiniteJukebox(object):
                 # min_sequence. During playback this will show up as having 00 beats remaining
                 # until we next jump. That's the signal that we'll jump as soon as we possibly can.
                 #
-                # Code that reads play_vector and sees this value can choose to visualize this in some
+                # Code that reads the play path and sees this value can choose to visualize this in some
                 # interesting way.
 
                 if beats_since_jump >= max_beats_between_jumps:
                     current_sequence = min_sequence
 
-                # add an entry to the play_vector
-                play_vector.append({'beat':beat['id'], 'seq_len': min_sequence, 'seq_pos': current_sequence})
+                # emit the next step of the play path
+                yield PlayStep(beat, min_sequence, current_sequence)
             else:
 
-                # if we're not trying to jump then just add the next item to the play_vector
-                play_vector.append({'beat':beat['next'], 'seq_len': min_sequence, 'seq_pos': current_sequence})
-                beat = beats[beat['next']]
+                # if we're not trying to jump then just emit the next beat in the sequence
+                beat = next_beat[beat]
                 beats_since_jump += 1
-
-        return play_vector
\ No newline at end of file
+                yield PlayStep(beat, min_sequence, current_sequence)
@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+
+from loopbot import remixatron
+
+
+def reference_beat_graph(beat_times, seg_ids, amps, bars, duration, bytes_per_second, start_beat):
+    # the end of the original InfiniteJukebox.__process_audio_madmom, O(n^2) per-beat dicts and all
+    beat_tuples = tuple(zip(range(len(beat_times)), beat_times, seg_ids, amps, bars))
+    info = []
+    last_cluster = -1
+    current_segment = -1
+    segment_beat = 0
+    for i in range(0, len(beat_tuples)):
+        final_beat = {}
+        final_beat['start'] = float(beat_tuples[i][1])
+        final_beat['cluster'] = int(beat_tuples[i][2])
+        final_beat['amplitude'] = float(beat_tuples[i][3])
+        final_beat['bar_position'] = int(beat_tuples[i][4])
+        if final_beat['cluster'] != last_cluster:
+            current_segment += 1
+            segment_beat = 0
+        else:
+            segment_beat += 1
+        final_beat['segment'] = current_segment
+        final_beat['is'] = segment_beat
+        last_cluster = final_beat['cluster']
+        if i == len(beat_tuples) - 1:
+            final_beat['duration'] = duration - final_beat['start']
+        else:
+            final_beat['duration'] = beat_tuples[i + 1][1] - beat_tuples[i][1]
+        final_beat['start_index'] = int(final_beat['start'] * bytes_per_second)
+        final_beat['stop_index'] = int((final_beat['start'] + final_beat['duration']) * bytes_per_second)
+        info.append(final_beat)
+
+    max_amplitude = sum([float(b['amplitude']) for b in info]) / len(info)
+    fade = len(info) - 1
+    for b in reversed(info):
+        if b['amplitude'] >= (.75 * max_amplitude):
+            fade = info.index(b)
+            break
+
+    beats = info[start_beat:fade + 1]
+    loop_bounds_begin = start_beat
+    for beat in beats:
+        beat['id'] = beats.index(beat)
+        beat['quartile'] = beat['id'] // (len(beats) / 4.0)
+
+    for beat in beats:
+        if beat == beats[-1]:
+            beat['next'] = next((b['id'] for b in beats if b['cluster'] == beat['cluster'] and
+                                 b['id'] % 4 == (beat['id'] + 1) % 4 and
+                                 b['id'] <= (.5 * len(beats)) and
+                                 b['id'] >= loop_bounds_begin), loop_bounds_begin)
+        else:
+            beat['next'] = beat['id'] + 1
+        beat['jump_candidates'] = [bx['id'] for bx in beats[loop_bounds_begin:] if
+                                   (bx['cluster'] == beats[beat['next']]['cluster']) and
+                                   (bx['is'] == beats[beat['next']]['is']) and
+                                   (bx['bar_position'] == beats[beat['next']]['bar_position']) and
+                                   (bx['segment'] != beat['segment']) and
+                                   (bx['id'] != beat['next']) and
+                                   (abs(bx['id'] - beats[beat['next']]['id']) > 7)]
+
+    segments = max([b['segment'] for b in beats]) + 1
+
+    last_chance = len(beats) - 1
+    for b in reversed(beats):
+        if len(b['jump_candidates']) > 0:
+            last_chance = beats.index(b)
+            break
+    beats[last_chance]['next'] = min(beats[last_chance]['jump_candidates'])
+
+    outro_start = last_chance + 1 + start_beat
+    outro = [] if outro_start >= len(info) else info[outro_start:]
+    return beats, outro, segments, max_amplitude
+
+
+def random_beat_table(seed):
+    rng = np.random.RandomState(seed)
+    n = rng.randint(60, 900)
+    k = rng.randint(3, 20)
+    # runs of beats in the same cluster, like the real thing
+    labels = np.empty(n, dtype=np.int64)
+    c = 0
+    for i in range(n):
+        if rng.rand() < 0.15:
+            c = rng.randint(k)
+        labels[i] = c
+    beat_times = np.concatenate(([0.0], np.sort(rng.uniform(0.1, n * 0.5, n - 1))))
+    # every other table has a quiet outro, so the fade point moves
+    amplitudes = rng.rand(n) * ((np.arange(n) < n * 0.9) if seed % 2 else 1)
+    bar_positions = np.tile(np.arange(1, 5, dtype=float), n)[:n]
+    duration = n * 0.5 + 1
+    start_beat = rng.randint(0, 5)
+    return beat_times, labels, amplitudes, bar_positions, duration, 1000.0, start_beat
+
+
+def without_buffer(beat):
+    return {k: v for k, v in dict(beat).items() if k != 'buffer'}
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_reference(seed):
+    args = random_beat_table(seed)
+    try:
+        expected_beats, expected_outro, expected_segments, expected_amplitude = reference_beat_graph(*args)
+    except ValueError:
+        # the original raises if no beat has any jump candidates
+        with pytest.raises(ValueError):
+            remixatron.build_beat_graph(*args)
+        return
+
+    graph = remixatron.build_beat_graph(*args)
+
+    assert [without_buffer(b) for b in graph.beats] == expected_beats
+    assert [without_buffer(b) for b in graph.outro] == expected_outro
+    assert graph.segments == expected_segments
+    assert graph.max_amplitude == expected_amplitude
+
+
+def test_buffers_point_into_audio():
+    beat_times, labels, amplitudes, bar_positions, duration, _, start_beat = random_beat_table(0)
+    audio = np.arange(int(duration * 1000) * 2, dtype=np.int16).reshape(-1, 2)
+    graph = remixatron.build_beat_graph(beat_times, labels, amplitudes, bar_positions, duration,
+                                        len(audio) / duration, start_beat, audio)
+    for beat in graph.beats:
+        np.testing.assert_array_equal(beat['buffer'], audio[beat['start_index']:beat['stop_index']])
+
+
+def test_beat_times_keep_their_own_precision():
+    beat_seconds = np.array([0.5, 0.51, 1.0301, 2.0])
+    beat_frames = (beat_seconds * 10).astype(int)
+    boundaries = np.unique(np.concatenate(([0], beat_frames, [30])))
+    times = remixatron.beats_to_times(boundaries, boundaries / 10.0, beat_frames, beat_seconds)
+    # the frame at 0 and the last one aren't beats, and two beats share frame 5
+    np.testing.assert_array_equal(times, [0.0, 0.5, 1.0301, 2.0, 3.0])
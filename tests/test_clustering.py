@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from loopbot import remixatron
+from loopbot.benchmarks import synth
+
+
+@pytest.fixture(scope='module', params=[1.0, 3.0])
+def song(request, tmp_path_factory):
+    # only the tests that run the whole analysis need madmom, for the beat tracking
+    pytest.importorskip('madmom')
+    # the longer song repeats its sections exactly, so its Laplacian has runs of equal eigenvalues
+    filename = tmp_path_factory.mktemp('synth') / 'song.wav'
+    synth.write_song(str(filename), minutes=request.param, seed=0)
+    return str(filename)
+
+
+def canonical(labels):
+    # relabels the clusters in order of first appearance, so labellings that only differ by a permutation compare equal
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first))
+    return order[inverse.reshape(-1)]
+
+
+def clusters(filename, **kwargs):
+    jukebox = remixatron.InfiniteJukebox(filename, **kwargs)
+    return jukebox.clusters, canonical(jukebox.beats.column('cluster'))
+
+
+def test_clusters_are_repeatable(song):
+    first_count, first_labels = clusters(song)
+    second_count, second_labels = clusters(song)
+    assert first_count == second_count
+    np.testing.assert_array_equal(first_labels, second_labels)
+
+
+def test_partial_eigensolver_matches_dense(song):
+    dense_count, dense_labels = clusters(song, eigen_solver='dense')
+    partial_count, partial_labels = clusters(song, eigen_solver='partial')
+    assert dense_count == partial_count
+    np.testing.assert_array_equal(dense_labels, partial_labels)
+
+
+def pinned(evals, evecs, k):
+    evecs = np.array(evecs[:, :k])
+    remixatron.fix_degenerate_eigenvectors(evals, evecs)
+    return remixatron.fix_eigenvector_signs(evecs)
+
+
+def repeated_laplacian(section, repeats, seed):
+    # a song that's one section over and over, with no similarity between the repeats: every eigenvalue comes repeats times over
+    a = np.random.RandomState(seed).rand(section, section)
+    return scipy.sparse.csgraph.laplacian(np.kron(np.eye(repeats), a + a.T), normed=True)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_partial_eigenvectors_match_dense_when_repeated(sparse):
+    L = repeated_laplacian(section=40, repeats=6, seed=0)
+    k = 24
+    dense = pinned(*scipy.linalg.eigh(L), k)
+    partial = pinned(*remixatron.smallest_eigenvectors(scipy.sparse.csr_matrix(L) if sparse else L.copy(), k), k)
+    np.testing.assert_allclose(partial, dense, atol=1e-8)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_partial_eigenvectors_use_lower_triangle(sparse):
+    # like the median filtered recurrence matrix, this isn't quite symmetric, and eigh() only reads the lower triangle
+    rng = np.random.RandomState(1)
+    a = rng.rand(200, 200)
+    L = scipy.sparse.csgraph.laplacian(a + a.T + np.triu(rng.rand(200, 200) * .1, k=1), normed=True)
+    k = 12
+    dense = pinned(*scipy.linalg.eigh(L), k)
+    partial = pinned(*remixatron.smallest_eigenvectors(scipy.sparse.csr_matrix(L) if sparse else L.copy(), k), k)
+    np.testing.assert_allclose(partial, dense, atol=1e-8)
+
+
+def test_canonical():
+    np.testing.assert_array_equal(canonical([2, 2, 0, 1, 0]), [0, 0, 1, 2, 1])
+    np.testing.assert_array_equal(canonical([5, 5, 3, 4, 3]), canonical([2, 2, 0, 1, 0]))
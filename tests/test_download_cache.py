@@ -0,0 +1,106 @@
+import functools
+import http.server
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('yt_dlp')
+
+from loopbot.bot.download_cache import DownloadCache
+from loopbot.pcm_store import PCMStore
+
+FILE_BYTES = 1000
+MONTH_SECONDS = 30 * 24 * 60 * 60
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+
+class QuietServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address) -> None:
+        # yt-dlp hangs up partway through its first look at a file, which isn't worth a traceback
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    # yt-dlp won't touch file:// urls, so the "remote" files are served over http instead
+    served = tmp_path / 'served'
+    served.mkdir()
+    httpd = QuietServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=str(served)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield served, f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+    thread.join()
+
+
+def serve(server, name):
+    served, base = server
+    path = served / name
+    path.write_bytes(os.urandom(FILE_BYTES))
+    # as if it was uploaded a while ago: yt-dlp gives the download this mtime too
+    os.utime(path, (time.time(), time.time() - MONTH_SECONDS))
+    return f'{base}/{name}'
+
+
+@pytest.fixture
+def cache(tmp_path):
+    options = {'quiet': True, 'no_warnings': True, 'noprogress': True, 'format': 'bestaudio/best'}
+    return DownloadCache(tmp_path / 'downloads', options, max_bytes=int(FILE_BYTES * 2.5))
+
+
+def test_miss_then_hit(server, cache):
+    info = cache.extract_info(serve(server, 'a.wav'))
+    assert cache.lookup(info) is None
+    path = cache.download(info)
+    assert path.read_bytes() == (server[0] / 'a.wav').read_bytes()
+    assert cache.stats == {'hits': 0, 'misses': 1}
+    assert cache.download(info) == path
+    assert cache.stats == {'hits': 1, 'misses': 1}
+
+
+def test_hit_keeps_pcm_store_key(server, cache):
+    info = cache.extract_info(serve(server, 'a.wav'))
+    path = cache.download(info)
+    mtime = path.stat().st_mtime_ns
+    key = PCMStore.key(str(path), sample_rate=48000)
+    before = path.stat().st_atime_ns
+    time.sleep(0.01)
+    assert cache.download(info) == path
+    assert path.stat().st_mtime_ns == mtime
+    assert PCMStore.key(str(path), sample_rate=48000) == key
+    assert path.stat().st_atime_ns > before
+
+
+def test_evicts_least_recently_used(server, cache):
+    a = cache.extract_info(serve(server, 'a.wav'))
+    b = cache.extract_info(serve(server, 'b.wav'))
+    c = cache.extract_info(serve(server, 'c.wav'))
+    a_path = cache.download(a)
+    b_path = cache.download(b)
+    time.sleep(0.01)
+    # a is the older download, but the more recently used
+    cache.download(a)
+    c_path = cache.download(c)
+    assert a_path.exists()
+    assert not b_path.exists()
+    assert c_path.exists()
+    assert cache.stats == {'hits': 1, 'misses': 3}
+    assert cache.lookup(b) is None
+
+
+def test_evicts_unused_files_by_age(server, cache):
+    a = cache.extract_info(serve(server, 'a.wav'))
+    b = cache.extract_info(serve(server, 'b.wav'))
+    a_path = cache.download(a)
+    b_path = cache.download(b)
+    # both have month old mtimes, but only a hasn't been used for a week
+    os.utime(a_path, (time.time() - MONTH_SECONDS, a_path.stat().st_mtime))
+    cache.evict()
+    assert not a_path.exists()
+    assert b_path.exists()